@@ -1,9 +1,10 @@
 from django.views.generic import ListView, DetailView
 
+from payments_logic.routers import ReplicaReadMixin
 from .models import Post
 
 
-class PostList(ListView):
+class PostList(ReplicaReadMixin, ListView):
     model = Post
     template_name = 'post_list.html'
     context_object_name = 'posts'
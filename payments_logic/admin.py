@@ -1,7 +1,9 @@
 from django.contrib import admin
 
-from .models import Payment, Travel, Friendship
+from .models import Payment, Travel, Friendship, TravelBalance, ExchangeRate
 
 admin.site.register(Payment)
 admin.site.register(Friendship)
 admin.site.register(Travel)
+admin.site.register(TravelBalance)
+admin.site.register(ExchangeRate)
@@ -0,0 +1,92 @@
+from django.contrib.auth.models import User
+from django.db.models import Count, Exists, F, OuterRef, Sum
+from django.db.models.functions import Abs
+
+import payments_logic.archive as archive
+from . import fx
+from .models import Debt, Payment
+
+
+def grouped_rows(travel_id):
+    """
+    Сгруппированные строки для трех разрезов, каждый - один агрегирующий запрос
+    (к долям добавляются платежи без должников, обычно их единицы).
+    Валюта и дата платежа входят в группировку: суммы пересчитываются в валюту путешествия по курсу на дату.
+    """
+    payments = Payment.objects.filter(travel_id=travel_id)
+    days = (payments
+            .values('date', 'currency')
+            .annotate(total=Sum('value'), count=Count('id'))
+            .order_by())
+    payers = (payments
+              .values('payer_id', 'currency', 'date')
+              .annotate(total=Sum('value'))
+              .order_by())
+    # Доля плательщика записана в Debt с минусом, поэтому берем модуль
+    shares = list(Debt.objects
+                  .filter(travel_id=travel_id)
+                  .values('debitor_id', currency=F('source__currency'), date=F('source__date'))
+                  .annotate(total=Sum(Abs('value')))
+                  .order_by())
+    # Платеж без других должников долей не создает и целиком приходится на плательщика
+    shares += list(payments
+                   .filter(~Exists(Debt.objects.filter(source_id=OuterRef('pk'))))
+                   .values('currency', 'date', debitor_id=F('payer_id'))
+                   .annotate(total=Sum('value'))
+                   .order_by())
+    return list(days), list(payers), shares
+
+
+def snapshot_rows(travel_id):
+    # Те же строки из снимка архивного путешествия
+    days, payers, shares = {}, {}, {}
+    for payment in archive.load_snapshot(travel_id)['payments']:
+        currency, date = payment['currency'], payment['date']
+        day = days.setdefault((date, currency), {'date': date, 'currency': currency, 'total': 0, 'count': 0})
+        day['total'] += payment['value']
+        day['count'] += 1
+        payer = payers.setdefault((payment['payer_id'], currency, date),
+                                  {'payer_id': payment['payer_id'], 'currency': currency, 'date': date, 'total': 0})
+        payer['total'] += payment['value']
+        for debitor_id, value in payment['debts'] or [(payment['payer_id'], payment['value'])]:
+            share = shares.setdefault((debitor_id, currency, date),
+                                      {'debitor_id': debitor_id, 'currency': currency, 'date': date, 'total': 0})
+            share['total'] += abs(value)
+    return list(days.values()), list(payers.values()), list(shares.values())
+
+
+def add_up(rows, key, field='total'):
+    totals = {}
+    for row in rows:
+        totals[row[key]] = totals.get(row[key], 0) + row[field]
+    return totals
+
+
+def travel_spending(travel, travelers):
+    """
+    Траты путешествия в его валюте: по дням (сумма и число платежей), по плательщикам
+    и по долям участников. travelers - уже загруженный список участников для имен.
+    """
+    days, payers, shares = snapshot_rows(travel.id) if travel.archived else grouped_rows(travel.id)
+    days = fx.convert_totals(days, travel.currency)
+    payers = fx.convert_totals(payers, travel.currency)
+    shares = fx.convert_totals(shares, travel.currency)
+
+    counts = add_up(days, 'date', 'count')
+    by_day = add_up(days, 'date')
+    by_payer = add_up(payers, 'payer_id')
+    by_share = add_up(shares, 'debitor_id')
+
+    # Участник мог быть исключен из путешествия после оплаты
+    users = {user.id: user for user in travelers}
+    missing = (by_payer.keys() | by_share.keys()) - users.keys()
+    if missing:
+        users.update(User.objects.in_bulk(missing))
+
+    return {'currency': travel.currency,
+            'total': sum(by_day.values(), fx.CENT * 0),
+            'days': [(date, by_day[date], counts[date]) for date in sorted(by_day)],
+            'payers': [(user_id, users[user_id].get_full_name(), total)
+                       for user_id, total in sorted(by_payer.items(), key=lambda item: -item[1])],
+            'shares': [(user_id, users[user_id].get_full_name(), total)
+                       for user_id, total in sorted(by_share.items(), key=lambda item: -item[1])]}
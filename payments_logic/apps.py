@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class PaymentsLogicConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'payments_logic'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .search import ensure_index
+
+        # Полнотекстовый индекс не описывается моделями, создаем его после migrate
+        post_migrate.connect(ensure_index, sender=self)
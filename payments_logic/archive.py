@@ -0,0 +1,198 @@
+import datetime
+import json
+import zlib
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+import payments_logic.ledger as ledger
+from . import fx
+from .models import Debt, Payment, Travel, TravelArchive
+
+SNAPSHOT_FORMAT = 1
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def pack(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode(), 9)
+
+
+def unpack(blob):
+    """
+    Снимок в виде, удобном для чтения: платежи - словари с Decimal и date,
+    у каждого список долей (debitor_id, value), включая отрицательную долю плательщика.
+    """
+    data = json.loads(zlib.decompress(bytes(blob)))
+    payments = [{'id': payment_id,
+                 'key': key,
+                 'title': title,
+                 'value': Decimal(value),
+                 'currency': currency,
+                 'date': datetime.date.fromisoformat(date),
+                 'payer_id': payer_id,
+                 'version': version,
+                 'debts': [(debitor_id, Decimal(debt)) for debitor_id, debt in debts]}
+                for payment_id, key, title, value, currency, date, payer_id, version, debts in data['payments']]
+    totals = [{'debitor_id': debitor_id,
+               'payer_id': payer_id,
+               'currency': currency,
+               'date': datetime.date.fromisoformat(date),
+               'total': Decimal(total)}
+              for debitor_id, payer_id, currency, date, total in data['totals']]
+    return {'payments': payments, 'totals': totals}
+
+
+def load_snapshot(travel_id):
+    return unpack(TravelArchive.objects.filter(travel_id=travel_id).values_list('snapshot', flat=True).get())
+
+
+@transaction.atomic
+def archive_travel(travel_id):
+    """
+    Замораживает завершенное путешествие: платежи, доли и итоги по парам уходят в один сжатый снимок,
+    строки Payment и Debt удаляются. TravelBalance остается - по нему считаются балансы и сокращенные итоги.
+    Вместе со строками платежи уходят и из поискового индекса: в поиске остается само путешествие,
+    платежи снова находятся после restore_travel.
+    """
+    base, _ = ledger.lock_travel(travel_id)
+    travel = Travel.objects.get(pk=travel_id)
+    if travel.archived:
+        raise ArchiveError(f'Путешествие {travel_id} уже в архиве')
+    if travel.end_date >= datetime.date.today():
+        raise ArchiveError(f'Путешествие {travel_id} еще не закончилось')
+
+    # Отбор через source, а не по копии travel_id: у строк до backfill_debts она пустая,
+    # и такие доли не попали бы в снимок, но удалились бы вместе с платежами
+    debts = {}
+    for source_id, debitor_id, value in (Debt.objects
+                                         .filter(source__travel_id=travel_id)
+                                         .order_by('id')
+                                         .values_list('source_id', 'debitor_id', 'value')):
+        debts.setdefault(source_id, []).append([debitor_id, str(value)])
+    payments = [[payment_id, key, title, str(value), currency, date.isoformat(), payer_id, version,
+                 debts.get(payment_id, [])]
+                for payment_id, key, title, value, currency, date, payer_id, version in
+                (Payment.objects
+                 .filter(travel_id=travel_id)
+                 .order_by('id')
+                 .values_list('id', 'client_key', 'title', 'value', 'currency', 'date', 'payer_id', 'version'))]
+    # Те же строки, что агрегирует страница итогов: по парам, в валюте и на дату платежа
+    totals = [[row['debitor_id'], row['source__payer_id'], row['currency'], row['date'].isoformat(),
+               str(row['total'])]
+              for row in (Debt.objects
+                          .filter(source__travel_id=travel_id)
+                          .exclude(debitor_id=F('source__payer_id'))
+                          .values('debitor_id', 'source__payer_id',
+                                  currency=F('source__currency'), date=F('source__date'))
+                          .annotate(total=Sum('value'))
+                          .order_by())]
+    spent = fx.convert_totals(Payment.objects
+                              .filter(travel_id=travel_id)
+                              .values('currency', 'date')
+                              .annotate(total=Sum('value'), count=Count('id'))
+                              .order_by(),
+                              base)
+
+    TravelArchive.objects.create(travel_id=travel_id,
+                                 snapshot=pack({'format': SNAPSHOT_FORMAT, 'payments': payments, 'totals': totals}),
+                                 payments_count=len(payments),
+                                 total_spent=sum((row['total'] for row in spent), fx.CENT * 0))
+    Debt.objects.filter(source__travel_id=travel_id).delete()
+    Payment.objects.filter(travel_id=travel_id).delete()
+    Travel.objects.filter(pk=travel_id).update(archived=True)
+    return len(payments)
+
+
+@transaction.atomic
+def restore_travel(travel_id):
+    # Возвращает строки Payment и Debt с прежними id и версиями: курсоры клиентов синхронизации остаются верными
+    ledger.lock_travel(travel_id)
+    if not Travel.objects.filter(pk=travel_id, archived=True).exists():
+        raise ArchiveError(f'Путешествие {travel_id} не в архиве')
+
+    snapshot = load_snapshot(travel_id)
+    payments = snapshot['payments']
+    Payment.objects.bulk_create([Payment(id=payment['id'], client_key=payment['key'], title=payment['title'],
+                                         value=payment['value'], currency=payment['currency'],
+                                         date=payment['date'], payer_id=payment['payer_id'],
+                                         version=payment['version'], travel_id=travel_id)
+                                 for payment in payments], batch_size=1000)
+    Debt.objects.bulk_create([Debt(source_id=payment['id'], debitor_id=debitor_id, value=value,
+                                   travel_id=travel_id, payer_id=payment['payer_id'])
+                              for payment in payments for debitor_id, value in payment['debts']], batch_size=1000)
+    TravelArchive.objects.filter(travel_id=travel_id).delete()
+    Travel.objects.filter(pk=travel_id).update(archived=False)
+    return len(payments)
+
+
+def payments_page(travel_id, after, before, size):
+    """
+    Страница платежей снимка по курсору id, как service_functions.keyset_page.
+    Возвращает строки, должников по платежам и курсоры.
+    """
+    payments = load_snapshot(travel_id)['payments']
+    if before is not None:
+        earlier = [payment for payment in payments if payment['id'] < before]
+        rows = earlier[-size:]
+        prev_cursor = rows[0]['id'] if len(earlier) > size and rows else None
+        next_cursor = rows[-1]['id'] if rows else None
+    else:
+        later = [payment for payment in payments if after is None or payment['id'] > after]
+        rows = later[:size]
+        prev_cursor = rows[0]['id'] if after is not None and rows else None
+        next_cursor = rows[-1]['id'] if len(later) > size else None
+
+    debitors = {payment['id']: [debitor_id for debitor_id, _ in payment['debts']] for payment in rows}
+    page = [{key: payment[key] for key in ('id', 'title', 'value', 'currency', 'payer_id')} for payment in rows]
+    return page, debitors, prev_cursor, next_cursor
+
+
+def summary_rows(travel_ids):
+    """
+    Итоги по парам (debitor_id, payer_id, currency, date, total) из снимков - для страницы итогов
+    и взаиморасчетов по всем путешествиям.
+    """
+    rows = []
+    for blob in TravelArchive.objects.filter(travel_id__in=travel_ids).values_list('snapshot', flat=True):
+        rows.extend(unpack(blob)['totals'])
+    return rows
+
+
+def pull_rows(travel_id, since, last_id, limit):
+    # Платежи снимка после курсора синхронизации, в порядке (version, id), как из Payment
+    rows = [payment for payment in sorted(load_snapshot(travel_id)['payments'],
+                                          key=lambda payment: (payment['version'], payment['id']))
+            if payment['version'] > since or
+            (last_id is not None and payment['version'] == since and payment['id'] > last_id)][:limit + 1]
+    debitors = {payment['id']: [debitor_id for debitor_id, _ in payment['debts']] for payment in rows}
+    return [(payment['id'], payment['key'], payment['title'], payment['value'], payment['currency'],
+             payment['date'], payment['payer_id'], payment['version']) for payment in rows], debitors
+
+
+def ledger_rows(travels):
+    """
+    Строки выгрузки по архивным путешествиям из travels в формате export.ledger_rows.
+    """
+    for travel_id, travel_title in travels.filter(archived=True).order_by('id').values_list('id', 'title'):
+        payments = load_snapshot(travel_id)['payments']
+        users = User.objects.in_bulk({payment['payer_id'] for payment in payments} |
+                                     {debitor_id for payment in payments for debitor_id, _ in payment['debts']})
+        for payment in payments:
+            row = {'type': 'payment',
+                   'travel_id': travel_id,
+                   'travel': travel_title,
+                   'payment_id': payment['id'],
+                   'title': payment['title'],
+                   'date': payment['date'].isoformat(),
+                   'payer': users[payment['payer_id']].username,
+                   'debitor': '',
+                   'value': str(payment['value']),
+                   'currency': payment['currency']}
+            yield row
+            for debitor_id, value in payment['debts']:
+                yield dict(row, type='debt', debitor=users[debitor_id].username, value=str(value))
@@ -0,0 +1,95 @@
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import events
+from .models import Travel
+
+MISSING = object()
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def get_cache():
+    return caches[getattr(settings, 'TRAVEL_CACHE_ALIAS', 'travels')]
+
+
+def bump_version(travel_id):
+    # Старые ключи не удаляем: они перестают читаться и вытесняются по LRU/TTL самого бэкенда
+    Travel.objects.filter(pk=travel_id).update(version=F('version') + 1, modified=timezone.now())
+    transaction.on_commit(lambda: events.publish(travel_id))
+
+
+def make_key(travel, kind, *parts):
+    return ':'.join(['travel', str(travel.id), str(travel.version), kind] + [str(part) for part in parts])
+
+
+def get_or_compute(travel, kind, parts, compute):
+    cache = get_cache()
+    key = make_key(travel, kind, *parts)
+    value = cache.get(key, MISSING)
+    if value is not MISSING:
+        count(kind, 'hits')
+        return value
+
+    count(kind, 'misses')
+    value = compute()
+    cache.set(key, value)
+    return value
+
+
+def get_travelers(travel):
+    # Общий для страницы путешествия и формы платежа список, сбрасывается сменой версии
+    return get_or_compute(travel, 'travelers', (),
+                          lambda: list(travel.travelers.order_by('first_name', 'last_name')))
+
+
+def friends_key(user_id):
+    return f'user:{user_id}:friends'
+
+
+def get_friends(user):
+    """
+    Друзья пользователя вместе с ним самим - варианты попутчиков в форме путешествия.
+    Ключ без версии: его удаляют сигналы Friendship.
+    """
+    cache = get_cache()
+    key = friends_key(user.id)
+    friends = cache.get(key, MISSING)
+    if friends is not MISSING:
+        count('friends', 'hits')
+        return friends
+
+    count('friends', 'misses')
+    friends = list(User.objects
+                   .filter(Q(creators_friend__creator=user) | Q(pk=user.pk))
+                   .distinct()
+                   .order_by('first_name', 'last_name'))
+    cache.set(key, friends)
+    return friends
+
+
+def invalidate_friends(user_id):
+    get_cache().delete(friends_key(user_id))
+
+
+def count(kind, event):
+    with _stats_lock:
+        kind_stats = _stats.setdefault(kind, {'hits': 0, 'misses': 0})
+        kind_stats[event] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return {kind: dict(kind_stats) for kind, kind_stats in _stats.items()}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,97 @@
+import hashlib
+
+from django.db.models import Count, Max, Sum
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .models import Travel
+
+MISSING = object()
+
+
+def query_digest(request):
+    # Разные курсоры и режимы страницы - разные представления одного путешествия
+    return hashlib.md5(request.GET.urlencode().encode()).hexdigest()[:8]
+
+
+def travel_state(request, pk):
+    """
+    Версия и время изменения путешествия одним запросом на весь ответ:
+    их читают и ETag, и Last-Modified. Чужое путешествие не находится, и 404 отдает само представление.
+    """
+    state = getattr(request, '_travel_state', MISSING)
+    if state is MISSING:
+        state = Travel.objects.filter(pk=pk, travelers=request.user).values_list('version', 'modified').first()
+        request._travel_state = state
+    return state
+
+
+def travels_state(request):
+    state = getattr(request, '_travels_state', MISSING)
+    if state is MISSING:
+        state = (Travel.objects
+                 .filter(travelers=request.user)
+                 .aggregate(count=Count('id'), versions=Sum('version'), modified=Max('modified')))
+        request._travels_state = state
+    return state
+
+
+def travel_etag(kind):
+    def etag(request, pk, **kwargs):
+        if not request.user.is_authenticated:
+            return None
+        state = travel_state(request, pk)
+        if state is None:
+            return None
+        version, modified = state
+        return f'{kind}-{pk}-{version}-{modified.timestamp():.6f}-{request.user.pk}-{query_digest(request)}'
+    return etag
+
+
+def travel_last_modified(request, pk, **kwargs):
+    if not request.user.is_authenticated:
+        return None
+    state = travel_state(request, pk)
+    return state[1] if state else None
+
+
+def travels_etag(request, **kwargs):
+    if not request.user.is_authenticated:
+        return None
+    state = travels_state(request)
+    modified = state['modified'].timestamp() if state['modified'] else 0
+    return f'list-{request.user.pk}-{state["count"]}-{state["versions"] or 0}-{modified:.6f}-{query_digest(request)}'
+
+
+def travels_last_modified(request, **kwargs):
+    if not request.user.is_authenticated:
+        return None
+    return travels_state(request)['modified']
+
+
+def revalidate(view):
+    # Браузер хранит страницу только для себя и каждый раз сверяет ETag, получая 304 без тела
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if request.user.is_authenticated and request.method in ('GET', 'HEAD'):
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+    return wrapper
+
+
+class ConditionalTravelMixin:
+    """
+    Страница путешествия: на If-None-Match/If-Modified-Since отвечаем 304 после одной выборки версии,
+    не запрашивая платежи и не рендеря шаблон.
+    """
+    etag_kind = 'detail'
+
+    def get(self, request, *args, **kwargs):
+        view = condition(etag_func=travel_etag(self.etag_kind), last_modified_func=travel_last_modified)(super().get)
+        return revalidate(view)(request, *args, **kwargs)
+
+
+class ConditionalTravelsMixin:
+    def get(self, request, *args, **kwargs):
+        view = condition(etag_func=travels_etag, last_modified_func=travels_last_modified)(super().get)
+        return revalidate(view)(request, *args, **kwargs)
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .models import Travel
+
+QUEUE_SIZE = 16
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+class LocalBroker:
+    """
+    Pub/sub внутри одного процесса: публикация приходит из потока представления,
+    подписчики - очереди asyncio своих event loop.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def publish(self, travel_id):
+        with self.lock:
+            subscribers = list(self.subscribers.get(travel_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(self.notify, queue)
+
+    @staticmethod
+    def notify(queue):
+        # Событие - только сигнал "есть изменения": подписчик сам дочитывает их от своего курсора,
+        # поэтому переполненную очередь можно не пополнять
+        if not queue.full():
+            queue.put_nowait(True)
+
+    def subscribe(self, travel_id):
+        subscription = (asyncio.get_running_loop(), asyncio.Queue(QUEUE_SIZE))
+        with self.lock:
+            self.subscribers.setdefault(travel_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, travel_id, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(travel_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[travel_id]
+
+
+class DatabaseBroker(LocalBroker):
+    """
+    Для нескольких воркеров: записи идут в других процессах, поэтому каждый процесс
+    раз в EVENTS_POLL_INTERVAL одним запросом сверяет версии путешествий, на которые есть подписчики.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.versions = {}
+        self.pollers = set()
+
+    def subscribe(self, travel_id):
+        subscription = super().subscribe(travel_id)
+        loop = subscription[0]
+        with self.lock:
+            if loop not in self.pollers:
+                self.pollers.add(loop)
+                loop.create_task(self.poll(loop))
+        return subscription
+
+    async def poll(self, loop):
+        interval = getattr(settings, 'EVENTS_POLL_INTERVAL', 1)
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                with self.lock:
+                    travel_ids = list(self.subscribers)
+                if not travel_ids:
+                    continue
+                versions = await sync_to_async(self.read_versions)(travel_ids)
+                for travel_id, version in versions.items():
+                    if self.versions.get(travel_id, version) != version:
+                        LocalBroker.publish(self, travel_id)
+                    self.versions[travel_id] = version
+        finally:
+            with self.lock:
+                self.pollers.discard(loop)
+
+    @staticmethod
+    def read_versions(travel_ids):
+        return dict(Travel.objects.filter(pk__in=travel_ids).values_list('id', 'version'))
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(getattr(settings, 'EVENTS_BROKER', 'payments_logic.events.LocalBroker'))()
+        return _broker
+
+
+def publish(travel_id):
+    get_broker().publish(travel_id)
@@ -0,0 +1,130 @@
+import csv
+import io
+import itertools
+import json
+import zlib
+
+from django.db.models import F, Q
+
+import payments_logic.archive as archive
+from .models import Payment, Debt
+
+CHUNK_SIZE = 2000
+
+FIELDS = ['type', 'travel_id', 'travel', 'payment_id', 'title', 'date', 'payer', 'debitor', 'value', 'currency']
+
+CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8',
+                 'ndjson': 'application/x-ndjson; charset=utf-8'}
+
+
+def keyset_iterator(queryset, keys, chunk_size=CHUNK_SIZE):
+    """
+    Читает values()-queryset кусками по ключу сортировки keys.
+    Драйвер MySQL буферизует весь результат запроса даже при iterator(), поэтому в памяти
+    держим не больше одного куска.
+    """
+    queryset = queryset.order_by(*keys)
+    last = None
+    while True:
+        chunk = queryset
+        if last is not None:
+            condition = Q()
+            for i, key in enumerate(keys):
+                condition |= Q(**{prefix: last[prefix] for prefix in keys[:i]}, **{f'{key}__gt': last[key]})
+            chunk = chunk.filter(condition)
+        count = 0
+        for row in chunk[:chunk_size].iterator(chunk_size=chunk_size):
+            count += 1
+            last = row
+            yield row
+        if count < chunk_size:
+            return
+
+
+def ledger_rows(travels):
+    """
+    Строки выгрузки: за каждым платежом идут его доли Debt.
+    Оба запроса читаются кусками в порядке id платежа и сливаются без накопления в памяти.
+    """
+    payments = keyset_iterator(Payment.objects
+                               .filter(travel__in=travels)
+                               .values('id', 'title', 'value', 'currency', 'date', 'travel_id',
+                                       travel_title=F('travel__title'),
+                                       payer_username=F('payer__username')),
+                               ['id'])
+    debts = keyset_iterator(Debt.objects
+                            .filter(travel__in=travels)
+                            .values('source_id', 'id', 'value', debitor_username=F('debitor__username')),
+                            ['source_id', 'id'])
+
+    debt = next(debts, None)
+    for payment in payments:
+        yield {'type': 'payment',
+               'travel_id': payment['travel_id'],
+               'travel': payment['travel_title'],
+               'payment_id': payment['id'],
+               'title': payment['title'],
+               'date': payment['date'].isoformat(),
+               'payer': payment['payer_username'],
+               'debitor': '',
+               'value': str(payment['value']),
+               'currency': payment['currency']}
+        while debt is not None and debt['source_id'] <= payment['id']:
+            if debt['source_id'] == payment['id']:
+                yield {'type': 'debt',
+                       'travel_id': payment['travel_id'],
+                       'travel': payment['travel_title'],
+                       'payment_id': payment['id'],
+                       'title': payment['title'],
+                       'date': payment['date'].isoformat(),
+                       'payer': payment['payer_username'],
+                       'debitor': debt['debitor_username'],
+                       'value': str(debt['value']),
+                       'currency': payment['currency']}
+            debt = next(debts, None)
+
+
+def encode_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def encode_ndjson(rows):
+    for row in rows:
+        yield (json.dumps(row, ensure_ascii=False) + '\n').encode()
+
+
+def regroup(chunks, size=64 * 1024):
+    # Отдаем клиенту куски разумного размера, а не по строке
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(travels, fmt, compress=False):
+    encode = encode_ndjson if fmt == 'ndjson' else encode_csv
+    stream = regroup(encode(itertools.chain(ledger_rows(travels), archive.ledger_rows(travels))))
+    return gzip_stream(stream) if compress else stream
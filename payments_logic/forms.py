@@ -1,8 +1,14 @@
+import datetime
+import re
+
 from django import forms
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.core.exceptions import ValidationError
 
-from .models import Travel, Payment, Friendship
+import payments_logic.cache as travel_cache
+import payments_logic.friends as friends
+from . import fx
+from .models import Travel, Payment
 
 
 class PersonForm(forms.Form):
@@ -15,23 +21,62 @@ class PersonForm(forms.Form):
               'email': 'email'}
 
 
-class UserChoiseField(forms.ModelChoiceField):
-    def label_from_instance(self, obj):
-        return obj.get_full_name()  # f'{obj.first_name} {obj.last_name}'
+class UserChoiseField(forms.ChoiceField):
+    """
+    Выбор из уже загруженного (обычно закэшированного) списка пользователей.
+    В отличие от ModelChoiceField не делает запросов ни при рендере, ни при проверке.
+    """
+
+    def __init__(self, users, to_field_name='pk', **kwargs):
+        self.to_field_name = to_field_name
+        self.users = {str(getattr(user, to_field_name)): user for user in users}
+        super().__init__(choices=[(key, user.get_full_name()) for key, user in self.users.items()], **kwargs)
+
+    def get_user(self, value):
+        try:
+            return self.users[str(value)]
+        except KeyError:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice',
+                                  params={'value': value})
+
+    def prepare_value(self, value):
+        return str(getattr(value, self.to_field_name)) if isinstance(value, User) else value
+
+    def to_python(self, value):
+        return None if value in self.empty_values else self.get_user(value)
+
+    def validate(self, value):
+        forms.Field.validate(self, value)
+
+
+class UserMultipleChoiseField(UserChoiseField):
+    widget = forms.SelectMultiple
+    hidden_widget = forms.MultipleHiddenInput
+
+    def prepare_value(self, value):
+        if isinstance(value, (list, tuple)):
+            return [super(UserMultipleChoiseField, self).prepare_value(item) for item in value]
+        return super(UserMultipleChoiseField, self).prepare_value(value)
 
+    def to_python(self, value):
+        if not value:
+            return []
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError(forms.MultipleChoiceField.default_error_messages['invalid_list'], code='invalid_list')
+        return list({user.pk: user for user in map(self.get_user, value)}.values())
 
-class UserMultipleChoiseField(forms.ModelMultipleChoiceField):
-    def label_from_instance(self, obj):
-        return obj.get_full_name()
+    def has_changed(self, initial, data):
+        return set(map(str, self.prepare_value(initial or []))) != set(map(str, data or []))
 
 
 class TravelForm(forms.ModelForm):
     class Meta:
         model = Travel
-        fields = ('title', 'start_date', 'end_date')
+        fields = ('title', 'start_date', 'end_date', 'currency')
         labels = {'start_date': 'Дата старта',
                   'end_date': 'Дата окончания',
-                  'title': 'Что за поездка?'}
+                  'title': 'Что за поездка?',
+                  'currency': 'Валюта расчетов'}
         widgets = {'start_date': forms.DateInput(attrs={'type': 'date'}),
                    'end_date': forms.DateInput(attrs={'type': 'date'}),
                    'title': forms.TextInput(attrs={'placeholder': 'Title of your travel'})}
@@ -40,10 +85,8 @@ class TravelForm(forms.ModelForm):
         current_user = kwargs.pop('current_user')
         super(TravelForm, self).__init__(**kwargs)
 
-        friends_ids = Friendship.objects.filter(creator__username=current_user).values_list('friend__username')
-
         self.fields['travelers'] = UserMultipleChoiseField(
-            User.objects.filter(Q(username__in=friends_ids) | Q(username=current_user)),
+            travel_cache.get_friends(current_user),
             label='Кто едет?',
             widget=forms.CheckboxSelectMultiple(),
             to_field_name='username')
@@ -56,24 +99,109 @@ class TravelForm(forms.ModelForm):
             msg = "Указаны некорректные даты: дата начала больше даты окончания."
             self._errors["date_validation"] = self.error_class([msg])
 
+        currency = self.cleaned_data.get('currency')
+        if self.instance.archived and 'currency' in self.changed_data:
+            self.add_error('currency', 'Путешествие в архиве, валюту изменить нельзя')
+        elif self.instance.pk and currency and 'currency' in self.changed_data:
+            # Балансы будут пересчитаны в новую валюту, нужны курсы на даты всех платежей
+            pairs = set(Payment.objects.filter(travel=self.instance).values_list('currency', 'date').distinct())
+            missing = pairs - fx.get_factors(pairs, currency).keys()
+            if missing:
+                missing_currency, missing_date = sorted(missing)[0]
+                self.add_error('currency', f'Нет курса {missing_currency} к {currency} на {missing_date}')
+
 
 class PaymentForm(forms.ModelForm):
 
     def __init__(self, **kwargs):
-        travel_id = kwargs.pop('travel_id')
+        # Путешествие уже загружено представлением, повторно его не читаем
+        self.travel = kwargs.pop('travel')
         super(PaymentForm, self).__init__(**kwargs)
-        travelers = Travel.objects.get(pk=travel_id).travelers.all()
+        # Один закэшированный список на оба поля вместо двух выборок travelers.all()
+        travelers = travel_cache.get_travelers(self.travel)
+        if not self.is_bound and not self.instance.pk:
+            self.initial['currency'] = self.travel.currency
+        if not self.is_bound and self.instance.pk:
+            self.initial['payer'] = self.instance.payer_id
+            self.initial['debitors'] = list(self.instance.debt_set
+                                            .exclude(debitor_id=self.instance.payer_id)
+                                            .values_list('debitor_id', flat=True))
+        # Клиенты без полей валюты и даты получают валюту путешествия и сегодняшнюю дату
+        self.fields['currency'].required = False
+        self.fields['date'].required = False
         self.fields['payer'] = UserChoiseField(travelers, label='Кто платит?', widget=forms.RadioSelect())
         self.fields['debitors'] = UserMultipleChoiseField(travelers,
                                                           label='На кого разделить счет?',
                                                           widget=forms.CheckboxSelectMultiple(),
                                                           required=False)
 
+    def clean(self):
+        super(PaymentForm, self).clean()
+        if 'currency' in self.cleaned_data and not self.cleaned_data['currency']:
+            self.cleaned_data['currency'] = self.instance.currency = self.travel.currency
+        if 'date' in self.cleaned_data and not self.cleaned_data['date']:
+            self.cleaned_data['date'] = self.instance.date = datetime.date.today()
+        currency = self.cleaned_data.get('currency')
+        date = self.cleaned_data.get('date')
+        if currency and date and not fx.get_factors({(currency, date)}, self.travel.currency):
+            self.add_error('currency', f'Нет курса {currency} к {self.travel.currency} на {date}')
+        return self.cleaned_data
+
     class Meta:
         model = Payment
-        fields = ('title', 'value')
+        fields = ('title', 'value', 'currency', 'date')
 
-        widgets = {'title': forms.TextInput(), }  # attrs={'placeholder': 'Title of payment'}),
+        widgets = {'title': forms.TextInput(),  # attrs={'placeholder': 'Title of payment'}),
+                   'date': forms.DateInput(attrs={'type': 'date'})}
 
         labels = {'title': 'Что оплатили?',
-                  'value': 'Сколько?', }
+                  'value': 'Сколько?',
+                  'currency': 'Валюта',
+                  'date': 'Когда?'}
+
+
+class ImportPaymentsForm(forms.Form):
+    FORMATS = [('csv', 'CSV / таблица'),
+               ('json', 'JSON / NDJSON')]
+
+    file = forms.FileField(label='Файл', required=False)
+    text = forms.CharField(label='Или вставьте таблицу', widget=forms.Textarea(), required=False)
+    format = forms.ChoiceField(label='Формат', choices=FORMATS, initial='csv')
+
+    def clean(self):
+        cleaned_data = super(ImportPaymentsForm, self).clean()
+        if not cleaned_data.get('file') and not cleaned_data.get('text'):
+            raise forms.ValidationError('Загрузите файл или вставьте таблицу')
+        return cleaned_data
+
+
+class FriendsForm(forms.Form):
+    # "Имя, email", "Имя; email", "Имя<TAB>email" или "Имя <email>"
+    LINE = re.compile(r'^\s*(?P<name>.+?)\s*(?:[,;\t]\s*<?|<)\s*(?P<email>[^\s,;<>]+)\s*>?\s*$')
+
+    people = forms.CharField(label='Друзья, по одному в строке: имя, email', widget=forms.Textarea())
+    travel = forms.ModelChoiceField(label='Сразу добавить в путешествие', queryset=Travel.objects.none(),
+                                    required=False)
+
+    def __init__(self, current_user, **kwargs):
+        super(FriendsForm, self).__init__(**kwargs)
+        self.fields['travel'].queryset = (Travel.objects
+                                          .filter(travelers=current_user, archived=False)
+                                          .order_by('-start_date'))
+
+    def clean_people(self):
+        people, errors = [], []
+        lines = [line for line in self.cleaned_data['people'].splitlines() if line.strip()]
+        if len(lines) > friends.MAX_FRIENDS:
+            raise ValidationError(f'Не больше {friends.MAX_FRIENDS} человек за раз')
+        for number, line in enumerate(lines, 1):
+            match = self.LINE.match(line)
+            try:
+                if match is None:
+                    raise ValueError('Ожидается "имя, email"')
+                people.append(friends.parse_person(match['name'], match['email']))
+            except ValueError as error:
+                errors.append(f'Строка {number}: {error}')
+        if errors:
+            raise ValidationError(errors)
+        return people
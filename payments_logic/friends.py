@@ -0,0 +1,107 @@
+import uuid
+
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.db.models.functions import Lower
+
+from .cache import invalidate_friends
+from .models import Friendship
+
+MAX_FRIENDS = 100
+USERNAME_LENGTH = User._meta.get_field('username').max_length
+
+
+class FriendsError(Exception):
+    pass
+
+
+def parse_person(name, email):
+    name = (name or '').strip()
+    email = (email or '').strip().lower()
+    if not name:
+        raise ValueError('Не указано имя')
+    if len(name) > User._meta.get_field('first_name').max_length:
+        raise ValueError('Слишком длинное имя')
+    try:
+        validate_email(email)
+    except ValidationError:
+        raise ValueError(f'Некорректный email: {email!r}')
+    return name, email
+
+
+def free_usernames(emails):
+    """
+    Логины новых пользователей - часть email до @, как при добавлении по одному.
+    Занятые логины проверяются одним запросом и получают случайный суффикс.
+    """
+    wanted = {email: email[:email.index('@')][:USERNAME_LENGTH - 9] for email in emails}
+    taken = set(User.objects.filter(username__in=wanted.values()).values_list('username', flat=True))
+    usernames = {}
+    for email, username in wanted.items():
+        if username in taken:
+            username = f'{username}-{uuid.uuid4().hex[:8]}'
+        taken.add(username)
+        usernames[email] = username
+    return usernames
+
+
+@transaction.atomic
+def add_friends(creator, people, travel=None):
+    """
+    Добавляет друзей списком пар (имя, email) за фиксированное число запросов:
+    существующие пользователи находятся одним запросом по email, недостающие пользователи и
+    дружбы создаются через bulk_create, повторы пропускаются. С travel все они сразу
+    становятся его участниками в той же транзакции.
+    Возвращает словарь со счетчиками created_users, created_friendships, added_travelers.
+    """
+    if len(people) > MAX_FRIENDS:
+        raise FriendsError(f'Не больше {MAX_FRIENDS} человек за раз')
+    names = {}
+    for name, email in people:
+        # При повторе email побеждает первое имя
+        names.setdefault(email.lower(), name)
+
+    users = {}
+    for user in (User.objects
+                 .annotate(email_lower=Lower('email'))
+                 .filter(email_lower__in=names)
+                 .order_by('id')):
+        # Если email повторяется у нескольких пользователей, берем самого раннего
+        users.setdefault(user.email_lower, user)
+
+    missing = [email for email in names if email not in users]
+    if missing:
+        usernames = free_usernames(missing)
+        # Вход у таких пользователей - через Google, пароль не задается, как у create_user без пароля
+        password = make_password(None)
+        User.objects.bulk_create([User(username=usernames[email], first_name=names[email], email=email,
+                                       password=password)
+                                  for email in missing])
+        # MySQL не возвращает id из bulk_create, перечитываем созданных по логину
+        users.update({user.email: user for user in User.objects.filter(username__in=usernames.values())})
+
+    friend_ids = {user.id for user in users.values()} - {creator.id}
+    existing = set(Friendship.objects
+                   .filter(creator=creator, friend_id__in=friend_ids)
+                   .values_list('friend_id', flat=True))
+    new_friends = friend_ids - existing
+    if new_friends:
+        Friendship.objects.bulk_create([Friendship(creator=creator, friend_id=friend_id)
+                                        for friend_id in sorted(new_friends)], ignore_conflicts=True)
+        # bulk_create не шлет post_save, сбрасываем кэш друзей сами
+        transaction.on_commit(lambda: invalidate_friends(creator.id))
+
+    added = 0
+    if travel is not None:
+        traveler_ids = {user.id for user in users.values()}
+        new_travelers = traveler_ids - set(travel.travelers.filter(pk__in=traveler_ids).values_list('id', flat=True))
+        if new_travelers:
+            travel.travelers.add(*sorted(new_travelers))
+        added = len(new_travelers)
+
+    return {'created_users': len(missing),
+            'created_friendships': len(new_friends),
+            'added_travelers': added}
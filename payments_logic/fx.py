@@ -0,0 +1,142 @@
+import datetime
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
+
+from .cache import get_cache
+from .models import ExchangeRate
+
+CENT = Decimal('0.01')
+RATES_VERSION_KEY = 'fx:rates_version'
+
+_cache_lock = threading.Lock()
+_cache = OrderedDict()
+# Версия курсов из общего кэша и время заполнения, к которым относится _cache
+_cache_state = {'version': None, 'filled': 0}
+
+
+class MissingRateError(Exception):
+    pass
+
+
+def reference_currency():
+    return getattr(settings, 'FX_REFERENCE_CURRENCY', 'RUR')
+
+
+def clear_cache():
+    """
+    Сбрасывает кэш курсов во всех процессах: версия в общем кэше поднимается,
+    и веб-процессы отбрасывают свои курсы при следующем обращении.
+    """
+    shared = get_cache()
+    try:
+        shared.incr(RATES_VERSION_KEY)
+    except ValueError:
+        shared.set(RATES_VERSION_KEY, 1, None)
+    with _cache_lock:
+        _cache.clear()
+        _cache_state['version'] = None
+
+
+def check_cache():
+    # Курсы процесса сбрасываются при смене версии и в любом случае раз в FX_CACHE_SECONDS:
+    # с locmem-бэкендом общего кэша версия между процессами не видна
+    version = get_cache().get(RATES_VERSION_KEY, 0)
+    now = time.monotonic()
+    max_age = getattr(settings, 'FX_CACHE_SECONDS', 300)
+    with _cache_lock:
+        if version != _cache_state['version'] or now - _cache_state['filled'] > max_age:
+            _cache.clear()
+            _cache_state.update(version=version, filled=now)
+
+
+def get_rates(pairs):
+    """
+    Курсы к опорной валюте для набора пар (currency, date): последний известный курс не позже даты.
+    Найденные курсы кэшируются в процессе, недостающие читаются из базы одним запросом.
+    """
+    check_cache()
+    reference = reference_currency()
+    rates = {}
+    missing = set()
+    with _cache_lock:
+        for pair in pairs:
+            if pair[0] == reference:
+                rates[pair] = Decimal(1)
+            elif pair in _cache:
+                _cache.move_to_end(pair)
+                rates[pair] = _cache[pair]
+            else:
+                missing.add(pair)
+    if not missing:
+        return rates
+
+    lookback = datetime.timedelta(days=getattr(settings, 'FX_LOOKBACK_DAYS', 14))
+    history = {}
+    for currency, date, rate in (ExchangeRate.objects
+                                 .filter(currency__in={currency for currency, _ in missing},
+                                         date__gte=min(date for _, date in missing) - lookback,
+                                         date__lte=max(date for _, date in missing))
+                                 .order_by('currency', 'date')
+                                 .values_list('currency', 'date', 'rate')):
+        dates, values = history.setdefault(currency, ([], []))
+        dates.append(date)
+        values.append(rate)
+
+    found = {}
+    for currency, date in missing:
+        dates, values = history.get(currency, ([], []))
+        position = bisect_right(dates, date)
+        if position and date - dates[position - 1] <= lookback:
+            found[(currency, date)] = values[position - 1]
+
+    with _cache_lock:
+        _cache.update(found)
+        while len(_cache) > getattr(settings, 'FX_CACHE_SIZE', 10000):
+            _cache.popitem(last=False)
+    rates.update(found)
+    return rates
+
+
+def get_factors(pairs, base):
+    # Множители пересчета (currency, date) -> base; пары без курса в результат не попадают
+    foreign = {(currency, date) for currency, date in pairs if currency != base}
+    factors = {pair: Decimal(1) for pair in pairs if pair not in foreign}
+    if foreign:
+        rates = get_rates(foreign | {(base, date) for _, date in foreign})
+        factors.update({(currency, date): rates[(currency, date)] / rates[(base, date)]
+                        for currency, date in foreign
+                        if (currency, date) in rates and (base, date) in rates})
+    return factors
+
+
+def require_factors(pairs, base):
+    pairs = set(pairs)
+    factors = get_factors(pairs, base)
+    if len(factors) != len(pairs):
+        currency, date = sorted(pairs - factors.keys())[0]
+        raise MissingRateError(f'Нет курса {currency} к {base} на {date}')
+    return factors
+
+
+def convert(value, currency, date, base, factors):
+    if currency == base:
+        return value
+    return (value * factors[(currency, date)]).quantize(CENT)
+
+
+def convert_totals(rows, base):
+    """
+    Пересчет агрегированных строк с ключами currency, date, total в валюту base.
+    Курс запрашивается один раз на пару (currency, date), а не на каждый платеж.
+    """
+    rows = list(rows)
+    factors = require_factors({(row['currency'], row['date']) for row in rows}, base)
+    for row in rows:
+        # SQLite суммирует decimal как float, возвращаем копейки к точному виду
+        row['total'] = convert(row['total'].quantize(CENT), row['currency'], row['date'], base, factors)
+    return rows
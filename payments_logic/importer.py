@@ -0,0 +1,190 @@
+import csv
+import datetime
+import io
+import json
+import re
+from decimal import Decimal, InvalidOperation
+
+import payments_logic.ledger as ledger
+from . import fx
+from .models import Payment, Travel
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+MIN_VALUE = Decimal('0.01')
+MAX_VALUE = Decimal('10000000.0')
+
+DEBITORS_SEPARATOR = re.compile(r'\s*[;,]\s*')
+CURRENCIES = {code for code, _ in Travel.CURRENCIES}
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+
+def read_csv(stream):
+    # Таблицы, вставленные из Excel/Google Sheets, разделены табуляцией - определяем разделитель по шапке
+    header = stream.readline()
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    fields = next(csv.reader([header], dialect))
+    for line, row in enumerate(csv.DictReader(stream, fieldnames=fields, dialect=dialect), start=2):
+        yield line, row
+
+
+def read_json(stream, chunk_size=64 * 1024):
+    """
+    Потоковое чтение JSON: массив объектов или NDJSON (объект на строку).
+    Файл не загружается в память целиком, разбираются только уже прочитанные объекты.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    line = 1
+    finished = False
+    while True:
+        buffer = buffer[position:]
+        position = 0
+        if not finished:
+            chunk = stream.read(chunk_size)
+            finished = not chunk
+            buffer += chunk
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+                if buffer[position] == '\n':
+                    line += 1
+                position += 1
+            if position >= len(buffer):
+                break
+            try:
+                row, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+                break
+            yield line, row
+            line += buffer.count('\n', position, end)
+            position = end
+
+        if finished:
+            return
+
+
+def read_rows(stream, fmt):
+    return read_json(stream) if fmt == 'json' else read_csv(stream)
+
+
+def traveler_index(travel):
+    # Одним запросом: путешественника можно указать логином, email или полным именем
+    index = {}
+    for user_id, username, email, first_name, last_name in travel.travelers.values_list(
+            'id', 'username', 'email', 'first_name', 'last_name'):
+        for key in (username, email, f'{first_name} {last_name}'):
+            key = ' '.join(key.split()).lower()
+            if key:
+                index[key] = user_id
+    return index
+
+
+def parse_row(row, travel, travelers):
+    if not isinstance(row, dict):
+        raise ValueError('Строка должна быть объектом с полями title, value, payer, debitors')
+
+    title = str(row.get('title') or '').strip()
+    if not title:
+        raise ValueError('Не указано, что оплатили')
+    if len(title) > Payment._meta.get_field('title').max_length:
+        raise ValueError('Слишком длинное название')
+
+    try:
+        value = Decimal(str(row.get('value') or '').replace(' ', '').replace(',', '.')).quantize(ledger.CENT)
+    except InvalidOperation:
+        raise ValueError(f'Некорректная сумма: {row.get("value")!r}')
+    if not value.is_finite() or not MIN_VALUE <= value <= MAX_VALUE:
+        raise ValueError('Сумма должна быть от 0.01 до 10 миллионов')
+
+    payer = travelers.get(' '.join(str(row.get('payer') or '').split()).lower())
+    if payer is None:
+        raise ValueError(f'Плательщик {row.get("payer")!r} не участвует в путешествии')
+
+    debitors = row.get('debitors') or []
+    if isinstance(debitors, str):
+        debitors = [name for name in DEBITORS_SEPARATOR.split(debitors.strip()) if name]
+    elif not isinstance(debitors, list) or any(not isinstance(name, str) for name in debitors):
+        raise ValueError('Должники должны быть строкой через запятую или списком строк')
+    debitor_ids = []
+    for name in debitors:
+        debitor_id = travelers.get(' '.join(name.split()).lower())
+        if debitor_id is None:
+            raise ValueError(f'Должник {name!r} не участвует в путешествии')
+        if debitor_id not in debitor_ids:
+            debitor_ids.append(debitor_id)
+
+    currency = str(row.get('currency') or travel.currency).strip().upper()
+    if currency not in CURRENCIES:
+        raise ValueError(f'Неизвестная валюта: {currency!r}')
+
+    date = row.get('date') or datetime.date.today()
+    if not isinstance(date, datetime.date):
+        try:
+            date = datetime.date.fromisoformat(str(date).strip())
+        except ValueError:
+            raise ValueError(f'Некорректная дата: {date!r}, ожидается ГГГГ-ММ-ДД')
+
+    return ledger.PaymentRow(title, value, payer, debitor_ids, currency, date)
+
+
+def import_payments(travel, stream, fmt='csv', batch_size=BATCH_SIZE):
+    """
+    Импорт платежей из CSV/JSON потока. Ошибочные строки пропускаются и попадают в отчет,
+    остальные записываются пачками по batch_size в одной транзакции.
+    """
+    result = ImportResult()
+    travelers = traveler_index(travel)
+
+    def with_rates(batch):
+        # Курсы проверяем на всю пачку сразу: один запрос на недостающие пары (валюта, дата)
+        factors = fx.get_factors({(row.currency, row.date) for _, row in batch}, travel.currency)
+        valid = []
+        for line, row in batch:
+            if (row.currency, row.date) in factors:
+                valid.append(row)
+            else:
+                result.add_error(line, f'Нет курса {row.currency} к {travel.currency} на {row.date}')
+        return valid
+
+    def batches():
+        batch = []
+        try:
+            for line, row in read_rows(stream, fmt):
+                try:
+                    batch.append((line, parse_row(row, travel, travelers)))
+                except ValueError as error:
+                    result.add_error(line, str(error))
+                    continue
+                if len(batch) >= batch_size:
+                    yield with_rates(batch)
+                    batch = []
+        except (csv.Error, json.JSONDecodeError, UnicodeDecodeError) as error:
+            result.add_error(None, f'Не удалось прочитать файл: {error}')
+        if batch:
+            yield with_rates(batch)
+
+    result.created = ledger.bulk_record_payments(travel.id, batches())
+    return result
+
+
+def open_text(binary_stream):
+    return io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
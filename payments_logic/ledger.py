@@ -0,0 +1,260 @@
+from collections import namedtuple
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Count, F, Max
+from django.utils import timezone
+
+from . import events, fx
+from .models import Debt, Payment, PaymentTombstone, Travel, TravelBalance
+
+CENT = fx.CENT
+
+PaymentRow = namedtuple('PaymentRow', ['title', 'value', 'payer_id', 'debitor_ids', 'currency', 'date', 'client_key'],
+                        defaults=[None])
+
+
+def lock_travel(travel_id, bump=True):
+    """
+    Блокирует путешествие до конца транзакции и (при bump) поднимает его версию.
+    Возвращает валюту путешествия и версию, которой помечаются записываемые строки.
+
+    Блокировку берет UPDATE, а не SELECT ... FOR UPDATE: в SQLite FOR UPDATE нет, а транзакция,
+    начатая чтением, не ждет права на запись и сразу падает с "database is locked".
+    """
+    travels = Travel.objects.filter(pk=travel_id)
+    if bump:
+        travels.update(version=F('version') + 1, modified=timezone.now())
+        transaction.on_commit(lambda: events.publish(travel_id))
+    else:
+        travels.update(version=F('version'))
+    return travels.values_list('currency', 'version').get()
+
+
+def split_value(value, debitors_count):
+    # Округляем долю так же, как DecimalField при сохранении, чтобы баланс совпадал с Debt
+    return (value / (debitors_count + 1)).quantize(CENT)
+
+
+def debts_for_payment(payment, debitor_ids):
+    debitor_ids = [debitor_id for debitor_id in debitor_ids if debitor_id != payment.payer_id]
+    if not debitor_ids:
+        return []
+
+    value = split_value(payment.value, len(debitor_ids))
+    return [Debt(source=payment, value=0 - value, debitor_id=payment.payer_id,
+                 travel_id=payment.travel_id, payer_id=payment.payer_id)] + [
+        Debt(source=payment, value=value, debitor_id=debitor_id, travel_id=payment.travel_id, payer_id=payment.payer_id)
+        for debitor_id in debitor_ids]
+
+
+def balance_deltas(debts, payer_id, factor=1):
+    # Балансы хранятся в валюте путешествия, factor - курс валюты платежа к ней
+    deltas = {}
+    for debt in debts:
+        if debt.debitor_id == payer_id:
+            continue
+        value = debt.value if factor == 1 else (debt.value * factor).quantize(CENT)
+        deltas[debt.debitor_id] = deltas.get(debt.debitor_id, 0) - value
+        deltas[payer_id] = deltas.get(payer_id, 0) + value
+    return deltas
+
+
+def payment_factor(payment, base):
+    pair = (payment.currency, payment.date)
+    return fx.require_factors({pair}, base)[pair]
+
+
+def apply_deltas(travel_id, deltas):
+    deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    balances = {balance.user_id: balance for balance in
+                TravelBalance.objects.select_for_update().filter(travel_id=travel_id, user_id__in=deltas)}
+    for balance in balances.values():
+        balance.amount += deltas[balance.user_id]
+        balance.version += 1
+    TravelBalance.objects.bulk_update(balances.values(), ['amount', 'version'])
+    TravelBalance.objects.bulk_create([TravelBalance(travel_id=travel_id, user_id=user_id, amount=delta, version=1)
+                                       for user_id, delta in deltas.items() if user_id not in balances])
+
+
+@transaction.atomic
+def record_payment(payment, debitors):
+    base, payment.version = lock_travel(payment.travel_id)
+    factor = payment_factor(payment, base)
+    payment.save()
+    debts = debts_for_payment(payment, [debitor.id for debitor in debitors])
+    Debt.objects.bulk_create(debts)
+    apply_deltas(payment.travel_id, balance_deltas(debts, payment.payer_id, factor))
+    return debts
+
+
+def insert_rows(model, fields, rows):
+    # executemany без создания экземпляров моделей: на сотнях тысяч строк это основная экономия
+    if not rows:
+        return
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(model._meta.get_field(field).column) for field in fields)
+    placeholders = ', '.join(['%s'] * len(fields))
+    with connection.cursor() as cursor:
+        cursor.executemany(f'INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES ({placeholders})', rows)
+
+
+@transaction.atomic
+def bulk_record_payments(travel_id, batches):
+    """
+    Массовая запись платежей: batches - итерируемые пачки PaymentRow.
+    Путешествие блокируется на время записи, балансы обновляются один раз в конце.
+    """
+    base, version = lock_travel(travel_id)
+    last_id = Payment.objects.filter(travel_id=travel_id).aggregate(last_id=Max('id'))['last_id'] or 0
+    adapt_value = connection.ops.adapt_decimalfield_value
+
+    deltas = {}
+    created = 0
+    for batch in batches:
+        if not batch:
+            continue
+        factors = fx.require_factors({(row.currency, row.date) for row in batch}, base)
+        insert_rows(Payment, ['title', 'value', 'payer', 'travel', 'currency', 'date', 'version', 'client_key'],
+                    [(row.title, adapt_value(row.value, 9, 2), row.payer_id, travel_id, row.currency, row.date,
+                      version, row.client_key) for row in batch])
+        # id из executemany не возвращаются: дочитываем их по порядку, путешествие заблокировано
+        ids = list(Payment.objects.filter(travel_id=travel_id, id__gt=last_id).order_by('id')
+                   .values_list('id', flat=True)[:len(batch) + 1])
+        if len(ids) != len(batch):
+            raise DatabaseError('Не удалось сопоставить id созданных платежей')
+        last_id = ids[-1]
+
+        debts = []
+        for payment_id, row in zip(ids, batch):
+            debitor_ids = [debitor_id for debitor_id in row.debitor_ids if debitor_id != row.payer_id]
+            if not debitor_ids:
+                continue
+            share = split_value(row.value, len(debitor_ids))
+            debts.append((payment_id, row.payer_id, adapt_value(0 - share, 9, 2), travel_id, row.payer_id))
+            debts.extend((payment_id, debitor_id, adapt_value(share, 9, 2), travel_id, row.payer_id)
+                         for debitor_id in debitor_ids)
+            share = fx.convert(share, row.currency, row.date, base, factors)
+            deltas[row.payer_id] = deltas.get(row.payer_id, 0) + share * len(debitor_ids)
+            for debitor_id in debitor_ids:
+                deltas[debitor_id] = deltas.get(debitor_id, 0) - share
+        insert_rows(Debt, ['source', 'debitor', 'value', 'travel', 'payer'], debts)
+        created += len(batch)
+
+    apply_deltas(travel_id, deltas)
+    return created
+
+
+@transaction.atomic
+def update_payment(payment, debitors):
+    """
+    Сохраняет измененный платеж. Строки Debt не пересоздаются: старые и новые доли сравниваются
+    по должнику, и выполняются только нужные вставки, обновления и удаления.
+    Балансы меняются на разницу между старым и новым вкладом платежа.
+    """
+    base, payment.version = lock_travel(payment.travel_id)
+    old = Payment.objects.filter(pk=payment.pk).values('payer_id', 'currency', 'date').get()
+    existing = {debt.debitor_id: debt for debt in Debt.objects.filter(source_id=payment.pk)}
+
+    deltas = {user_id: -delta for user_id, delta in
+              balance_deltas(existing.values(), old['payer_id'], payment_factor(Payment(**old), base)).items()}
+    payment.save()
+
+    wanted = {debt.debitor_id: debt for debt in debts_for_payment(payment, [debitor.id for debitor in debitors])}
+    changed = []
+    for debitor_id, debt in wanted.items():
+        current = existing.get(debitor_id)
+        if current is not None and (current.value != debt.value or current.payer_id != debt.payer_id):
+            current.value, current.payer_id, current.travel_id = debt.value, debt.payer_id, debt.travel_id
+            changed.append(current)
+    Debt.objects.bulk_update(changed, ['value', 'payer', 'travel'])
+    Debt.objects.filter(pk__in=[debt.pk for debitor_id, debt in existing.items() if debitor_id not in wanted]).delete()
+    Debt.objects.bulk_create([debt for debitor_id, debt in wanted.items() if debitor_id not in existing])
+
+    for user_id, delta in balance_deltas(wanted.values(), payment.payer_id, payment_factor(payment, base)).items():
+        deltas[user_id] = deltas.get(user_id, 0) + delta
+    apply_deltas(payment.travel_id, deltas)
+    return list(wanted.values())
+
+
+@transaction.atomic
+def delete_payment(payment):
+    base, version = lock_travel(payment.travel_id)
+    deltas = balance_deltas(payment.debt_set.all(), payment.payer_id, payment_factor(payment, base))
+    apply_deltas(payment.travel_id, {user_id: -delta for user_id, delta in deltas.items()})
+    PaymentTombstone.objects.create(travel_id=payment.travel_id, payment_id=payment.id, version=version)
+    payment.delete()
+
+
+def get_balances(travel_id):
+    return dict(TravelBalance.objects.filter(travel_id=travel_id).values_list('user_id', 'amount'))
+
+
+def compute_balances(travel_ids=None):
+    """
+    Эталонный расчет по сырым строкам Debt: {travel_id: {user_id: amount}}.
+    Группируем по сумме доли, чтобы пересчитать валюту так же, как при записи - по каждой доле.
+    """
+    debts = Debt.objects.exclude(debitor_id=F('payer_id'))
+    if travel_ids is not None:
+        debts = debts.filter(travel_id__in=travel_ids)
+    rows = list(debts
+                .values('value', 'travel_id', 'payer_id',
+                        base=F('travel__currency'),
+                        user_id=F('debitor_id'),
+                        currency=F('source__currency'),
+                        date=F('source__date'))
+                .annotate(count=Count('id'))
+                .order_by())
+
+    factors = {}
+    for base in {row['base'] for row in rows}:
+        factors[base] = fx.require_factors({(row['currency'], row['date']) for row in rows if row['base'] == base},
+                                           base)
+
+    balances = {}
+    for row in rows:
+        total = fx.convert(row['value'], row['currency'], row['date'], row['base'], factors[row['base']]) * row['count']
+        travel = balances.setdefault(row['travel_id'], {})
+        travel[row['user_id']] = travel.get(row['user_id'], 0) - total
+        travel[row['payer_id']] = travel.get(row['payer_id'], 0) + total
+    return balances
+
+
+def find_drift(travel_ids=None):
+    expected = compute_balances(travel_ids)
+    # У архивных путешествий строк Debt нет, их балансы заморожены вместе со снимком
+    stored = TravelBalance.objects.exclude(travel__archived=True)
+    if travel_ids is not None:
+        stored = stored.filter(travel_id__in=travel_ids)
+
+    drift = []
+    for travel_id, user_id, amount in stored.values_list('travel_id', 'user_id', 'amount'):
+        expected_amount = expected.get(travel_id, {}).pop(user_id, 0)
+        if amount != expected_amount:
+            drift.append((travel_id, user_id, amount, expected_amount))
+    for travel_id, users in expected.items():
+        drift.extend((travel_id, user_id, 0, amount) for user_id, amount in users.items() if amount)
+    return drift
+
+
+@transaction.atomic
+def rebuild_balances(travel_ids=None):
+    stored = TravelBalance.objects.exclude(travel__archived=True)
+    if travel_ids is not None:
+        stored = stored.filter(travel_id__in=travel_ids)
+    stored.delete()
+
+    TravelBalance.objects.bulk_create([
+        TravelBalance(travel_id=travel_id, user_id=user_id, amount=amount, version=1)
+        for travel_id, users in compute_balances(travel_ids).items()
+        for user_id, amount in users.items()], batch_size=1000)
+
+    travels = Travel.objects.all()
+    if travel_ids is not None:
+        travels = travels.filter(pk__in=travel_ids)
+    travels.update(version=F('version') + 1, modified=timezone.now())
+    for travel_id in travel_ids or ():
+        transaction.on_commit(lambda travel_id=travel_id: events.publish(travel_id))
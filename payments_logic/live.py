@@ -0,0 +1,134 @@
+import asyncio
+import json
+import re
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+
+import payments_logic.ledger as ledger
+import payments_logic.sync as sync
+from . import events
+from .models import Travel
+
+PATH = re.compile(r'^/travel_detail/(?P<pk>\d+)/events$')
+HEARTBEAT = 15
+
+
+class SessionRequest:
+    # auth.get_user нужна только сессия, полноценный HttpRequest не собираем
+    def __init__(self, session):
+        self.session = session
+
+
+def load_user(headers):
+    cookie = SimpleCookie()
+    cookie.load(headers.get(b'cookie', b'').decode('latin-1'))
+    morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+    if morsel is None:
+        return None
+    session = import_module(settings.SESSION_ENGINE).SessionStore(morsel.value)
+    user = auth.get_user(SessionRequest(session))
+    return user if user.is_authenticated else None
+
+
+def load_travel(pk, user):
+    return Travel.objects.filter(pk=pk, travelers=user).first()
+
+
+def changes(travel_id, cursor):
+    travel = Travel.objects.get(pk=travel_id)
+    data = sync.pull(travel, cursor)
+    data['balances'] = {str(user_id): amount for user_id, amount in ledger.get_balances(travel_id).items()}
+    return data
+
+
+def format_event(name, data, event_id=None):
+    lines = [f'event: {name}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append('data: ' + json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':'), ensure_ascii=False))
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+async def respond(send, status, body=b''):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def stream(scope, receive, send):
+    """
+    Server-sent events по путешествию: при каждой записи клиенту уходят новые платежи,
+    id удаленных и текущие балансы. Курсор синхронизации служит id события,
+    поэтому после обрыва браузер продолжает с Last-Event-ID без потерь.
+    """
+    headers = dict(scope['headers'])
+    user = await sync_to_async(load_user)(headers)
+    if user is None:
+        return await respond(send, 401)
+    travel_id = int(PATH.match(scope['path'])['pk'])
+    travel = await sync_to_async(load_travel)(travel_id, user)
+    if travel is None:
+        return await respond(send, 404)
+
+    # Страница передает версию, с которой отрисована, чтобы не потерять записи до подключения
+    query = parse_qs(scope.get('query_string', b'').decode())
+    cursor = headers.get(b'last-event-id', b'').decode() or query.get('cursor', [''])[0]
+    try:
+        sync.parse_cursor(cursor)
+    except sync.SyncError:
+        cursor = ''
+    cursor = cursor or str(travel.version)
+    broker = events.get_broker()
+    subscription = broker.subscribe(travel_id)
+    queue = subscription[1]
+
+    async def wait_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    disconnect = asyncio.ensure_future(wait_disconnect())
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        # Изменения, случившиеся между загрузкой страницы и подключением, отдаем сразу
+        events.LocalBroker.notify(queue)
+        while not disconnect.done():
+            waiter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({waiter, disconnect}, timeout=HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if waiter not in done:
+                waiter.cancel()
+                if not disconnect.done():
+                    await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                continue
+
+            more = True
+            while more:
+                data = await sync_to_async(changes)(travel_id, cursor)
+                more = data['more']
+                if data['payments'] or data['deleted'] or data['cursor'] != cursor:
+                    cursor = data['cursor']
+                    await send({'type': 'http.response.body', 'body': format_event('ledger', data, cursor),
+                                'more_body': True})
+    finally:
+        disconnect.cancel()
+        broker.unsubscribe(travel_id, subscription)
+        await sync_to_async(close_old_connections)()
+
+
+def with_events(application):
+    # Долгие соединения обслуживаем до Django: в 3.2 потоковый ответ под ASGI отдается синхронно
+    async def router(scope, receive, send):
+        if scope['type'] == 'http' and PATH.match(scope['path']):
+            return await stream(scope, receive, send)
+        return await application(scope, receive, send)
+    return router
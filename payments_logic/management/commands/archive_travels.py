@@ -0,0 +1,38 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+import payments_logic.archive as archive
+from payments_logic.models import Travel
+
+
+class Command(BaseCommand):
+    help = ('Переносит платежи и доли завершенных путешествий в сжатые снимки TravelArchive '
+            'и удаляет их строки из Payment и Debt')
+
+    def add_arguments(self, parser):
+        parser.add_argument('travel_ids', nargs='*', type=int)
+        parser.add_argument('--ended-days-ago', type=int, default=None,
+                            help='Все путешествия, закончившиеся больше N дней назад')
+
+    def handle(self, *args, **options):
+        if not options['travel_ids'] and options['ended_days_ago'] is None:
+            raise CommandError('Укажите id путешествий или --ended-days-ago')
+        travels = Travel.objects.filter(archived=False)
+        if options['travel_ids']:
+            travels = travels.filter(pk__in=options['travel_ids'])
+        if options['ended_days_ago'] is not None:
+            travels = travels.filter(end_date__lt=datetime.date.today() - datetime.timedelta(options['ended_days_ago']))
+
+        archived = failed = 0
+        # Каждое путешествие - своя короткая транзакция
+        for travel_id in travels.order_by('id').values_list('id', flat=True):
+            try:
+                count = archive.archive_travel(travel_id)
+            except archive.ArchiveError as error:
+                self.stderr.write(str(error))
+                failed += 1
+                continue
+            archived += 1
+            self.stdout.write(f'Путешествие {travel_id}: в архиве {count} платежей')
+        self.stdout.write(self.style.SUCCESS(f'Архивировано путешествий: {archived}, пропущено: {failed}'))
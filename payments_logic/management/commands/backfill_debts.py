@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from payments_logic.models import Debt, Payment
+
+
+class Command(BaseCommand):
+    help = 'Заполняет Debt.travel и Debt.payer у строк, записанных до появления этих полей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        source = Payment.objects.filter(pk=OuterRef('source_id'))
+        total = 0
+        # Короткие транзакции по диапазонам id, чтобы не держать блокировки на всю таблицу
+        while True:
+            with transaction.atomic():
+                ids = list(Debt.objects.filter(travel__isnull=True).order_by('id')
+                           .values_list('id', flat=True)[:options['batch_size']])
+                if not ids:
+                    break
+                total += Debt.objects.filter(pk__in=ids).update(
+                    travel_id=Subquery(source.values('travel_id')[:1]),
+                    payer_id=Subquery(source.values('payer_id')[:1]))
+            self.stdout.write(f'Заполнено строк: {total}')
+        self.stdout.write(self.style.SUCCESS(f'Готово, заполнено строк: {total}'))
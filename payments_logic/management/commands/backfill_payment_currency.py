@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import payments_logic.ledger as ledger
+from payments_logic.models import Payment, Travel
+
+
+class Command(BaseCommand):
+    help = ('Переводит платежи, записанные до появления Payment.currency, в валюту их путешествия: '
+            'при добавлении поля все они получили RUR')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-id', type=int, default=None,
+                            help='id последнего платежа, записанного до обновления; '
+                                 'более поздние платежи в RUR остаются как есть')
+
+    def handle(self, *args, **options):
+        payments = Payment.objects.filter(currency=Travel.RUR).exclude(travel__currency=Travel.RUR)
+        if options['max_id'] is not None:
+            payments = payments.filter(id__lte=options['max_id'])
+        travel_ids = list(payments.order_by('travel_id').values_list('travel_id', flat=True).distinct())
+
+        total = 0
+        # По транзакции на путешествие: версия поднимается, чтобы кэш страниц и клиенты синхронизации
+        # получили исправленные платежи
+        for travel_id in travel_ids:
+            with transaction.atomic():
+                currency, version = ledger.lock_travel(travel_id)
+                total += payments.filter(travel_id=travel_id).update(currency=currency, version=version)
+        self.stdout.write(self.style.SUCCESS(f'Готово, исправлено платежей: {total} в путешествиях: {len(travel_ids)}'))
@@ -0,0 +1,157 @@
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import (CaptureQueriesContext, setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+from django.urls import reverse
+
+import payments_logic.cache as travel_cache
+from payments_logic.models import Payment, Travel
+from payments_logic.synthetic import seed
+
+
+class Command(BaseCommand):
+    help = ('Замеряет основные страницы через тестовый клиент на синтетических данных во временной базе: '
+            'p50/p95 задержки, число запросов, пик памяти и размер ответа после сжатия')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000],
+                            help='Число платежей в поездке')
+        parser.add_argument('--travels', type=int, default=20)
+        parser.add_argument('--travelers', type=int, default=6)
+        parser.add_argument('--iterations', type=int, default=30)
+        parser.add_argument('--warm-cache', action='store_true',
+                            help='Не сбрасывать кэш путешествий между запросами')
+        parser.add_argument('--output', help='Сохранить результаты в JSON')
+        parser.add_argument('--compare', help='JSON предыдущего прогона для поиска регрессий')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Доля ухудшения p50, считающаяся регрессией')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        results = {}
+        try:
+            for size in options['sizes']:
+                results[str(size)] = self.run_size(size, options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'database': settings.DATABASES['default']['ENGINE'],
+                  'iterations': options['iterations'],
+                  'warm_cache': options['warm_cache'],
+                  'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, ensure_ascii=False)
+            self.stdout.write(f'Результаты сохранены в {options["output"]}')
+        if options['compare']:
+            with open(options['compare']) as previous:
+                self.compare(json.load(previous), report, options['threshold'])
+
+    def run_size(self, size, options):
+        Travel.objects.all().delete()
+        prefix = f'bench{size}_'
+        people, travels = seed(users=options['travelers'] * 3, travels=options['travels'],
+                               travelers_per_travel=options['travelers'], payments_per_travel=size,
+                               prefix=prefix, rnd=random.Random(size))
+        user = people[0]
+        travel = travels[0]
+        travelers = list(travel.travelers.values_list('id', flat=True))
+        rnd = random.Random(size)
+
+        # Размер ответа считаем так, как его получит браузер со сжатием
+        client = Client(HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        client.force_login(user)
+
+        cases = {
+            'TravelsList': lambda: client.get(reverse('travels_list'), secure=True),
+            'TravelDetail': lambda: client.get(reverse('travel_detail', args=[travel.id]), secure=True),
+            'SummaryPaymentsAndDebts': lambda: client.get(reverse('summaries', args=[travel.id]), secure=True),
+            'AddPayment': lambda: client.post(reverse('new_payment', args=[travel.id]),
+                                              {'title': 'Бенчмарк',
+                                               'value': '100.00',
+                                               'payer': rnd.choice(travelers),
+                                               'debitors': rnd.sample(travelers, 3)},
+                                              secure=True),
+            'CreateTravel': lambda: client.post(reverse('new_travel'),
+                                                {'title': 'Бенчмарк',
+                                                 'start_date': '2021-01-01',
+                                                 'end_date': '2021-01-10',
+                                                 'currency': Travel.RUR,
+                                                 'travelers': [user.username]},
+                                                secure=True),
+        }
+
+        self.stdout.write(f'{size} платежей в поездке ({Payment.objects.filter(travel=travel).count()} в замеряемой):')
+        results = {}
+        for name, request in cases.items():
+            results[name] = self.measure(request, options)
+            row = results[name]
+            self.stdout.write(f'  {name:<24} p50 {row["p50_ms"]:8.2f} ms  p95 {row["p95_ms"]:8.2f} ms  '
+                              f'{row["queries"]:4} запросов  пик {row["peak_kib"]:8.1f} KiB  '
+                              f'ответ {row["bytes"]:7} байт')
+        return results
+
+    def measure(self, request, options):
+        timings = []
+        queries = []
+        sizes = []
+        for _ in range(options['iterations']):
+            if not options['warm_cache']:
+                travel_cache.get_cache().clear()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = request()
+                timings.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                raise RuntimeError(f'Запрос завершился со статусом {response.status_code}')
+            queries.append(len(captured))
+            sizes.append(len(response.content))
+
+        # Память меряем отдельным прогоном: tracemalloc заметно искажает время
+        if not options['warm_cache']:
+            travel_cache.get_cache().clear()
+        tracemalloc.start()
+        try:
+            request()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        timings.sort()
+        return {'p50_ms': round(statistics.median(timings), 3),
+                'p95_ms': round(timings[max(0, int(len(timings) * 0.95) - 1)], 3),
+                'queries': max(queries),
+                'peak_kib': round(peak / 1024, 1),
+                'bytes': max(sizes)}
+
+    def compare(self, previous, current, threshold):
+        regressions = 0
+        for size, views in current['results'].items():
+            for name, row in views.items():
+                old = previous.get('results', {}).get(size, {}).get(name)
+                if not old:
+                    continue
+                change = (row['p50_ms'] - old['p50_ms']) / old['p50_ms'] if old['p50_ms'] else 0
+                marks = []
+                if change > threshold:
+                    marks.append(f'p50 +{change:.0%}')
+                if row['queries'] > old['queries']:
+                    marks.append(f'запросов {old["queries"]} -> {row["queries"]}')
+                if old.get('bytes') and (row['bytes'] - old['bytes']) / old['bytes'] > threshold:
+                    marks.append(f'ответ {old["bytes"]} -> {row["bytes"]} байт')
+                if marks:
+                    regressions += 1
+                    self.stdout.write(self.style.WARNING(f'Регрессия {size}/{name}: {", ".join(marks)}'))
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS('Регрессий не найдено'))
@@ -0,0 +1,58 @@
+import random
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases
+
+import payments_logic.service_functions as sf
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает get_summary и settle на синтетических данных во временной тестовой базе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000])
+        parser.add_argument('--pairs-per-traveler', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            for size in options['sizes']:
+                self.run_size(size, options['pairs_per_traveler'], random.Random(options['seed']))
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run_size(self, size, pairs_per_traveler, rnd):
+        User.objects.all().delete()
+        users = User.objects.bulk_create(
+            [User(username=f'bench{i}', first_name='Bench', last_name=str(i)) for i in range(size)])
+        if not users[0].pk:
+            users = list(User.objects.order_by('id'))
+
+        rows = {}
+        for debitor in users:
+            for payer in rnd.sample(users, min(pairs_per_traveler, size)):
+                if payer is not debitor:
+                    rows[(debitor, payer)] = Decimal(rnd.randint(1, 100000)) / 100
+
+        old_rows = [{'debitor__username': debitor.username,
+                     'source__payer__username': payer.username,
+                     'total': total} for (debitor, payer), total in rows.items()]
+        new_rows = [{'debitor_id': debitor.id, 'payer_id': payer.id, 'total': total}
+                    for (debitor, payer), total in rows.items()]
+
+        self.stdout.write(f'{size} путешественников, {len(rows)} строк:')
+        self.measure('get_summary', sf.get_summary, old_rows)
+        self.measure('settle', sf.settle, new_rows)
+        self.measure('settle(simplify)', lambda data: sf.settle(data, simplify=True), new_rows)
+
+    def measure(self, name, func, data):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            result = func(data)
+            elapsed = time.perf_counter() - start
+        self.stdout.write(f'  {name:<18} {elapsed * 1000:10.1f} ms  {len(queries):6} запросов  {len(result):6} переводов')
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from payments_logic.models import Friendship
+
+
+class Command(BaseCommand):
+    help = 'Удаляет повторяющиеся Friendship (оставляет самую раннюю запись) перед включением ограничения уникальности'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            duplicates = (Friendship.objects
+                          .values('creator_id', 'friend_id')
+                          .annotate(keep_id=Min('id'), count=Count('id'))
+                          .filter(count__gt=1)
+                          .order_by())
+            deleted = 0
+            for row in duplicates:
+                deleted += (Friendship.objects
+                            .filter(creator_id=row['creator_id'], friend_id=row['friend_id'])
+                            .exclude(pk=row['keep_id'])
+                            .delete())[0]
+        self.stdout.write(self.style.SUCCESS(f'Удалено повторов: {deleted}'))
@@ -0,0 +1,29 @@
+import os
+
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand
+
+from payments_logic.storage import is_hashed
+
+
+class Command(BaseCommand):
+    help = ('Создает копии файлов STATIC_ROOT с хэшем содержимого в имени и манифест staticfiles.json. '
+            'Исходники лежат прямо в STATIC_ROOT, поэтому collectstatic не подходит')
+
+    def handle(self, *args, **options):
+        paths = {}
+        for root, _, files in os.walk(staticfiles_storage.location):
+            for filename in files:
+                path = os.path.relpath(os.path.join(root, filename), staticfiles_storage.location).replace(os.sep, '/')
+                if path != staticfiles_storage.manifest_name and not is_hashed(path):
+                    paths[path] = (staticfiles_storage, path)
+
+        # post_process проходит CSS несколько раз, пока не подставит хэши во все ссылки
+        processed = {}
+        for original, hashed, _ in staticfiles_storage.post_process(paths):
+            if isinstance(hashed, Exception):
+                raise hashed
+            processed[original] = hashed
+        for original, hashed in sorted(processed.items()):
+            self.stdout.write(f'{original} -> {hashed}')
+        self.stdout.write(self.style.SUCCESS(f'Обработано файлов: {len(processed)}'))
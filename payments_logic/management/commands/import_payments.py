@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import payments_logic.importer as importer
+from payments_logic.models import Travel
+
+
+class Command(BaseCommand):
+    help = 'Импортирует платежи путешествия из CSV или JSON/NDJSON файла'
+
+    def add_arguments(self, parser):
+        parser.add_argument('travel_id', type=int)
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'json'], default=None,
+                            help='По умолчанию определяется по расширению файла')
+        parser.add_argument('--batch-size', type=int, default=importer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            travel = Travel.objects.get(pk=options['travel_id'])
+        except Travel.DoesNotExist:
+            raise CommandError(f'Путешествие {options["travel_id"]} не найдено')
+        if travel.archived:
+            raise CommandError(f'Путешествие {travel.id} в архиве, сначала manage.py restore_travels {travel.id}')
+
+        path = options['path']
+        fmt = options['format'] or ('json' if path.endswith(('.json', '.ndjson', '.jsonl')) else 'csv')
+        with open(path, encoding='utf-8-sig', newline='') as stream:
+            result = importer.import_payments(travel, stream, fmt, batch_size=options['batch_size'])
+
+        for line, message in result.errors:
+            self.stderr.write(f'Строка {line}: {message}' if line else message)
+        self.stdout.write(self.style.SUCCESS(f'Добавлено оплат: {result.created}, пропущено строк: {result.failed}'))
@@ -0,0 +1,85 @@
+import csv
+import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+import payments_logic.events as events
+import payments_logic.fx as fx
+from payments_logic.models import ExchangeRate, Payment, Travel
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('Загружает курсы валют из CSV с колонками date, currency, rate '
+            '(сколько единиц опорной валюты стоит единица currency)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+
+    def handle(self, *args, **options):
+        currencies = {code for code, _ in Travel.CURRENCIES}
+        loaded = 0
+        loaded_currencies, dates = set(), set()
+        with open(options['path'], encoding='utf-8-sig', newline='') as stream, transaction.atomic():
+            batch = []
+            for line, row in enumerate(csv.DictReader(stream), start=2):
+                try:
+                    rate = ExchangeRate(currency=row['currency'].strip().upper(),
+                                        date=datetime.date.fromisoformat(row['date'].strip()),
+                                        rate=Decimal(row['rate'].strip().replace(',', '.')))
+                except (KeyError, AttributeError, ValueError, InvalidOperation):
+                    raise CommandError(f'Строка {line}: ожидаются колонки date (ГГГГ-ММ-ДД), currency, rate')
+                if rate.currency not in currencies or rate.rate <= 0:
+                    raise CommandError(f'Строка {line}: некорректная валюта или курс')
+                batch.append(rate)
+                loaded_currencies.add(rate.currency)
+                dates.add(rate.date)
+                if len(batch) >= BATCH_SIZE:
+                    loaded += self.save(batch)
+                    batch = []
+            loaded += self.save(batch)
+            touched = self.touch_travels(loaded_currencies, dates) if dates else 0
+
+        fx.clear_cache()
+        self.stdout.write(self.style.SUCCESS(f'Загружено курсов: {loaded}, обновлено путешествий: {touched}'))
+        self.stdout.write('Если менялись курсы прошлых дат, пересоберите балансы: manage.py rebuild_balances')
+
+    @staticmethod
+    def touch_travels(currencies, dates):
+        """
+        Поднимает версию путешествий, чьи суммы пересчитываются по загруженным курсам:
+        кэш страниц и ETag привязаны к версии и иначе показывали бы старый пересчет.
+        Курс действует еще FX_LOOKBACK_DAYS после своей даты, архивные путешествия берутся по датам поездки.
+        """
+        first = min(dates)
+        last = max(dates) + datetime.timedelta(days=getattr(settings, 'FX_LOOKBACK_DAYS', 14))
+        payments = (Payment.objects
+                    .filter(date__range=(first, last))
+                    .filter(Q(currency__in=currencies) | Q(travel__currency__in=currencies)))
+        travels = Travel.objects.filter(Q(pk__in=payments.values('travel_id')) |
+                                        Q(archived=True, start_date__lte=last, end_date__gte=first))
+        travel_ids = list(travels.values_list('id', flat=True))
+        Travel.objects.filter(pk__in=travel_ids).update(version=F('version') + 1, modified=timezone.now())
+        for travel_id in travel_ids:
+            transaction.on_commit(lambda travel_id=travel_id: events.publish(travel_id))
+        return len(travel_ids)
+
+    @staticmethod
+    def save(batch):
+        if not batch:
+            return 0
+        # Повторная загрузка тех же дат заменяет курсы. Удаляем по валюте списком дат:
+        # OR из тысячи условий SQLite не разбирает ("Expression tree is too large")
+        dates = {}
+        for rate in batch:
+            dates.setdefault(rate.currency, set()).add(rate.date)
+        for currency, currency_dates in dates.items():
+            ExchangeRate.objects.filter(currency=currency, date__in=currency_dates).delete()
+        ExchangeRate.objects.bulk_create(batch)
+        return len(batch)
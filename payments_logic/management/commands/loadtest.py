@@ -0,0 +1,224 @@
+import io
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test import Client
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+
+from payments_logic.synthetic import seed
+
+OPERATIONS = ('list', 'detail', 'add', 'summary')
+LOCK_MESSAGES = ('locked', 'lock wait timeout', 'deadlock')
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class DbTimer:
+    # Время в БД отдельно для записей: ожидание блокировок проявляется именно там
+    def __init__(self):
+        self.db_time = 0.0
+        self.write_time = 0.0
+        self.lock_errors = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as error:
+            if any(message in str(error).lower() for message in LOCK_MESSAGES):
+                self.lock_errors += 1
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.db_time += duration
+            if sql.lstrip()[:6].upper() in WRITE_PREFIXES or 'FOR UPDATE' in sql.upper():
+                self.write_time += duration
+
+
+def wsgi_request(application, method, url, cookies, data=None, scheme='http'):
+    parts = urlsplit(url)
+    body = urlencode(data, doseq=True).encode() if data else b''
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': parts.path,
+        'QUERY_STRING': parts.query,
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '443' if scheme == 'https' else '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'testserver',
+        'HTTP_COOKIE': '; '.join(f'{name}={value}' for name, value in cookies.items()),
+        'HTTP_REFERER': f'{scheme}://testserver/',
+        'HTTP_ACCEPT_ENCODING': 'gzip',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.url_scheme': scheme,
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    status = []
+    result = application(environ, lambda response_status, headers, exc_info=None: status.append(response_status))
+    try:
+        for _ in result:
+            pass
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return int(status[0].split()[0])
+
+
+def run_plan(plan, cookies, scheme):
+    """
+    Выполняет свою часть сценария в текущем потоке или процессе.
+    Возвращает (операция, статус, длительность, время в БД, время записей, ошибки блокировок).
+    """
+    from travel_payments_web.wsgi import application
+
+    timer = DbTimer()
+    results = []
+    try:
+        with connection.execute_wrapper(timer):
+            for operation, user_id, travel_id, debitors in plan:
+                user_cookies = cookies[user_id]
+                db_time, write_time, lock_errors = timer.db_time, timer.write_time, timer.lock_errors
+                start = time.perf_counter()
+                if operation == 'list':
+                    status = wsgi_request(application, 'GET', reverse('travels_list'), user_cookies, scheme=scheme)
+                elif operation == 'detail':
+                    status = wsgi_request(application, 'GET', reverse('travel_detail', args=[travel_id]),
+                                          user_cookies, scheme=scheme)
+                elif operation == 'summary':
+                    status = wsgi_request(application, 'GET', reverse('summaries', args=[travel_id]),
+                                          user_cookies, scheme=scheme)
+                else:
+                    status = wsgi_request(application, 'POST', reverse('new_payment', args=[travel_id]), user_cookies,
+                                          {'title': 'Нагрузка',
+                                           'value': '100.00',
+                                           'payer': user_id,
+                                           'debitors': debitors,
+                                           'csrfmiddlewaretoken': user_cookies[settings.CSRF_COOKIE_NAME]},
+                                          scheme=scheme)
+                results.append((operation, status, time.perf_counter() - start, timer.db_time - db_time,
+                                timer.write_time - write_time, timer.lock_errors - lock_errors))
+    finally:
+        connections.close_all()
+    return results
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный прогон всего WSGI-стека в процессе: смешанный сценарий (список, путешествие, '
+            'новый платеж, итоги) на синтетических данных во временной базе, пул потоков или процессов')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--mode', choices=['thread', 'process'], default='thread')
+        parser.add_argument('--requests', type=int, default=400, help='Всего запросов на все воркеры')
+        parser.add_argument('--mix', default='list=3,detail=3,add=2,summary=2',
+                            help='Веса операций: list, detail, add, summary')
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--travels', type=int, default=3,
+                            help='Мало путешествий - много одновременных записей в одно и то же')
+        parser.add_argument('--travelers', type=int, default=6)
+        parser.add_argument('--payments', type=int, default=200, help='Платежей в каждом путешествии заранее')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        weights = self.parse_mix(options['mix'])
+        setup_test_environment()
+        database = settings.DATABASES['default']
+        temp_dir = None
+        if database['ENGINE'].endswith('sqlite3'):
+            # Общая in-memory база SQLite не видна другим процессам и блокирует целые таблицы:
+            # берем временный файл, как у настоящей DEBUG-базы
+            temp_dir = tempfile.TemporaryDirectory()
+            database.setdefault('TEST', {})['NAME'] = os.path.join(temp_dir.name, 'loadtest.sqlite3')
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.run(options, weights)
+        finally:
+            connections.close_all()
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+            if temp_dir is not None:
+                temp_dir.cleanup()
+
+    def parse_mix(self, mix):
+        weights = {}
+        for item in mix.split(','):
+            name, _, weight = item.partition('=')
+            if name.strip() not in OPERATIONS:
+                raise CommandError(f'Неизвестная операция {name!r}, допустимы: {", ".join(OPERATIONS)}')
+            weights[name.strip()] = float(weight or 1)
+        return weights
+
+    def run(self, options, weights):
+        rnd = random.Random(options['seed'])
+        people, travels = seed(users=options['users'], travels=options['travels'],
+                               travelers_per_travel=options['travelers'],
+                               payments_per_travel=options['payments'], prefix='load', rnd=rnd)
+        travelers = {travel.id: list(travel.travelers.values_list('id', flat=True)) for travel in travels}
+
+        cookies = {}
+        for user_id in {user_id for ids in travelers.values() for user_id in ids}:
+            client = Client()
+            client.force_login(next(person for person in people if person.id == user_id))
+            cookies[user_id] = {settings.SESSION_COOKIE_NAME: client.cookies[settings.SESSION_COOKIE_NAME].value,
+                                settings.CSRF_COOKIE_NAME: get_random_string(32)}
+
+        plan = []
+        operations, operation_weights = zip(*weights.items())
+        for _ in range(options['requests']):
+            travel_id = rnd.choice(list(travelers))
+            user_id = rnd.choice(travelers[travel_id])
+            debitors = rnd.sample(travelers[travel_id], min(3, len(travelers[travel_id])))
+            plan.append((rnd.choices(operations, operation_weights)[0], user_id, travel_id, debitors))
+        chunks = [plan[i::options['workers']] for i in range(options['workers'])]
+        scheme = 'https' if settings.SECURE_SSL_REDIRECT else 'http'
+
+        # Соединения не должны достаться дочерним процессам и потокам от родителя
+        connections.close_all()
+        start = time.perf_counter()
+        if options['mode'] == 'process':
+            with multiprocessing.get_context('fork').Pool(options['workers']) as pool:
+                parts = pool.starmap(run_plan, [(chunk, cookies, scheme) for chunk in chunks])
+        else:
+            with ThreadPoolExecutor(options['workers']) as pool:
+                parts = list(pool.map(run_plan, chunks, [cookies] * len(chunks), [scheme] * len(chunks)))
+        wall = time.perf_counter() - start
+
+        self.report([row for part in parts for row in part], wall, options)
+
+    def report(self, results, wall, options):
+        self.stdout.write(f'{len(results)} запросов, {options["workers"]} воркеров ({options["mode"]}), '
+                          f'{settings.DATABASES["default"]["ENGINE"].rsplit(".", 1)[-1]}: '
+                          f'{len(results) / wall:.1f} запросов/с за {wall:.2f} с')
+        for operation in OPERATIONS + ('all',):
+            rows = [row for row in results if operation in ('all', row[0])]
+            if not rows:
+                continue
+            timings = sorted(row[2] * 1000 for row in rows)
+            errors = sum(1 for row in rows if row[1] >= 400)
+            self.stdout.write(
+                f'  {operation:<8} {len(rows):5}  ошибок {errors / len(rows):6.1%}  '
+                f'p50 {statistics.median(timings):8.2f}  p95 {percentile(timings, 0.95):8.2f}  '
+                f'p99 {percentile(timings, 0.99):8.2f}  max {timings[-1]:8.2f} ms  '
+                f'БД {sum(row[3] for row in rows) * 1000:9.1f} ms, из них записи {sum(row[4] for row in rows) * 1000:9.1f} ms, '
+                f'блокировок {sum(row[5] for row in rows)}')
+
+
+def percentile(sorted_values, share):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * share))]
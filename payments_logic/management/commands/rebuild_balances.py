@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import payments_logic.ledger as ledger
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает таблицу TravelBalance из строк Debt и проверяет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('travel_ids', nargs='*', type=int, help='Путешествия для проверки (по умолчанию все)')
+        parser.add_argument('--check', action='store_true', help='Только найти расхождения, ничего не меняя')
+
+    def handle(self, *args, **options):
+        travel_ids = options['travel_ids'] or None
+
+        if not options['check']:
+            ledger.rebuild_balances(travel_ids)
+            self.stdout.write('Балансы пересобраны')
+
+        drift = ledger.find_drift(travel_ids)
+        for travel_id, user_id, stored, expected in drift:
+            self.stderr.write(f'Путешествие {travel_id}, пользователь {user_id}: '
+                              f'в таблице {stored}, по Debt {expected}')
+        if drift:
+            raise CommandError(f'Найдено расхождений: {len(drift)}')
+        self.stdout.write(self.style.SUCCESS('Расхождений нет'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+import payments_logic.search as search
+
+
+class Command(BaseCommand):
+    help = 'Пересоздает полнотекстовый индекс по названиям путешествий и платежей (FTS5 в SQLite, FULLTEXT в MySQL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        search.rebuild_index(options['database'])
+        self.stdout.write(self.style.SUCCESS('Индекс пересоздан'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import payments_logic.archive as archive
+
+
+class Command(BaseCommand):
+    help = 'Возвращает платежи и доли архивных путешествий из снимков в Payment и Debt'
+
+    def add_arguments(self, parser):
+        parser.add_argument('travel_ids', nargs='+', type=int)
+
+    def handle(self, *args, **options):
+        for travel_id in options['travel_ids']:
+            try:
+                count = archive.restore_travel(travel_id)
+            except archive.ArchiveError as error:
+                raise CommandError(str(error))
+            self.stdout.write(f'Путешествие {travel_id}: восстановлено {count} платежей')
+        self.stdout.write(self.style.SUCCESS('Готово'))
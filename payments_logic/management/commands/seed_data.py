@@ -0,0 +1,30 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from payments_logic.synthetic import seed
+
+
+class Command(BaseCommand):
+    help = 'Заполняет базу синтетическими пользователями, поездками и платежами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--friends-per-user', type=int, default=5)
+        parser.add_argument('--travels', type=int, default=10)
+        parser.add_argument('--travelers-per-travel', type=int, default=5)
+        parser.add_argument('--payments-per-travel', type=int, default=100)
+        parser.add_argument('--debitors-per-payment', type=int, default=3)
+        parser.add_argument('--prefix', default='seed', help='Префикс логинов создаваемых пользователей')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        people, travels = seed(users=options['users'],
+                               friends_per_user=options['friends_per_user'],
+                               travels=options['travels'],
+                               travelers_per_travel=options['travelers_per_travel'],
+                               payments_per_travel=options['payments_per_travel'],
+                               debitors_per_payment=options['debitors_per_payment'],
+                               prefix=options['prefix'],
+                               rnd=random.Random(options['seed']))
+        self.stdout.write(self.style.SUCCESS(f'Создано пользователей: {len(people)}, поездок: {len(travels)}'))
@@ -0,0 +1,106 @@
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576)
+
+OVERFLOW_VIEW = '__other__'
+
+
+class ViewStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.duration = 0.0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.queries = 0
+        self.query_counts = [0] * (len(QUERY_BUCKETS) + 1)
+        self.db_time = 0.0
+        self.sized = 0
+        self.size = 0
+        self.sizes = [0] * (len(SIZE_BUCKETS) + 1)
+
+    def add(self, duration, queries, db_time, error, size=None):
+        self.requests += 1
+        self.errors += error
+        self.duration += duration
+        self.latency[bisect_left(LATENCY_BUCKETS, duration)] += 1
+        self.queries += queries
+        self.query_counts[bisect_left(QUERY_BUCKETS, queries)] += 1
+        self.db_time += db_time
+        if size is not None:
+            self.sized += 1
+            self.size += size
+            self.sizes[bisect_left(SIZE_BUCKETS, size)] += 1
+
+
+class Registry:
+    """
+    Агрегаты по имени URL в памяти процесса. Число представлений ограничено max_views,
+    остальные попадают в OVERFLOW_VIEW, так что память не растет от случайных адресов.
+    """
+
+    def __init__(self, max_views=200):
+        self.max_views = max_views
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view, duration, queries, db_time, error=False, size=None):
+        with self.lock:
+            stats = self.views.get(view)
+            if stats is None:
+                if len(self.views) >= self.max_views:
+                    view = OVERFLOW_VIEW
+                stats = self.views.setdefault(view, ViewStats())
+            stats.add(duration, queries, db_time, error, size)
+
+    def reset(self):
+        with self.lock:
+            self.views.clear()
+
+    def render(self, extra=()):
+        lines = []
+        with self.lock:
+            views = sorted(self.views.items())
+            histogram(lines, 'http_request_duration_seconds', 'Request latency by URL name',
+                      views, LATENCY_BUCKETS, lambda stats: stats.latency, lambda stats: stats.duration)
+            histogram(lines, 'db_queries_per_request', 'Database queries per request by URL name',
+                      views, QUERY_BUCKETS, lambda stats: stats.query_counts, lambda stats: stats.queries)
+            histogram(lines, 'http_response_size_bytes', 'Response body size over the wire by URL name',
+                      views, SIZE_BUCKETS, lambda stats: stats.sizes, lambda stats: stats.size,
+                      lambda stats: stats.sized)
+            counter(lines, 'http_requests_total', 'Requests by URL name',
+                    views, lambda stats: stats.requests)
+            counter(lines, 'http_request_errors_total', 'Responses with status 5xx by URL name',
+                    views, lambda stats: stats.errors)
+            counter(lines, 'db_query_duration_seconds_total', 'Time spent in database queries by URL name',
+                    views, lambda stats: stats.db_time)
+        lines.extend(extra)
+        return '\n'.join(lines) + '\n'
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def histogram(lines, name, help_text, views, buckets, counts, total, observed=lambda stats: stats.requests):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for view, stats in views:
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf',), counts(stats)):
+            cumulative += count
+            lines.append(f'{name}_bucket{{view="{label(view)}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{view="{label(view)}"}} {total(stats)}')
+        lines.append(f'{name}_count{{view="{label(view)}"}} {observed(stats)}')
+
+
+def counter(lines, name, help_text, views, value):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} counter')
+    for view, stats in views:
+        lines.append(f'{name}{{view="{label(view)}"}} {value(stats)}')
+
+
+registry = Registry()
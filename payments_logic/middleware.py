@@ -0,0 +1,178 @@
+import cProfile
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from . import profiling, routers
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class InstrumentationMiddleware:
+    """
+    Задержка, число запросов к БД и время в БД для каждого запроса, агрегированные по имени URL.
+    Запросы сверх METRICS_QUERY_BUDGET пишутся в лог предупреждением - так ловятся N+1.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.query_budget = getattr(settings, 'METRICS_QUERY_BUDGET', 30)
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match and match.view_name else '<unresolved>'
+        # Размер тела после сжатия - то, что уходит по сети; у потоковых ответов он заранее неизвестен
+        size = None if response.streaming else len(response.content)
+        registry.record(view, duration, counter.count, counter.duration, error=response.status_code >= 500, size=size)
+
+        if counter.count > self.query_budget:
+            logger.warning('%s (%s) выполнил %d запросов к БД при бюджете %d',
+                           view, request.path, counter.count, self.query_budget)
+        return response
+
+
+def accepted_encodings(header):
+    encodings = set()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = params.strip().partition('q=')[2]
+        try:
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+class CompressionMiddleware:
+    """
+    Сжатие ответов больше COMPRESSION_MIN_SIZE байт: brotli, если модуль установлен и клиент его принимает,
+    иначе gzip. Потоковые ответы не трогаем: выгрузка сжимается сама по ?gzip=1.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_size = getattr(settings, 'COMPRESSION_MIN_SIZE', 512)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < self.min_size:
+            return response
+
+        encodings = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and 'br' in encodings:
+            encoding, content = 'br', brotli.compress(response.content, quality=5)
+        elif 'gzip' in encodings:
+            encoding, content = 'gzip', compress_string(response.content)
+        else:
+            return response
+        if len(content) >= len(response.content):
+            return response
+
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+        # Сжатое тело побайтно отличается от исходного: ETag становится слабым, как в GZipMiddleware
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+
+class ReplicaPinMiddleware:
+    """
+    Read-your-writes для чтений с реплики: если запрос что-то записал в основную базу
+    (любым методом, в том числе GET-обработчик входа через Google), пользователь на REPLICA_PIN_SECONDS
+    получает cookie, и его страницы читаются с основной базы, пока реплика догоняет запись.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with routers.track_writes() as writes:
+            response = self.get_response(request)
+        if writes['written']:
+            response.set_cookie(settings.REPLICA_PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True, samesite='Lax', secure=request.is_secure())
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Профилирование реальных запросов: сотрудник включает его заголовком X-Profile: 1 или ?profile=1,
+    либо профилируется каждый PROFILING_SAMPLE_RATE-й запрос. Без триггера запрос идет как обычно.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+        self.requests = 0
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        sql_log = profiling.SqlLog()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(sql_log))
+            profile.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profile.disable()
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match and match.view_name else 'unresolved'
+        response['X-Profile-Id'] = profiling.save(profile, sql_log, request, view, duration)
+        return response
+
+    def should_profile(self, request):
+        if self.sample_rate:
+            self.requests += 1
+            if self.requests % self.sample_rate == 0:
+                return True
+        if request.headers.get('X-Profile') != '1' and request.GET.get('profile') != '1':
+            return False
+        return request.user.is_staff
@@ -1,3 +1,4 @@
+import datetime
 from decimal import Decimal
 
 from django.contrib.auth.models import User
@@ -9,6 +10,9 @@ class Friendship(models.Model):
     creator = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friendship_creator')
     friend = models.ForeignKey(User, on_delete=models.CASCADE, related_name='creators_friend')
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=('creator', 'friend'), name='unique_friendship')]
+
 
 class Travel(models.Model):
     EUR = 'EUR'
@@ -26,6 +30,11 @@ class Travel(models.Model):
     end_date = models.DateField(null=False, editable=True)
     travelers = models.ManyToManyField(User, editable=True)
     currency = models.CharField(max_length=3, choices=CURRENCIES, default=RUR)
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # Меняется вместе с version и при сохранении самого путешествия, отдается в Last-Modified
+    modified = models.DateTimeField(auto_now=True)
+    # Платежи и доли перенесены в TravelArchive, новые записи запрещены
+    archived = models.BooleanField(default=False, editable=False)
 
     def __str__(self):
         return f'{self.title} ({str(self.start_date)} - {str(self.end_date)})'
@@ -41,11 +50,32 @@ class Payment(models.Model):
                                             MaxValueValidator(Decimal('10000000.0'),
                                                               message='Значение должно быть не больше 10 миллионов')])
 
+    currency = models.CharField(max_length=3, choices=Travel.CURRENCIES, default=Travel.RUR)
+    date = models.DateField(null=False, default=datetime.date.today)
+
     payer = models.ForeignKey(User, on_delete=models.CASCADE)
     travel = models.ForeignKey(Travel, on_delete=models.CASCADE)
 
+    # Версия путешествия на момент записи и ключ идемпотентности клиента для синхронизации
+    version = models.PositiveIntegerField(default=0, editable=False)
+    client_key = models.CharField(max_length=64, null=True, blank=True, editable=False)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=('travel', 'client_key'), name='unique_payment_client_key')]
+        indexes = [models.Index(fields=('travel', 'version', 'id'), name='payment_travel_version')]
+
     def __str__(self):
-        return f'{self.title} - {self.value}'
+        return f'{self.title} - {self.value} {self.currency}'
+
+
+class PaymentTombstone(models.Model):
+    # След удаленного платежа, чтобы клиенты синхронизации узнали об удалении
+    travel = models.ForeignKey(Travel, on_delete=models.CASCADE)
+    payment_id = models.BigIntegerField(null=False)
+    version = models.PositiveIntegerField(null=False)
+
+    class Meta:
+        indexes = [models.Index(fields=('travel', 'version'), name='tombstone_travel_version')]
 
 
 class Debt(models.Model):
@@ -53,5 +83,52 @@ class Debt(models.Model):
     debitor = models.ForeignKey(User, on_delete=models.CASCADE)
     value = models.DecimalField(null=False, max_digits=9, decimal_places=2)
 
+    # Копии source.travel и source.payer: итоги агрегируются по Debt без соединений.
+    # null только у строк, записанных до появления полей, их заполняет manage.py backfill_debts
+    travel = models.ForeignKey(Travel, on_delete=models.CASCADE, null=True, editable=False, related_name='+')
+    payer = models.ForeignKey(User, on_delete=models.CASCADE, null=True, editable=False, related_name='+')
+
+    class Meta:
+        indexes = [models.Index(fields=('travel', 'debitor', 'payer', 'value'), name='debt_travel_debitor_payer')]
+
     def __str__(self):
         return f'{self.debitor}s debt: {self.value} to {self.source.payer}'
+
+
+class TravelBalance(models.Model):
+    travel = models.ForeignKey(Travel, on_delete=models.CASCADE, related_name='balances')
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    amount = models.DecimalField(null=False, max_digits=12, decimal_places=2, default=Decimal('0'))
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=('travel', 'user'), name='unique_travel_balance')]
+
+    def __str__(self):
+        return f'{self.user} в {self.travel}: {self.amount}'
+
+
+class TravelArchive(models.Model):
+    # Снимок завершенного путешествия: платежи с долями и итоги по парам одним сжатым JSON
+    travel = models.OneToOneField(Travel, on_delete=models.CASCADE, primary_key=True, related_name='archive')
+    snapshot = models.BinaryField()
+    # Для списка путешествий, чтобы не распаковывать снимок
+    payments_count = models.PositiveIntegerField(default=0)
+    total_spent = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0'))
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Архив {self.travel}'
+
+
+class ExchangeRate(models.Model):
+    # Сколько единиц опорной валюты (settings.FX_REFERENCE_CURRENCY) стоит одна единица currency
+    currency = models.CharField(max_length=3, choices=Travel.CURRENCIES)
+    date = models.DateField(null=False)
+    rate = models.DecimalField(null=False, max_digits=18, decimal_places=8)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=('currency', 'date'), name='unique_exchange_rate')]
+
+    def __str__(self):
+        return f'{self.currency} {self.date}: {self.rate}'
@@ -0,0 +1,91 @@
+import cProfile
+import json
+import os
+import pstats
+import re
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+NAME_PATTERN = re.compile(r'^[\w.-]+$')
+UNSAFE_CHARS = re.compile(r'[^\w.-]')
+
+
+def profiles_dir():
+    return Path(getattr(settings, 'PROFILING_DIR', settings.BASE_DIR / 'profiles'))
+
+
+class SqlLog:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'sql': sql,
+                                 'params': repr(params)[:500],
+                                 'many': many,
+                                 'ms': round((time.perf_counter() - start) * 1000, 3)})
+
+
+def save(profile: cProfile.Profile, sql_log: SqlLog, request, view, duration):
+    directory = profiles_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    view = UNSAFE_CHARS.sub('_', view)
+    name = f'{time.strftime("%Y%m%d-%H%M%S")}-{time.perf_counter_ns() % 10 ** 6:06d}-{view}'
+
+    profile.dump_stats(directory / f'{name}.prof')
+    with open(directory / f'{name}.json', 'w') as meta:
+        json.dump({'path': request.get_full_path(),
+                   'method': request.method,
+                   'view': view,
+                   'user': getattr(request.user, 'username', ''),
+                   'duration_ms': round(duration * 1000, 3),
+                   'queries': sql_log.queries}, meta, ensure_ascii=False)
+    rotate(directory)
+    return name
+
+
+def rotate(directory):
+    # Храним только последние PROFILING_MAX_FILES профилей
+    profiles = sorted(directory.glob('*.prof'), key=os.path.getmtime)
+    for path in profiles[:max(0, len(profiles) - getattr(settings, 'PROFILING_MAX_FILES', 50))]:
+        path.unlink(missing_ok=True)
+        path.with_suffix('.json').unlink(missing_ok=True)
+
+
+def list_profiles():
+    profiles = []
+    for path in sorted(profiles_dir().glob('*.json'), key=os.path.getmtime, reverse=True):
+        with open(path) as meta:
+            data = json.load(meta)
+        profiles.append({'name': path.stem,
+                         'path': data['path'],
+                         'method': data['method'],
+                         'view': data['view'],
+                         'user': data['user'],
+                         'duration_ms': data['duration_ms'],
+                         'queries': len(data['queries'])})
+    return profiles
+
+
+def load_profile(name, top=30):
+    if not NAME_PATTERN.match(name) or not (profiles_dir() / f'{name}.prof').exists():
+        raise FileNotFoundError(name)
+
+    with open(profiles_dir() / f'{name}.json') as meta:
+        data = json.load(meta)
+
+    stats = pstats.Stats(str(profiles_dir() / f'{name}.prof'))
+    functions = []
+    for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        functions.append({'function': f'{function} ({os.path.relpath(filename) if filename != "~" else ""}:{line})',
+                          'calls': calls,
+                          'tottime_ms': round(tottime * 1000, 3),
+                          'cumtime_ms': round(cumtime * 1000, 3)})
+    functions.sort(key=lambda row: row['cumtime_ms'], reverse=True)
+    data['functions'] = functions[:top]
+    return data
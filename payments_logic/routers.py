@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+REPLICA_ALIAS = 'replica'
+# Служебные таблицы всегда читаются с основной базы: сессия и пользователь, созданные при входе,
+# могли еще не доехать до реплики
+PRIMARY_ONLY_APPS = ('sessions', 'auth', 'social_django', 'admin', 'contenttypes', 'django_cache')
+# Записи этих таблиц не закрепляют пользователя за основной базой: их и так читают только с нее
+UNTRACKED_WRITE_APPS = ('sessions', 'django_cache')
+
+_use_replica = ContextVar('use_replica', default=False)
+# Изменяемый флаг текущего запроса: ContextVar, выставленный внутри представления,
+# не виден middleware, если представление выполнялось в скопированном контексте (ASGI)
+_writes = ContextVar('replica_writes', default=None)
+
+
+def replica_configured():
+    return REPLICA_ALIAS in settings.DATABASES
+
+
+@contextmanager
+def use_replica(enabled=True):
+    token = _use_replica.set(enabled and replica_configured())
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+@contextmanager
+def track_writes():
+    writes = {'written': False}
+    token = _writes.set(writes)
+    try:
+        yield writes
+    finally:
+        _writes.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Чтения внутри use_replica() уходят на реплику, все остальное - на основную базу.
+    После первой записи в том же контексте чтения тоже возвращаются на основную,
+    а запрос внутри track_writes() помечается как записывавший.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and model._meta.app_label not in PRIMARY_ONLY_APPS:
+            return REPLICA_ALIAS
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        _use_replica.set(False)
+        writes = _writes.get()
+        if writes is not None and model._meta.app_label not in UNTRACKED_WRITE_APPS:
+            writes['written'] = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплика - копия основной базы, объекты из обеих можно связывать
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == 'default'
+
+
+class ReplicaReadMixin:
+    """
+    Для представлений только на чтение: GET и HEAD читают с реплики, если пользователь
+    недавно ничего не записывал (см. ReplicaPinMiddleware).
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        enabled = request.method in ('GET', 'HEAD') and not is_pinned(request)
+        with use_replica(enabled):
+            return super().dispatch(request, *args, **kwargs)
+
+
+def is_pinned(request):
+    return settings.REPLICA_PIN_COOKIE in request.COOKIES
+
+
+def check_connections(**kwargs):
+    """
+    Проверка живости постоянных соединений в начале запроса: соединение, оборванное
+    сервером БД за время простоя, закрывается и открывается заново, а не падает на первом запросе.
+    """
+    for connection in connections.all():
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
@@ -0,0 +1,156 @@
+import logging
+import re
+from collections import namedtuple
+
+from django.db import connections, router
+from django.db.models import CharField, F, FloatField, Q, Value
+
+from .models import Payment, Travel
+
+SEARCH_PAGE_SIZE = 20
+FTS_TABLE = 'payments_logic_search'
+FULLTEXT_INDEX = 'payments_logic_title_fulltext'
+WORD = re.compile(r'\w+')
+
+logger = logging.getLogger(__name__)
+
+SearchHit = namedtuple('SearchHit', 'kind id travel_id title rank')
+
+
+def query_words(query):
+    return WORD.findall(query.lower())[:10]
+
+
+def sqlite_statements():
+    """
+    FTS5-таблица с названиями путешествий и платежей. rowid кодирует объект
+    (платеж - 2 * id, путешествие - 2 * id + 1), поэтому триггеры правят индекс по первичному ключу
+    и ловят любые записи, в том числе bulk_create, update() и каскадные удаления.
+    """
+    travel, payment = Travel._meta.db_table, Payment._meta.db_table
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+        f"USING fts5(title, travel_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_travel_ai AFTER INSERT ON {travel} BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, title, travel_id) VALUES (new.id * 2 + 1, new.title, new.id); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_travel_au AFTER UPDATE OF title ON {travel} BEGIN "
+        f"UPDATE {FTS_TABLE} SET title = new.title WHERE rowid = new.id * 2 + 1; END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_travel_ad AFTER DELETE ON {travel} BEGIN "
+        f"DELETE FROM {FTS_TABLE} WHERE rowid = old.id * 2 + 1; END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_payment_ai AFTER INSERT ON {payment} BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, title, travel_id) VALUES (new.id * 2, new.title, new.travel_id); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_payment_au AFTER UPDATE OF title, travel_id ON {payment} BEGIN "
+        f"UPDATE {FTS_TABLE} SET title = new.title, travel_id = new.travel_id WHERE rowid = new.id * 2; END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_payment_ad AFTER DELETE ON {payment} BEGIN "
+        f"DELETE FROM {FTS_TABLE} WHERE rowid = old.id * 2; END",
+    ]
+
+
+def mysql_has_index(cursor, table):
+    cursor.execute(f'SHOW INDEX FROM {table} WHERE Key_name = %s', [FULLTEXT_INDEX])
+    return cursor.fetchone() is not None
+
+
+def ensure_index(using='default', **kwargs):
+    """
+    Создает индекс, если его нет; подключена к post_migrate. В MySQL это FULLTEXT-индексы на title,
+    их InnoDB поддерживает сам. На остальных базах индекса нет, и search() ищет через icontains.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            exists = FTS_TABLE in connection.introspection.table_names(cursor)
+            for statement in sqlite_statements():
+                cursor.execute(statement)
+            if not exists:
+                fill_sqlite(cursor)
+        elif connection.vendor == 'mysql':
+            for model in (Travel, Payment):
+                if not mysql_has_index(cursor, model._meta.db_table):
+                    cursor.execute(f'ALTER TABLE {model._meta.db_table} ADD FULLTEXT INDEX {FULLTEXT_INDEX} (title)')
+        else:
+            logger.warning('Полнотекстовый индекс для %s не поддерживается, поиск будет идти без индекса',
+                           connection.vendor)
+
+
+def fill_sqlite(cursor):
+    cursor.execute(f'INSERT INTO {FTS_TABLE}(rowid, title, travel_id) '
+                   f'SELECT id * 2 + 1, title, id FROM {Travel._meta.db_table}')
+    cursor.execute(f'INSERT INTO {FTS_TABLE}(rowid, title, travel_id) '
+                   f'SELECT id * 2, title, travel_id FROM {Payment._meta.db_table}')
+
+
+def rebuild_index(using='default'):
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+        elif connection.vendor == 'mysql':
+            for model in (Travel, Payment):
+                if mysql_has_index(cursor, model._meta.db_table):
+                    cursor.execute(f'ALTER TABLE {model._meta.db_table} DROP INDEX {FULLTEXT_INDEX}')
+    ensure_index(using)
+
+
+def search(user, query, page=1, page_size=SEARCH_PAGE_SIZE):
+    """
+    Путешествия и платежи пользователя, в названии которых есть все слова запроса
+    (каждое - как начало слова: "отел каз"), по убыванию релевантности.
+    Возвращает (список SearchHit, есть ли следующая страница).
+    """
+    words = query_words(query)
+    if not words:
+        return [], False
+    using = router.db_for_read(Payment)
+    connection = connections[using]
+    travels = Travel.travelers.through._meta.db_table
+    offset = (page - 1) * page_size
+
+    if connection.vendor == 'sqlite':
+        match = ' '.join(f'"{word}"*' for word in words)
+        sql = (f'SELECT rowid, travel_id, title, bm25({FTS_TABLE}) AS rank FROM {FTS_TABLE} '
+               f'WHERE {FTS_TABLE} MATCH %s AND travel_id IN (SELECT travel_id FROM {travels} WHERE user_id = %s) '
+               f'ORDER BY rank LIMIT %s OFFSET %s')
+        params = [match, user.pk, page_size + 1, offset]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = [SearchHit('travel' if rowid % 2 else 'payment', rowid // 2, travel_id, title, -rank)
+                    for rowid, travel_id, title, rank in cursor.fetchall()]
+    elif connection.vendor == 'mysql':
+        match = ' '.join(f'+{word}*' for word in words)
+        against = 'MATCH(title) AGAINST (%s IN BOOLEAN MODE)'
+        sql = (f"SELECT 'payment', id, travel_id, title, {against} AS score FROM {Payment._meta.db_table} "
+               f"WHERE {against} AND travel_id IN (SELECT travel_id FROM {travels} WHERE user_id = %s) "
+               f"UNION ALL "
+               f"SELECT 'travel', id, id, title, {against} FROM {Travel._meta.db_table} "
+               f"WHERE {against} AND id IN (SELECT travel_id FROM {travels} WHERE user_id = %s) "
+               f"ORDER BY score DESC LIMIT %s OFFSET %s")
+        params = [match, match, user.pk, match, match, user.pk, page_size + 1, offset]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = [SearchHit(*row) for row in cursor.fetchall()]
+    else:
+        rows = search_unindexed(user, words, using, offset, page_size + 1)
+
+    return rows[:page_size], len(rows) > page_size
+
+
+def search_unindexed(user, words, using, offset, limit):
+    # Без полнотекстового индекса: все слова как подстроки названия, путешествия выше платежей, новые выше старых
+    condition = Q()
+    for word in words:
+        condition &= Q(title__icontains=word)
+    travel_ids = Travel.travelers.through.objects.filter(user=user).values('travel_id')
+    travels = unindexed_hits(Travel.objects.using(using).filter(condition, id__in=travel_ids), 'travel', 'id')
+    payments = unindexed_hits(Payment.objects.using(using).filter(condition, travel_id__in=travel_ids),
+                              'payment', 'travel_id')
+    rows = travels.union(payments, all=True).order_by('-hit_kind', '-hit_id')[offset:offset + limit]
+    return [SearchHit(*row) for row in rows]
+
+
+def unindexed_hits(queryset, kind, travel_field):
+    # Одинаковые аннотации в обеих частях UNION: у values_list поля модели и аннотации идут в разном порядке
+    return (queryset
+            .annotate(hit_kind=Value(kind, output_field=CharField()), hit_id=F('id'), hit_travel_id=F(travel_field),
+                      hit_title=F('title'), hit_rank=Value(0.0, output_field=FloatField()))
+            .values_list('hit_kind', 'hit_id', 'hit_travel_id', 'hit_title', 'hit_rank'))
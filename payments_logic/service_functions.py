@@ -1,4 +1,16 @@
+import datetime
+
 from django.contrib.auth.models import User
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+
+import payments_logic.archive as archive
+from . import fx
+from .models import Payment, Debt, Travel, TravelArchive, TravelBalance
+
+PAYMENTS_PAGE_SIZE = 50
+TRAVELS_PAGE_SIZE = 10
+# Курсор больше BIGINT базе не передать: драйвер падает с OverflowError
+MAX_CURSOR = 2 ** 63 - 1
 
 
 def dictfetchall(cursor):
@@ -48,3 +60,243 @@ def get_summary(data):
 
     new_data = list(filter(lambda elem: elem['total'] > 0, new_data))
     return new_data
+
+
+def pairwise_debts(data):
+    # Сворачивает встречные долги каждой пары в одну сумму за один проход
+    pairs = {}
+    for row in data:
+        debitor, payer, total = row['debitor_id'], row['payer_id'], row['total']
+        if debitor == payer:
+            continue
+        if debitor < payer:
+            key, signed = (debitor, payer), total
+        else:
+            key, signed = (payer, debitor), -total
+        pairs[key] = pairs.get(key, 0) + signed
+
+    debts = []
+    for (first, second), total in pairs.items():
+        if total > 0:
+            debts.append((first, second, total))
+        elif total < 0:
+            debts.append((second, first, -total))
+    return debts
+
+
+def net_balances(data):
+    # Положительный баланс - путешественнику должны, отрицательный - должен он
+    balances = {}
+    for row in data:
+        debitor, payer, total = row['debitor_id'], row['payer_id'], row['total']
+        if debitor == payer:
+            continue
+        balances[debitor] = balances.get(debitor, 0) - total
+        balances[payer] = balances.get(payer, 0) + total
+    return balances
+
+
+def minimal_transfers(balances):
+    # Сокращение цепочек долгов: самый крупный должник платит самому крупному кредитору
+    debitors = sorted(((-value, user_id) for user_id, value in balances.items() if value < 0), reverse=True)
+    creditors = sorted(((value, user_id) for user_id, value in balances.items() if value > 0), reverse=True)
+
+    transfers = []
+    i = j = 0
+    while i < len(debitors) and j < len(creditors):
+        debt, debitor = debitors[i]
+        credit, payer = creditors[j]
+        total = min(debt, credit)
+        transfers.append((debitor, payer, total))
+        debitors[i] = (debt - total, debitor)
+        creditors[j] = (credit - total, payer)
+        if debitors[i][0] <= 0:
+            i += 1
+        if creditors[j][0] <= 0:
+            j += 1
+    return transfers
+
+
+def settle(data, simplify=False):
+    """
+    Замена get_summary: data - строки с ключами debitor_id, payer_id, total.
+    При simplify=True возвращается минимальный набор переводов по чистым балансам.
+    """
+    if simplify:
+        return resolve_transfers(minimal_transfers(net_balances(data)))
+    return resolve_transfers(pairwise_debts(data))
+
+
+def settle_balances(balances):
+    # То же, что settle(simplify=True), но по готовым балансам из TravelBalance
+    return resolve_transfers(minimal_transfers(balances))
+
+
+def resolve_transfers(transfers):
+    users = User.objects.in_bulk({user_id for transfer in transfers for user_id in transfer[:2]})
+    return [{'debitor': users[debitor], 'payer': users[payer], 'total': total}
+            for debitor, payer, total in transfers]
+
+
+def global_settlement(user, currency, simplify=False):
+    """
+    Взаиморасчет пользователя с друзьями по всем его путешествиям в валюте currency.
+    Один сгруппированный запрос по индексу Debt (travel, debitor, payer) вместо итогов по каждому путешествию,
+    для архивных путешествий - готовые итоги по парам из снимков.
+    С simplify цепочки сокращаются по всем участникам его путешествий, показываются только его переводы.
+    """
+    travels = Travel.objects.filter(travelers=user)
+    debts = (Debt.objects
+             .filter(travel__in=travels.values('id'))
+             .exclude(debitor_id=F('payer_id')))
+    if not simplify:
+        debts = debts.filter(Q(debitor=user) | Q(payer=user))
+    rows = list(debts
+                .values('debitor_id', 'payer_id', currency=F('source__currency'), date=F('source__date'))
+                .annotate(total=Sum('value'))
+                .order_by())
+    archived = archive.summary_rows(travels.filter(archived=True).values('id'))
+    if not simplify:
+        archived = [row for row in archived if user.id in (row['debitor_id'], row['payer_id'])]
+    rows = fx.convert_totals(rows + archived, currency)
+    if simplify:
+        transfers = [transfer for transfer in minimal_transfers(net_balances(rows)) if user.id in transfer[:2]]
+    else:
+        transfers = pairwise_debts(rows)
+    return resolve_transfers(transfers)
+
+
+def keyset_page(queryset, after=None, before=None, size=PAYMENTS_PAGE_SIZE):
+    """
+    Постраничная выборка по курсору id вместо OFFSET: любая страница стоит как первая.
+    Возвращает строки страницы и курсоры для предыдущей и следующей страниц.
+    """
+    if before is not None:
+        rows = list(queryset.filter(id__lt=before).order_by('-id')[:size + 1])
+        has_more = len(rows) > size
+        rows = rows[:size][::-1]
+        prev_cursor = rows[0]['id'] if has_more and rows else None
+        next_cursor = rows[-1]['id'] if rows else None
+    else:
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+        rows = list(queryset.order_by('id')[:size + 1])
+        has_more = len(rows) > size
+        rows = rows[:size]
+        prev_cursor = rows[0]['id'] if after is not None and rows else None
+        next_cursor = rows[-1]['id'] if has_more else None
+    return rows, prev_cursor, next_cursor
+
+
+def travel_payments(travel_id, travelers, after=None, before=None, size=PAYMENTS_PAGE_SIZE, archived=False):
+    """
+    Список платежей путешествия за фиксированное число запросов на любой СУБД.
+    Имена плательщиков и должников берутся из уже загруженных travelers (словарь id -> User).
+    У архивного путешествия платежи читаются из снимка.
+    """
+    if archived:
+        payments, debitors, prev_cursor, next_cursor = archive.payments_page(travel_id, after, before, size)
+    else:
+        payments, prev_cursor, next_cursor = keyset_page(
+            Payment.objects.filter(travel_id=travel_id).values('id', 'title', 'value', 'currency', 'payer_id'),
+            after=after, before=before, size=size)
+
+        debitors = {}
+        for source_id, debitor_id in (Debt.objects
+                                      .filter(source_id__in=[payment['id'] for payment in payments])
+                                      .order_by('id')
+                                      .values_list('source_id', 'debitor_id')):
+            debitors.setdefault(source_id, []).append(debitor_id)
+
+    # Плательщик или должник мог быть исключен из путешествия после оплаты
+    users = dict(travelers)
+    missing = {payment['payer_id'] for payment in payments} | {user_id for ids in debitors.values() for user_id in ids}
+    missing -= users.keys()
+    if missing:
+        users.update(User.objects.in_bulk(missing))
+
+    for payment in payments:
+        payment['name'] = users[payment['payer_id']].get_full_name()
+        payment['debitors'] = ', '.join(users[user_id].get_full_name() for user_id in debitors.get(payment['id'], []))
+    return payments, prev_cursor, next_cursor
+
+
+def parse_travel_cursor(cursor):
+    # Курсор списка путешествий: "дата старта.дата окончания.id"
+    try:
+        start_date, end_date, travel_id = (cursor or '').split('.')
+        start_date, end_date, travel_id = (datetime.date.fromisoformat(start_date),
+                                           datetime.date.fromisoformat(end_date), int(travel_id))
+    except ValueError:
+        return None
+    return (start_date, end_date, travel_id) if 0 <= travel_id <= MAX_CURSOR else None
+
+
+def travel_cursor(travel):
+    return f'{travel.start_date.isoformat()}.{travel.end_date.isoformat()}.{travel.id}'
+
+
+def travels_page(user, after=None, before=None, size=TRAVELS_PAGE_SIZE):
+    """
+    Страница путешествий пользователя (новые сверху) по курсору (start_date, end_date, id) вместо OFFSET.
+    У каждого путешествия число платежей, сумма трат в валюте путешествия и баланс пользователя:
+    всего два запроса на страницу.
+    """
+    travels = (Travel.objects
+               .filter(travelers=user)
+               .annotate(my_balance=Subquery(TravelBalance.objects
+                                             .filter(travel=OuterRef('pk'), user=user)
+                                             .values('amount')[:1])))
+    after, before = parse_travel_cursor(after), parse_travel_cursor(before)
+    keys = ('start_date', 'end_date', 'id')
+
+    def beyond(cursor, lookup):
+        condition = Q()
+        for i, key in enumerate(keys):
+            condition |= Q(**dict(zip(keys[:i], cursor[:i])), **{f'{key}__{lookup}': cursor[i]})
+        return condition
+
+    if before is not None:
+        rows = list(travels.filter(beyond(before, 'gt')).order_by(*keys)[:size + 1])
+        has_more = len(rows) > size
+        rows = rows[:size][::-1]
+        prev_cursor = travel_cursor(rows[0]) if has_more and rows else None
+        next_cursor = travel_cursor(rows[-1]) if rows else None
+    else:
+        if after is not None:
+            travels = travels.filter(beyond(after, 'lt'))
+        rows = list(travels.order_by(*[f'-{key}' for key in keys])[:size + 1])
+        has_more = len(rows) > size
+        rows = rows[:size]
+        prev_cursor = travel_cursor(rows[0]) if after is not None and rows else None
+        next_cursor = travel_cursor(rows[-1]) if has_more else None
+
+    totals = {}
+    for row in (Payment.objects
+                .filter(travel__in=[travel.id for travel in rows])
+                .values('travel_id', 'currency', 'date')
+                .annotate(total=Sum('value'), count=Count('id'))
+                .order_by()):
+        totals.setdefault(row['travel_id'], []).append(row)
+    # У архивных путешествий платежей в таблице нет, итоги сохранены в архиве
+    archived = {}
+    if any(travel.archived for travel in rows):
+        archived = {travel_id: (count, total) for travel_id, count, total in
+                    (TravelArchive.objects
+                     .filter(travel__in=[travel.id for travel in rows if travel.archived])
+                     .values_list('travel_id', 'payments_count', 'total_spent'))}
+    for travel in rows:
+        if travel.id in archived:
+            travel.payments_count, travel.total_spent = archived[travel.id]
+        else:
+            travel_totals = totals.get(travel.id, [])
+            travel.payments_count = sum(row['count'] for row in travel_totals)
+            # Без курса на дату одного из платежей сумма неизвестна, но список должен открываться
+            try:
+                travel_totals = fx.convert_totals(travel_totals, travel.currency)
+            except fx.MissingRateError:
+                travel.total_spent = None
+            else:
+                travel.total_spent = sum((row['total'] for row in travel_totals), fx.CENT * 0)
+        travel.my_balance = travel.my_balance or fx.CENT * 0
+    return rows, prev_cursor, next_cursor
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.signals import request_started
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import bump_version, invalidate_friends
+from .models import Friendship, Travel
+from .routers import check_connections
+
+
+@receiver(m2m_changed, sender=Travel.travelers.through)
+def travelers_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # Изменение со стороны пользователя: затронуты все путешествия из pk_set
+        for travel_id in pk_set or ():
+            bump_version(travel_id)
+    else:
+        bump_version(instance.pk)
+
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def friendship_changed(sender, instance, **kwargs):
+    invalidate_friends(instance.creator_id)
+
+
+@receiver(request_started)
+def connections_health_check(sender, **kwargs):
+    if settings.DB_HEALTH_CHECKS:
+        check_connections()
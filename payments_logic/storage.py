@@ -0,0 +1,18 @@
+import re
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+
+class HashedStaticStorage(ManifestStaticFilesStorage):
+    def stored_name(self, name):
+        # До первого hashstatic манифеста нет: отдаем исходное имя, а не роняем страницу
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+
+def is_hashed(name):
+    return bool(HASHED_NAME.search(name))
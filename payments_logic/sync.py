@@ -0,0 +1,204 @@
+import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Q
+
+import payments_logic.archive as archive
+import payments_logic.importer as importer
+import payments_logic.ledger as ledger
+import payments_logic.service_functions as sf
+from . import fx
+from .models import Debt, Payment, PaymentTombstone, Travel
+
+PULL_LIMIT = 500
+MAX_PUSH_ITEMS = 1000
+MAX_KEY_LENGTH = Payment._meta.get_field('client_key').max_length
+
+
+class SyncError(Exception):
+    pass
+
+
+def travels_state(user):
+    """
+    Список путешествий пользователя с версиями: клиент тянет изменения только там, где версия выросла.
+    """
+    travels = (Travel.objects
+               .filter(travelers=user)
+               .order_by('id')
+               .prefetch_related('travelers'))
+    return [{'id': travel.id,
+             'title': travel.title,
+             'start': travel.start_date,
+             'end': travel.end_date,
+             'currency': travel.currency,
+             'version': travel.version,
+             'travelers': [[person.id, person.get_full_name() or person.username]
+                           for person in travel.travelers.all()]}
+            for travel in travels]
+
+
+def parse_cursor(cursor):
+    # Курсор "версия" - версия получена целиком, "версия.id" - внутри одной версии (массовый импорт) листаем по id
+    if not cursor:
+        return 0, None
+    try:
+        version, _, last_id = str(cursor).partition('.')
+        version, last_id = int(version), int(last_id) if last_id else None
+    except ValueError:
+        raise SyncError(f'Некорректный курсор: {cursor!r}')
+    if not 0 <= version <= sf.MAX_CURSOR or last_id is not None and not 0 <= last_id <= sf.MAX_CURSOR:
+        raise SyncError(f'Некорректный курсор: {cursor!r}')
+    return version, last_id
+
+
+def pull(travel, cursor=None, limit=PULL_LIMIT):
+    """
+    Изменения путешествия после курсора: новые платежи с долями и id удаленных платежей.
+    """
+    since, last_id = parse_cursor(cursor)
+    if since >= travel.version and last_id is None:
+        return {'version': travel.version, 'cursor': str(travel.version), 'more': False,
+                'payments': [], 'deleted': []}
+
+    if travel.archived:
+        rows, debitors = archive.pull_rows(travel.id, since, last_id, limit)
+    else:
+        condition = Q(version__gt=since)
+        if last_id is not None:
+            condition |= Q(version=since, id__gt=last_id)
+        rows = list(Payment.objects
+                    .filter(condition, travel=travel)
+                    .order_by('version', 'id')
+                    .values_list('id', 'client_key', 'title', 'value', 'currency', 'date', 'payer_id', 'version')
+                    [:limit + 1])
+
+        debitors = {}
+        for source_id, debitor_id in (Debt.objects
+                                      .filter(source_id__in=[row[0] for row in rows[:limit]])
+                                      .order_by('id')
+                                      .values_list('source_id', 'debitor_id')):
+            debitors.setdefault(source_id, []).append(debitor_id)
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    # Удаления отдаем до версии последнего платежа страницы; повторная отдача безвредна
+    upto = rows[-1][7] if more else travel.version
+    deleted = list(PaymentTombstone.objects
+                   .filter(travel=travel, version__gt=since, version__lte=upto)
+                   .values_list('payment_id', flat=True))
+
+    payments = []
+    for payment_id, key, title, value, currency, date, payer_id, _ in rows:
+        payments.append({'id': payment_id,
+                         'key': key,
+                         'title': title,
+                         'value': value,
+                         'currency': currency,
+                         'date': date,
+                         'payer': payer_id,
+                         'debitors': [debitor_id for debitor_id in debitors.get(payment_id, ())
+                                      if debitor_id != payer_id]})
+
+    return {'version': travel.version,
+            'cursor': f'{rows[-1][7]}.{rows[-1][0]}' if more else str(travel.version),
+            'more': more,
+            'payments': payments,
+            'deleted': deleted}
+
+
+def parse_item(item, travel, traveler_ids):
+    if not isinstance(item, dict):
+        raise ValueError('Элемент должен быть объектом')
+
+    title = str(item.get('title') or '').strip()
+    if not title:
+        raise ValueError('Не указано, что оплатили')
+    if len(title) > Payment._meta.get_field('title').max_length:
+        raise ValueError('Слишком длинное название')
+
+    try:
+        value = Decimal(str(item.get('value') or '')).quantize(ledger.CENT)
+    except InvalidOperation:
+        raise ValueError(f'Некорректная сумма: {item.get("value")!r}')
+    if not value.is_finite() or not importer.MIN_VALUE <= value <= importer.MAX_VALUE:
+        raise ValueError('Сумма должна быть от 0.01 до 10 миллионов')
+
+    payer = item.get('payer')
+    if not isinstance(payer, int) or payer not in traveler_ids:
+        raise ValueError(f'Плательщик {payer!r} не участвует в путешествии')
+
+    debitors = item.get('debitors') or []
+    if not isinstance(debitors, list) or any(not isinstance(debitor, int) or debitor not in traveler_ids
+                                             for debitor in debitors):
+        raise ValueError('Должники должны быть списком id участников путешествия')
+
+    currency = str(item.get('currency') or travel.currency).upper()
+    if currency not in importer.CURRENCIES:
+        raise ValueError(f'Неизвестная валюта: {currency!r}')
+
+    try:
+        date = datetime.date.fromisoformat(item['date']) if item.get('date') else datetime.date.today()
+    except (TypeError, ValueError):
+        raise ValueError(f'Некорректная дата: {item.get("date")!r}, ожидается ГГГГ-ММ-ДД')
+
+    return ledger.PaymentRow(title, value, payer, list(dict.fromkeys(debitors)), currency, date)
+
+
+def push(travel, items):
+    """
+    Пакетная запись платежей клиента. Каждый элемент несет ключ идемпотентности key:
+    повторная отправка того же ключа возвращает уже созданный id, а не дубль.
+    Ошибки валидации возвращаются по элементам, корректные записываются одной транзакцией.
+    """
+    if not isinstance(items, list):
+        raise SyncError('Ожидается список payments')
+    if len(items) > MAX_PUSH_ITEMS:
+        raise SyncError(f'Не больше {MAX_PUSH_ITEMS} платежей за запрос')
+    if travel.archived:
+        raise SyncError('Путешествие в архиве, новые платежи не принимаются')
+
+    traveler_ids = set(travel.travelers.values_list('id', flat=True))
+    results = {}
+    rows = {}
+    for item in items:
+        key = item.get('key') if isinstance(item, dict) else None
+        if not isinstance(key, str) or not key or len(key) > MAX_KEY_LENGTH:
+            raise SyncError(f'У каждого платежа должен быть строковый key до {MAX_KEY_LENGTH} символов')
+        if key in results or key in rows:
+            continue
+        try:
+            rows[key] = parse_item(item, travel, traveler_ids)._replace(client_key=key)
+        except ValueError as error:
+            results[key] = {'key': key, 'error': str(error)}
+
+    with transaction.atomic():
+        # Блокируем путешествие до проверки ключей, чтобы параллельные повторы не прошли оба
+        ledger.lock_travel(travel.id, bump=False)
+        existing = dict(Payment.objects
+                        .filter(travel=travel, client_key__in=[*rows, *results])
+                        .values_list('client_key', 'id'))
+
+        factors = fx.get_factors({(row.currency, row.date) for row in rows.values()}, travel.currency)
+        new_rows = []
+        for key, row in rows.items():
+            if key in existing:
+                continue
+            if (row.currency, row.date) in factors:
+                new_rows.append(row)
+            else:
+                results[key] = {'key': key, 'error': f'Нет курса {row.currency} к {travel.currency} на {row.date}'}
+
+        created = {}
+        if new_rows:
+            ledger.bulk_record_payments(travel.id, [new_rows])
+            created = dict(Payment.objects
+                           .filter(travel=travel, client_key__in=[row.client_key for row in new_rows])
+                           .values_list('client_key', 'id'))
+
+    for key, payment_id in {**existing, **created}.items():
+        results[key] = {'key': key, 'id': payment_id, 'created': key in created}
+    travel.refresh_from_db(fields=['version'])
+    return {'version': travel.version,
+            'results': [results[key] for key in dict.fromkeys(item['key'] for item in items)]}
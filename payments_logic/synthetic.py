@@ -0,0 +1,54 @@
+import datetime
+import random
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+import payments_logic.ledger as ledger
+from .models import Friendship, Travel
+
+
+@transaction.atomic
+def seed(users=20, friends_per_user=5, travels=10, travelers_per_travel=5, payments_per_travel=100,
+         debitors_per_payment=3, prefix='seed', rnd=None):
+    """
+    Синтетические данные для нагрузочных замеров. Платежи пишутся через ledger,
+    поэтому балансы и версии путешествий согласованы с сырыми строками.
+    Возвращает созданных пользователей и путешествия.
+    """
+    rnd = rnd or random.Random(0)
+
+    User.objects.bulk_create([User(username=f'{prefix}{i}',
+                                   first_name=f'Имя{i}',
+                                   last_name=prefix.capitalize(),
+                                   email=f'{prefix}{i}@example.com') for i in range(users)])
+    people = list(User.objects.filter(username__startswith=prefix, last_name=prefix.capitalize()).order_by('id'))
+
+    Friendship.objects.bulk_create([Friendship(creator=person, friend=friend)
+                                    for person in people
+                                    for friend in rnd.sample(people, min(friends_per_user, len(people)))
+                                    if friend is not person])
+
+    today = datetime.date.today()
+    created_travels = []
+    for i in range(travels):
+        start_date = today - datetime.timedelta(days=rnd.randint(0, 3650))
+        travel = Travel.objects.create(title=f'Поездка {i}',
+                                       start_date=start_date,
+                                       end_date=start_date + datetime.timedelta(days=rnd.randint(1, 21)))
+        # Первый пользователь участвует во всех поездках, от его имени идут замеры
+        travelers = [people[0]] + rnd.sample(people[1:], min(travelers_per_travel, len(people)) - 1)
+        travel.travelers.add(*travelers)
+
+        traveler_ids = [person.id for person in travelers]
+        payments = [ledger.PaymentRow(f'Платеж {j}',
+                                      Decimal(rnd.randint(100, 1000000)) / 100,
+                                      rnd.choice(traveler_ids),
+                                      rnd.sample(traveler_ids, min(debitors_per_payment, len(traveler_ids))),
+                                      travel.currency,
+                                      today) for j in range(payments_per_travel)]
+        ledger.bulk_record_payments(travel.id, [payments[k:k + 1000] for k in range(0, len(payments), 1000)])
+        created_travels.append(travel)
+
+    return people, created_travels
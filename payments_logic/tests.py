@@ -1,3 +1,1081 @@
-from django.test import TestCase
+import datetime
+import gzip
+import json
+import os
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, router, transaction
+from django.db.models import F, Sum
+from django.core.management import call_command
+from django.http import HttpResponse
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.views import View
+
+import payments_logic.analytics as analytics
+import payments_logic.archive as archive
+import payments_logic.cache as travel_cache
+import payments_logic.friends as friends
+import payments_logic.fx as fx
+import payments_logic.importer as importer
+import payments_logic.ledger as ledger
+import payments_logic.live as live
+import payments_logic.routers as routers
+import payments_logic.search as search
+import payments_logic.service_functions as sf
+import payments_logic.sync as sync
+from . import events
+from .cache import get_cache
+from .metrics import registry
+from .middleware import ReplicaPinMiddleware
+from .models import Debt, ExchangeRate, Friendship, Payment, PaymentTombstone, Travel, TravelBalance
+
+
+class TravelTestCase(TestCase):
+    # Три пользователя и законченное путешествие, в котором участвуют первые два
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ann = User.objects.create_user('ann', first_name='Ann')
+        cls.bob = User.objects.create_user('bob', first_name='Bob')
+        cls.cid = User.objects.create_user('cid', first_name='Cid')
+        cls.travel = Travel.objects.create(title='Kazan', start_date=datetime.date(2021, 1, 1),
+                                           end_date=datetime.date(2021, 1, 5))
+        cls.travel.travelers.add(cls.ann, cls.bob)
+
+    def setUp(self):
+        # Ключи кэша строятся по id и версии, а они повторяются от теста к тесту
+        get_cache().clear()
+        self.client.force_login(self.ann)
+
+    def add_payment(self, payer, value, debitors, **kwargs):
+        kwargs.setdefault('travel', self.travel)
+        payment = Payment(title='hotel', value=Decimal(value), payer=payer, **kwargs)
+        ledger.record_payment(payment, debitors)
+        return payment
+
+    def debt_rows(self):
+        return sorted(Debt.objects.filter(source__travel=self.travel).values_list('source_id', 'debitor_id', 'value'))
+
+
+class ExportTests(TravelTestCase):
+
+    def test_export_own_travel(self):
+        response = self.client.get(reverse('travel_export', args=[self.travel.pk, 'csv']))
+        self.assertEqual(response.status_code, 200)
+
+    def test_export_foreign_travel(self):
+        self.client.force_login(self.cid)
+        response = self.client.get(reverse('travel_export', args=[self.travel.pk, 'csv']))
+        self.assertEqual(response.status_code, 404)
+
+
+class ArchiveTests(TravelTestCase):
+
+    def test_archive_restore_round_trip(self):
+        self.add_payment(self.ann, '300', [self.ann, self.bob])
+        self.add_payment(self.bob, '90.10', [self.ann])
+        self.add_payment(self.bob, '15', [])
+        # Доли, записанные до появления Debt.travel и Debt.payer
+        legacy = self.add_payment(self.ann, '50', [self.bob])
+        Debt.objects.filter(source=legacy).update(travel=None, payer=None)
+        payments = sorted(Payment.objects.filter(travel=self.travel)
+                          .values_list('id', 'title', 'value', 'currency', 'date', 'payer_id', 'version'))
+        debts = self.debt_rows()
+        balances = ledger.get_balances(self.travel.pk)
+
+        self.assertEqual(archive.archive_travel(self.travel.pk), 4)
+        self.assertFalse(Payment.objects.filter(travel=self.travel).exists())
+        self.assertFalse(Debt.objects.filter(source__travel=self.travel).exists())
+        snapshot = archive.load_snapshot(self.travel.pk)
+        self.assertEqual(sum(len(payment['debts']) for payment in snapshot['payments']), len(debts))
+        self.assertIn({'debitor_id': self.bob.pk, 'payer_id': self.ann.pk, 'currency': 'RUR',
+                       'date': legacy.date, 'total': Decimal('175.00')}, snapshot['totals'])
+
+        self.assertEqual(archive.restore_travel(self.travel.pk), 4)
+        self.assertEqual(sorted(Payment.objects.filter(travel=self.travel)
+                                .values_list('id', 'title', 'value', 'currency', 'date', 'payer_id', 'version')),
+                         payments)
+        self.assertEqual(self.debt_rows(), debts)
+        self.assertEqual(ledger.get_balances(self.travel.pk), balances)
+        self.assertEqual(ledger.find_drift([self.travel.pk]), [])
+
+    def test_unfinished_travel_is_not_archived(self):
+        Travel.objects.filter(pk=self.travel.pk).update(end_date=datetime.date.today())
+        with self.assertRaises(archive.ArchiveError):
+            archive.archive_travel(self.travel.pk)
+
+
+class BackfillPaymentCurrencyTests(TravelTestCase):
+
+    def test_old_payments_take_travel_currency(self):
+        old = self.add_payment(self.ann, '30', [self.bob])
+        Travel.objects.filter(pk=self.travel.pk).update(currency=Travel.EUR)
+        # Платеж, записанный после обновления, в рублях намеренно
+        new = Payment.objects.create(title='taxi', value=Decimal('500'), currency=Travel.RUR,
+                                     payer=self.bob, travel=self.travel)
+        call_command('backfill_payment_currency', max_id=old.pk, stdout=StringIO())
+
+        old.refresh_from_db()
+        new.refresh_from_db()
+        self.assertEqual(old.currency, Travel.EUR)
+        self.assertEqual(old.version, Travel.objects.get(pk=self.travel.pk).version)
+        self.assertEqual(new.currency, Travel.RUR)
+
+
+def load_rates(test, rows):
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as stream:
+        stream.write('date,currency,rate\n')
+        stream.writelines(f'{date},{currency},{rate}\n' for date, currency, rate in rows)
+    test.addCleanup(os.remove, stream.name)
+    call_command('load_fx_rates', stream.name, stdout=StringIO())
+
+
+class LoadFxRatesTests(TestCase):
+
+    def load(self, rows):
+        load_rates(self, rows)
+
+    def test_reload_replaces_full_batch(self):
+        start = datetime.date(2020, 1, 1)
+        days = [start + datetime.timedelta(days=day) for day in range(600)]
+        self.load([(day, currency, '1') for day in days for currency in ('EUR', 'USD')])
+        self.load([(day, currency, '2') for day in days for currency in ('EUR', 'USD')])
+        self.assertEqual(ExchangeRate.objects.count(), 1200)
+        self.assertFalse(ExchangeRate.objects.exclude(rate=2).exists())
+
+
+class FxCacheTests(TestCase):
+    day = datetime.date(2021, 1, 3)
+
+    def setUp(self):
+        ExchangeRate.objects.create(currency='EUR', date=self.day, rate=Decimal('90'))
+        fx.clear_cache()
+
+    def test_rates_reload_after_version_bump(self):
+        self.assertEqual(fx.get_rates({('EUR', self.day)})[('EUR', self.day)], 90)
+        ExchangeRate.objects.update(rate=Decimal('95'))
+        self.assertEqual(fx.get_rates({('EUR', self.day)})[('EUR', self.day)], 90)
+        # load_fx_rates в другом процессе поднимает только общую версию
+        get_cache().incr(fx.RATES_VERSION_KEY)
+        self.assertEqual(fx.get_rates({('EUR', self.day)})[('EUR', self.day)], 95)
+
+    def test_rates_expire(self):
+        fx.get_rates({('EUR', self.day)})
+        ExchangeRate.objects.update(rate=Decimal('95'))
+        with self.settings(FX_CACHE_SECONDS=-1):
+            self.assertEqual(fx.get_rates({('EUR', self.day)})[('EUR', self.day)], 95)
+
+
+class TravelsListTests(TravelTestCase):
+
+    def test_missing_rate_does_not_break_list(self):
+        self.add_payment(self.ann, '100', [self.bob])
+        Payment.objects.create(title='museum', value=Decimal('10'), currency='EUR', payer=self.bob,
+                               travel=self.travel)
+        response = self.client.get(reverse('travels_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Платежей: 2')
+        self.assertContains(response, 'недоступно')
+
+    def test_pages(self):
+        later = Travel.objects.create(title='Sochi', start_date=datetime.date(2021, 6, 1),
+                                      end_date=datetime.date(2021, 6, 5))
+        later.travelers.add(self.ann)
+        travels, prev_cursor, next_cursor = sf.travels_page(self.ann, size=1)
+        self.assertEqual((travels, prev_cursor), ([later], None))
+        travels, prev_cursor, last_cursor = sf.travels_page(self.ann, after=next_cursor, size=1)
+        self.assertEqual((travels, last_cursor), ([self.travel], None))
+        self.assertEqual(sf.travels_page(self.ann, before=prev_cursor, size=1)[0], [later])
+
+    def test_invalid_cursors(self):
+        for cursor in ('x', '2021-01-01.2021-01-05', f'2021-01-01.2021-01-05.{2 ** 63}'):
+            response = self.client.get(reverse('travels_list'), {'after': cursor, 'before': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(response.context['travels']), [self.travel])
+
+
+class ImportTests(TravelTestCase):
+
+    def test_debitors_of_wrong_type_are_reported(self):
+        stream = StringIO('[{"title": "hotel", "value": 100, "payer": "ann", "debitors": 5},'
+                          ' {"title": "taxi", "value": 20, "payer": "ann", "debitors": [1]},'
+                          ' {"title": "museum", "value": 30, "payer": "ann", "debitors": "bob; ann"},'
+                          ' {"title": "lunch", "value": 40, "payer": "bob", "debitors": ["ann"]}]')
+        result = importer.import_payments(self.travel, stream, 'json')
+        self.assertEqual(result.created, 2)
+        self.assertEqual([line for line, _ in result.errors], [1, 1])
+        self.assertEqual(ledger.get_balances(self.travel.pk), {self.ann.pk: Decimal('-5.00'),
+                                                               self.bob.pk: Decimal('5.00')})
+
+    def test_import_into_foreign_travel(self):
+        self.client.force_login(self.cid)
+        url = reverse('import_payments', args=[self.travel.pk])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.post(url, {'format': 'csv', 'text': 'title,value,payer,debitors\nhotel,100,ann,bob'})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_import_form(self):
+        response = self.client.post(reverse('import_payments', args=[self.travel.pk]),
+                                    {'format': 'csv', 'text': 'title,value,payer,debitors\nhotel,100,ann,bob'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Payment.objects.filter(travel=self.travel).count(), 1)
+
+
+class PaymentViewsTests(TravelTestCase):
+
+    def test_add_payment_to_foreign_travel(self):
+        self.client.force_login(self.cid)
+        response = self.client.post(reverse('new_payment', args=[self.travel.pk]),
+                                    {'title': 'hotel', 'value': '100', 'payer': self.cid.pk, 'debitors': [self.ann.pk]})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_update_and_delete_payment(self):
+        payment = self.add_payment(self.ann, '100', [self.bob])
+        response = self.client.post(reverse('payment_update', args=[self.travel.pk, payment.pk]),
+                                    {'title': 'hotel', 'value': '60', 'payer': self.bob.pk,
+                                     'debitors': [self.ann.pk], 'currency': 'RUR', 'date': '2021-01-02'})
+        self.assertRedirects(response, reverse('travel_detail', args=[self.travel.pk]), fetch_redirect_response=False)
+        self.assertEqual(ledger.get_balances(self.travel.pk), {self.ann.pk: Decimal('-30.00'),
+                                                               self.bob.pk: Decimal('30.00')})
+        response = self.client.post(reverse('payment_delete', args=[self.travel.pk, payment.pk]))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(ledger.find_drift([self.travel.pk]), [])
+
+    def test_payment_forms(self):
+        payment = self.add_payment(self.ann, '100', [self.bob])
+        response = self.client.get(reverse('new_payment', args=[self.travel.pk]))
+        self.assertContains(response, 'Новая оплата')
+        self.assertContains(response, 'check_all_debitors')
+        response = self.client.get(reverse('payment_update', args=[self.travel.pk, payment.pk]))
+        self.assertContains(response, 'Изменить оплату')
+        self.assertContains(response, 'check_all_debitors')
+        self.assertContains(response, reverse('payment_delete', args=[self.travel.pk, payment.pk]))
+
+    def test_update_and_delete_foreign_payment(self):
+        payment = self.add_payment(self.ann, '100', [self.bob])
+        self.client.force_login(self.cid)
+        for name in ('payment_update', 'payment_delete'):
+            url = reverse(name, args=[self.travel.pk, payment.pk])
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.assertEqual(self.client.post(url, {'title': 'x', 'value': '1', 'payer': self.cid.pk}).status_code, 404)
+        payment.refresh_from_db()
+        self.assertEqual(payment.value, 100)
+
+    def test_archived_payment_is_read_only(self):
+        payment = self.add_payment(self.ann, '100', [self.bob])
+        # Строки платежа остаются, чтобы проверить именно флаг archived
+        Travel.objects.filter(pk=self.travel.pk).update(archived=True)
+        for name in ('payment_update', 'payment_delete'):
+            self.assertEqual(self.client.get(reverse(name, args=[self.travel.pk, payment.pk])).status_code, 404)
+
+
+class TravelCacheTests(TravelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        travel_cache.reset_stats()
+
+    def test_pages_are_cached_until_the_travel_changes(self):
+        for name, kind in (('travel_detail', 'detail'), ('summaries', 'summary')):
+            url = reverse(name, args=[self.travel.pk])
+            self.client.get(url)
+            self.client.get(url)
+            self.assertEqual(travel_cache.get_stats()[kind], {'hits': 1, 'misses': 1})
+
+        self.add_payment(self.ann, '100', [self.bob])
+        response = self.client.get(reverse('summaries', args=[self.travel.pk]))
+        self.assertEqual(travel_cache.get_stats()['summary'], {'hits': 1, 'misses': 2})
+        self.assertContains(response, '50,00')
+
+
+class ReplicaPinTests(TravelTestCase):
+
+    def pin_cookie(self, method, view):
+        request = getattr(RequestFactory(), method)('/')
+        response = ReplicaPinMiddleware(view)(request)
+        return settings.REPLICA_PIN_COOKIE in response.cookies
+
+    def test_any_method_that_writes_is_pinned(self):
+        def login_complete(request):
+            User.objects.filter(pk=self.ann.pk).update(first_name='Anna')
+            return HttpResponse()
+
+        self.assertTrue(self.pin_cookie('get', login_complete))
+
+    @mock.patch.object(routers, 'replica_configured', return_value=True)
+    def test_reads_go_to_replica_until_a_write(self, configured):
+        with routers.use_replica():
+            self.assertEqual(router.db_for_read(Payment), routers.REPLICA_ALIAS)
+            self.assertEqual(router.db_for_read(User), 'default')
+            self.assertEqual(router.db_for_write(Payment), 'default')
+            self.assertEqual(router.db_for_read(Payment), 'default')
+        self.assertEqual(router.db_for_read(Payment), 'default')
+
+    @mock.patch.object(routers, 'replica_configured', return_value=True)
+    def test_pinned_user_reads_from_primary(self, configured):
+        class ReadView(routers.ReplicaReadMixin, View):
+            def get(self, request):
+                return HttpResponse(router.db_for_read(Payment))
+
+            post = get
+
+        factory = RequestFactory()
+        self.assertEqual(ReadView.as_view()(factory.get('/')).content, routers.REPLICA_ALIAS.encode())
+        self.assertEqual(ReadView.as_view()(factory.post('/')).content, b'default')
+        factory.cookies[settings.REPLICA_PIN_COOKIE] = '1'
+        self.assertEqual(ReadView.as_view()(factory.get('/')).content, b'default')
+
+    def test_requests_without_writes_are_not_pinned(self):
+        def invalid_form(request):
+            list(Travel.objects.all())
+            return HttpResponse()
+
+        self.assertFalse(self.pin_cookie('post', invalid_form))
+        self.assertFalse(self.pin_cookie('get', invalid_form))
+
+    def test_new_payment_pins_reads(self):
+        response = self.client.post(reverse('new_payment', args=[self.travel.pk]),
+                                    {'title': 'hotel', 'value': '100', 'payer': self.ann.pk, 'debitors': [self.bob.pk],
+                                     'currency': 'RUR', 'date': '2021-01-02'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+        self.assertNotIn(settings.REPLICA_PIN_COOKIE, self.client.get(reverse('travels_list')).cookies)
+
+
+class MetricsTests(TravelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        registry.reset()
+
+    def test_request_is_recorded(self):
+        self.add_payment(self.ann, '100', [self.bob])
+        self.client.get(reverse('travels_list'))
+        stats = registry.views['travels_list']
+        self.assertEqual(stats.requests, 1)
+        self.assertGreater(stats.queries, 0)
+        self.assertEqual(sum(stats.latency), 1)
+        self.assertEqual(sum(stats.query_counts), 1)
+
+        self.client.get(reverse('travels_list'))
+        self.assertEqual(registry.views['travels_list'].requests, 2)
+
+    def test_metrics_page_is_staff_only(self):
+        self.client.get(reverse('travels_list'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 302)
+
+        User.objects.filter(pk=self.ann.pk).update(is_staff=True)
+        response = self.client.get(reverse('metrics'))
+        self.assertContains(response, 'http_requests_total{view="travels_list"} 1')
+        self.assertContains(response, 'db_queries_per_request_count{view="travels_list"} 1')
+
+
+class ProfilingTests(TravelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def profile(self, **kwargs):
+        with self.settings(PROFILING_DIR=self.directory):
+            return self.client.get(reverse('travels_list'), **kwargs)
+
+    def test_profile_is_ignored_for_non_staff(self):
+        self.assertNotIn('X-Profile-Id', self.profile(data={'profile': '1'}))
+        self.assertNotIn('X-Profile-Id', self.profile(HTTP_X_PROFILE='1'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_staff_request_is_profiled(self):
+        User.objects.filter(pk=self.ann.pk).update(is_staff=True)
+        self.assertNotIn('X-Profile-Id', self.profile())
+        name = self.profile(data={'profile': '1'})['X-Profile-Id']
+        self.assertEqual(sorted(os.listdir(self.directory)), [f'{name}.json', f'{name}.prof'])
+
+
+class CompressionTests(TravelTestCase):
+
+    def test_gzip_page_still_answers_304(self):
+        self.add_payment(self.ann, '100', [self.bob])
+        url = reverse('travel_detail', args=[self.travel.pk])
+        plain = self.client.get(url)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(response['ETag'], 'W/' + plain['ETag'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        cached = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b'')
+
+    def test_unaccepted_encoding_is_not_used(self):
+        url = reverse('travel_detail', args=[self.travel.pk])
+        self.assertNotIn('Content-Encoding', self.client.get(url))
+        self.assertNotIn('Content-Encoding', self.client.get(url, HTTP_ACCEPT_ENCODING='gzip;q=0'))
+
+
+class PaymentsPageTests(TravelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ids = [self.add_payment(self.ann, str(value), [self.bob]).pk for value in range(1, 6)]
+        self.travelers = {self.ann.pk: self.ann, self.bob.pk: self.bob}
+
+    def page(self, **kwargs):
+        payments, prev_cursor, next_cursor = sf.travel_payments(self.travel.pk, self.travelers, size=2, **kwargs)
+        return [payment['id'] for payment in payments], prev_cursor, next_cursor
+
+    def test_forward(self):
+        ids = self.ids
+        self.assertEqual(self.page(), (ids[:2], None, ids[1]))
+        self.assertEqual(self.page(after=ids[1]), (ids[2:4], ids[2], ids[3]))
+        self.assertEqual(self.page(after=ids[3]), (ids[4:], ids[4], None))
+        self.assertEqual(self.page(after=ids[4]), ([], None, None))
+
+    def test_backward(self):
+        ids = self.ids
+        self.assertEqual(self.page(before=ids[4]), (ids[2:4], ids[2], ids[3]))
+        self.assertEqual(self.page(before=ids[2]), (ids[:2], None, ids[1]))
+        self.assertEqual(self.page(before=ids[0]), ([], None, None))
+
+    def test_page_is_same_in_archive(self):
+        pages = [self.page(), self.page(after=self.ids[1]), self.page(before=self.ids[2]), self.page(after=self.ids[4])]
+        archive.archive_travel(self.travel.pk)
+        self.assertEqual([self.page(archived=True), self.page(after=self.ids[1], archived=True),
+                          self.page(before=self.ids[2], archived=True), self.page(after=self.ids[4], archived=True)],
+                         pages)
+
+    def test_invalid_cursors(self):
+        url = reverse('travel_detail', args=[self.travel.pk])
+        for cursor in ('', 'x', '-1', '²', str(2 ** 63), '9' * 30):
+            response = self.client.get(url, {'after': cursor, 'before': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([payment['id'] for payment in response.context['payments_list']], self.ids)
+
+
+class SyncTests(TravelTestCase):
+
+    def item(self, key, value='100'):
+        return {'key': key, 'title': 'hotel', 'value': value, 'payer': self.ann.pk, 'debitors': [self.bob.pk],
+                'date': '2021-01-02'}
+
+    def test_push_is_idempotent(self):
+        first = sync.push(self.travel, [self.item('a'), self.item('b', '50')])
+        self.assertEqual([result['created'] for result in first['results']], [True, True])
+        # Повтор после потерянного ответа: те же id, ничего не записывается, версия не меняется
+        second = sync.push(self.travel, [self.item('b', '50'), self.item('a'), self.item('a')])
+        self.assertEqual([(result['key'], result['id'], result['created']) for result in second['results']],
+                         [('b', first['results'][1]['id'], False), ('a', first['results'][0]['id'], False)])
+        self.assertEqual(second['version'], first['version'])
+        self.assertEqual(Payment.objects.filter(travel=self.travel).count(), 2)
+        self.assertEqual(ledger.get_balances(self.travel.pk), {self.ann.pk: Decimal('75.00'),
+                                                               self.bob.pk: Decimal('-75.00')})
+
+    def test_pull_returns_changes_and_tombstones(self):
+        pushed = sync.push(self.travel, [self.item('a'), self.item('b')])
+        self.travel.refresh_from_db()
+        start = sync.pull(self.travel)
+        self.assertEqual([payment['key'] for payment in start['payments']], ['a', 'b'])
+        self.assertEqual(start['payments'][0]['debitors'], [self.bob.pk])
+
+        ledger.delete_payment(Payment.objects.get(pk=pushed['results'][0]['id']))
+        self.travel.refresh_from_db()
+        changes = sync.pull(self.travel, start['cursor'])
+        self.assertEqual(changes['payments'], [])
+        self.assertEqual(changes['deleted'], [pushed['results'][0]['id']])
+        self.assertEqual(sync.pull(self.travel, changes['cursor'])['deleted'], [])
+
+    def test_pull_pages_inside_one_version(self):
+        sync.push(self.travel, [self.item(key) for key in 'abcde'])
+        self.travel.refresh_from_db()
+        keys, cursor, more = [], None, True
+        while more:
+            page = sync.pull(self.travel, cursor, limit=2)
+            keys += [payment['key'] for payment in page['payments']]
+            cursor, more = page['cursor'], page['more']
+        self.assertEqual(keys, list('abcde'))
+        self.assertEqual(cursor, str(self.travel.version))
+
+    def test_invalid_cursor(self):
+        url = reverse('api_payments', args=[self.travel.pk])
+        for cursor in ('x', '1.x', '-1', '1.-1', str(2 ** 63), f'1.{2 ** 63}'):
+            response = self.client.get(url, {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertIn('error', json.loads(response.content))
+
+
+class LiveStreamTests(TransactionTestCase):
+    # on_commit в TestCase не срабатывает, а поток получает события только после коммита
+
+    def setUp(self):
+        self.ann = User.objects.create_user('ann')
+        self.bob = User.objects.create_user('bob')
+        self.cid = User.objects.create_user('cid')
+        self.travel = Travel.objects.create(title='Kazan', start_date=datetime.date(2021, 1, 1),
+                                            end_date=datetime.date(2021, 1, 5))
+        self.travel.travelers.add(self.ann, self.bob)
+
+    def login(self, user):
+        self.client.force_login(user)
+        return [(b'cookie', f'{settings.SESSION_COOKIE_NAME}={self.client.session.session_key}'.encode())]
+
+    async def connect(self, user=None):
+        headers = [] if user is None else await sync_to_async(self.login)(user)
+        scope = {'type': 'http', 'method': 'GET', 'path': f'/travel_detail/{self.travel.pk}/events',
+                 'query_string': b'', 'headers': headers}
+        communicator = ApplicationCommunicator(live.stream, scope)
+        await communicator.send_input({'type': 'http.request'})
+        return communicator
+
+    def add_payment(self, value):
+        payment = Payment(title='hotel', value=Decimal(value), payer=self.ann, travel_id=self.travel.pk)
+        ledger.record_payment(payment, [self.bob])
+        return payment
+
+    def rollback_payment(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.add_payment('10')
+            raise IntegrityError
+
+    async def test_rejects_anonymous_and_foreign_users(self):
+        for user, status in ((None, 401), (self.cid, 404)):
+            communicator = await self.connect(user)
+            response = await communicator.receive_output()
+            self.assertEqual(response['status'], status)
+            await communicator.wait()
+
+    async def test_one_event_per_committed_write(self):
+        communicator = await self.connect(self.ann)
+        response = await communicator.receive_output()
+        self.assertEqual(response['status'], 200)
+        # Записей после подключения не было - событий тоже
+        self.assertTrue(await communicator.receive_nothing())
+
+        for value, balance in (('100', '50.00'), ('50', '75.00')):
+            payment = await sync_to_async(self.add_payment)(value)
+            body = (await communicator.receive_output())['body'].decode()
+            self.assertTrue(body.startswith('event: ledger\n'))
+            data = json.loads(body.split('data: ', 1)[1])
+            self.assertEqual([payment['id'] for payment in data['payments']], [payment.pk])
+            self.assertEqual(data['balances'], {str(self.ann.pk): balance, str(self.bob.pk): '-' + balance})
+            self.assertTrue(await communicator.receive_nothing())
+
+        # Откаченная запись событий не порождает
+        await sync_to_async(self.rollback_payment)()
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait()
+
+    async def test_disconnect_unsubscribes(self):
+        communicator = await self.connect(self.ann)
+        await communicator.receive_output()
+        self.assertIn(self.travel.pk, events.get_broker().subscribers)
+
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait(timeout=1)
+        self.assertNotIn(self.travel.pk, events.get_broker().subscribers)
+        # После отключения запись не должна никуда отправляться
+        await sync_to_async(self.add_payment)('100')
+        self.assertTrue(await communicator.receive_nothing())
+
+
+class SearchTests(TravelTestCase):
+
+    def test_search_pages(self):
+        self.add_payment(self.ann, '100', [self.bob])
+        response = self.client.get(reverse('search'), {'q': 'hot'})
+        self.assertEqual([hit.kind for hit, _ in response.context['results']], ['payment'])
+        for page in ('0', '²', str(2 ** 63)):
+            response = self.client.get(reverse('search'), {'q': 'hot', 'page': page})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['page'], 1)
+
+    def test_foreign_travels_are_not_found(self):
+        self.add_payment(self.ann, '100', [self.bob])
+        self.client.force_login(self.cid)
+        response = self.client.get(reverse('search'), {'q': 'hot'})
+        self.assertEqual(response.context['results'], [])
+
+    def test_archived_payments_are_not_found(self):
+        payment = self.add_payment(self.ann, '100', [self.bob])
+        archive.archive_travel(self.travel.pk)
+        self.assertEqual([(hit.kind, hit.id) for hit in search.search(self.ann, 'kazan')[0]],
+                         [('travel', self.travel.pk)])
+        self.assertEqual(search.search(self.ann, 'hotel'), ([], False))
+        self.assertContains(self.client.get(reverse('travel_detail', args=[self.travel.pk])),
+                            'не находятся поиском')
+
+        archive.restore_travel(self.travel.pk)
+        self.assertEqual([(hit.kind, hit.id) for hit in search.search(self.ann, 'hotel')[0]],
+                         [('payment', payment.pk)])
+
+    def test_other_databases_search_without_index(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            with self.assertLogs('payments_logic.search', 'WARNING'):
+                search.ensure_index()
+
+            self.assertEqual(search.search(self.ann, 'hot'), ([], False))
+            payments = [self.add_payment(self.ann, '100', [self.bob]) for _ in range(3)]
+            other = Travel.objects.create(title='Hotels of Kazan', start_date=datetime.date(2021, 2, 1),
+                                          end_date=datetime.date(2021, 2, 2))
+            other.travelers.add(self.ann)
+            foreign = Travel.objects.create(title='Hotel', start_date=datetime.date(2021, 2, 1),
+                                            end_date=datetime.date(2021, 2, 2))
+            foreign.travelers.add(self.cid)
+
+            hits, has_next = search.search(self.ann, 'HOT', page_size=3)
+            self.assertEqual([(hit.kind, hit.id, hit.travel_id) for hit in hits],
+                             [('travel', other.pk, other.pk), ('payment', payments[2].pk, self.travel.pk),
+                              ('payment', payments[1].pk, self.travel.pk)])
+            self.assertTrue(has_next)
+            hits, has_next = search.search(self.ann, 'hot', page=2, page_size=3)
+            self.assertEqual([hit.id for hit in hits], [payments[0].pk])
+            self.assertFalse(has_next)
+            self.assertEqual([hit.id for hit in search.search(self.ann, 'hotels kaz')[0]], [other.pk])
+
+
+class LedgerTests(TravelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.travel.travelers.add(self.cid)
+        ExchangeRate.objects.create(currency='EUR', date=datetime.date(2021, 1, 2), rate=Decimal('90'))
+        ExchangeRate.objects.create(currency='USD', date=datetime.date(2021, 1, 2), rate=Decimal('75'))
+        fx.clear_cache()
+
+    def balances(self):
+        return {user_id: amount for user_id, amount in ledger.get_balances(self.travel.pk).items() if amount}
+
+    def test_record_splits_between_payer_and_debitors(self):
+        self.add_payment(self.ann, '100', [self.ann, self.bob, self.cid])
+        self.assertEqual(self.balances(), {self.ann.pk: Decimal('66.66'), self.bob.pk: Decimal('-33.33'),
+                                           self.cid.pk: Decimal('-33.33')})
+        self.assertEqual(sorted(Debt.objects.values_list('debitor_id', 'value')),
+                         sorted([(self.ann.pk, Decimal('-33.33')), (self.bob.pk, Decimal('33.33')),
+                                 (self.cid.pk, Decimal('33.33'))]))
+
+    def test_record_converts_to_travel_currency(self):
+        self.add_payment(self.bob, '10', [self.ann], currency='EUR', date=datetime.date(2021, 1, 2))
+        self.assertEqual(self.balances(), {self.ann.pk: Decimal('-450.00'), self.bob.pk: Decimal('450.00')})
+
+    def test_missing_rate_records_nothing(self):
+        with self.assertRaises(fx.MissingRateError):
+            self.add_payment(self.bob, '10', [self.ann], currency='EUR', date=datetime.date(2020, 1, 2))
+        self.assertFalse(Payment.objects.exists())
+
+    def test_update_applies_difference(self):
+        payment = self.add_payment(self.ann, '100', [self.bob, self.cid])
+        payment.value, payment.payer, payment.currency = Decimal('20'), self.bob, 'USD'
+        payment.date = datetime.date(2021, 1, 2)
+        ledger.update_payment(payment, [self.ann])
+        self.assertEqual(self.balances(), {self.ann.pk: Decimal('-750.00'), self.bob.pk: Decimal('750.00')})
+        self.assertEqual(sorted(Debt.objects.values_list('debitor_id', 'value')),
+                         [(self.ann.pk, Decimal('10.00')), (self.bob.pk, Decimal('-10.00'))])
+
+    def test_delete_reverts_payment(self):
+        kept = self.add_payment(self.ann, '30', [self.bob])
+        deleted = self.add_payment(self.cid, '10', [self.ann, self.bob], currency='EUR',
+                                   date=datetime.date(2021, 1, 2))
+        deleted_id = deleted.pk
+        ledger.delete_payment(deleted)
+        self.assertEqual(self.balances(), {self.ann.pk: Decimal('15.00'), self.bob.pk: Decimal('-15.00')})
+        self.assertEqual(list(PaymentTombstone.objects.values_list('payment_id', flat=True)), [deleted_id])
+        self.assertTrue(Payment.objects.filter(pk=kept.pk).exists())
+
+    def test_no_drift_after_mixed_operations(self):
+        first = self.add_payment(self.ann, '100', [self.ann, self.bob, self.cid])
+        second = self.add_payment(self.bob, '10.01', [self.ann, self.cid], currency='EUR',
+                                  date=datetime.date(2021, 1, 2))
+        self.add_payment(self.cid, '7', [])
+        ledger.bulk_record_payments(self.travel.pk, [[
+            ledger.PaymentRow('taxi', Decimal('33.33'), self.cid.pk, [self.ann.pk, self.bob.pk], 'USD',
+                              datetime.date(2021, 1, 2)),
+            ledger.PaymentRow('lunch', Decimal('12'), self.ann.pk, [self.cid.pk], 'RUR', datetime.date(2021, 1, 3))]])
+        first.value = Decimal('99.99')
+        ledger.update_payment(first, [self.bob])
+        ledger.delete_payment(second)
+        self.assertEqual(ledger.find_drift([self.travel.pk]), [])
+        self.assertEqual(sum(self.balances().values()), 0)
+
+    def test_rebuild_fixes_drift(self):
+        self.add_payment(self.ann, '100', [self.bob])
+        TravelBalance.objects.filter(user=self.bob).update(amount=0)
+        self.assertEqual(ledger.find_drift([self.travel.pk]),
+                         [(self.travel.pk, self.bob.pk, Decimal('0.00'), Decimal('-50.00'))])
+        ledger.rebuild_balances([self.travel.pk])
+        self.assertEqual(ledger.find_drift([self.travel.pk]), [])
+
+
+class FriendsTests(TravelTestCase):
+
+    def friend_names(self, user):
+        return sorted(Friendship.objects.filter(creator=user).values_list('friend__username', flat=True))
+
+    def test_new_users_are_created(self):
+        User.objects.create_user('dan', email='dan@old.example')
+        result = friends.add_friends(self.ann, [('Dan', 'dan@example.com'), ('Eve', 'eve@example.com')])
+        self.assertEqual(result, {'created_users': 2, 'created_friendships': 2, 'added_travelers': 0})
+        eve = User.objects.get(email='eve@example.com')
+        self.assertEqual((eve.username, eve.first_name, eve.has_usable_password()), ('eve', 'Eve', False))
+        # Занятый логин получает суффикс
+        self.assertTrue(User.objects.get(email='dan@example.com').username.startswith('dan-'))
+
+    def test_existing_emails_are_reused(self):
+        User.objects.filter(pk=self.bob.pk).update(email='Bob@Example.com')
+        result = friends.add_friends(self.ann, [('Bobby', 'bob@example.COM'), ('Bob again', 'BOB@example.com')])
+        self.assertEqual(result, {'created_users': 0, 'created_friendships': 1, 'added_travelers': 0})
+        self.assertEqual(self.friend_names(self.ann), ['bob'])
+
+    def test_duplicate_friendships_are_skipped(self):
+        User.objects.filter(pk=self.ann.pk).update(email='ann@example.com')
+        User.objects.filter(pk=self.bob.pk).update(email='bob@example.com')
+        people = [('Bob', 'bob@example.com'), ('Ann', 'ann@example.com')]
+        first = friends.add_friends(self.ann, people)
+        second = friends.add_friends(self.ann, people)
+        self.assertEqual(first['created_friendships'], 1)
+        self.assertEqual(second, {'created_users': 0, 'created_friendships': 0, 'added_travelers': 0})
+        # Себя в друзья не добавляем
+        self.assertEqual(self.friend_names(self.ann), ['bob'])
+
+    def test_friends_join_travel(self):
+        User.objects.filter(pk=self.bob.pk).update(email='bob@example.com')
+        result = friends.add_friends(self.ann, [('Bob', 'bob@example.com'), ('Eve', 'eve@example.com')], self.travel)
+        self.assertEqual(result['added_travelers'], 1)
+        self.assertEqual(sorted(self.travel.travelers.values_list('username', flat=True)), ['ann', 'bob', 'eve'])
+
+    def test_too_many_friends(self):
+        with self.assertRaises(friends.FriendsError):
+            friends.add_friends(self.ann, [('X', f'x{i}@example.com') for i in range(friends.MAX_FRIENDS + 1)])
+
+    def test_form_adds_to_travel(self):
+        response = self.client.post(reverse('new_friends'), {'people': 'Eve, eve@example.com\nDan <dan@example.com>',
+                                                             'travel': self.travel.pk})
+        self.assertRedirects(response, reverse('travel_detail', args=[self.travel.pk]), fetch_redirect_response=False)
+        self.assertEqual(self.travel.travelers.count(), 4)
+
+    def test_api(self):
+        response = self.client.post(reverse('api_friends'), {'friends': [{'name': 'Eve', 'email': 'eve@example.com'}],
+                                                             'travel': self.travel.pk},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content),
+                         {'created_users': 1, 'created_friendships': 1, 'added_travelers': 1})
+
+    def test_api_bad_payloads(self):
+        friend = {'name': 'Eve', 'email': 'eve@example.com'}
+        for body in ('not json', [], {'friends': 'eve'}, {'friends': [5]}, {'friends': [{'name': 'Eve'}]},
+                     {'friends': [friend], 'travel': 'abc'}, {'friends': [friend], 'travel': 2 ** 63},
+                     {'friends': [friend], 'travel': 0}, {'friends': [friend], 'travel': True},
+                     {'friends': [friend], 'travel': 1.5}):
+            data = body if isinstance(body, str) else json.dumps(body)
+            response = self.client.post(reverse('api_friends'), data, content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        self.assertFalse(User.objects.filter(email='eve@example.com').exists())
+
+    def test_api_foreign_travel(self):
+        self.client.force_login(self.cid)
+        response = self.client.post(reverse('api_friends'),
+                                    {'friends': [{'name': 'Eve', 'email': 'eve@example.com'}], 'travel': self.travel.pk},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.travel.travelers.count(), 2)
+
+
+class SummaryTests(TravelTestCase):
+    day = datetime.date(2021, 1, 2)
+
+    def test_missing_rate(self):
+        # Платеж в евро, записанный до того, как курс пропал из таблицы
+        ExchangeRate.objects.create(currency='EUR', date=self.day, rate=Decimal('90'))
+        fx.clear_cache()
+        self.add_payment(self.ann, '10', [self.bob], currency='EUR', date=self.day)
+        ExchangeRate.objects.all().delete()
+        fx.clear_cache()
+        response = self.client.get(reverse('summaries', args=[self.travel.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Нет курса EUR к RUR')
+        # Сокращенные итоги берутся из TravelBalance, курс им не нужен
+        response = self.client.get(reverse('summaries', args=[self.travel.pk]), {'simplify': '1'})
+        self.assertContains(response, '450,00')
+
+    def test_rate_correction_refreshes_cached_summary(self):
+        load_rates(self, [(self.day, 'EUR', '90')])
+        self.add_payment(self.ann, '10', [self.bob], currency='EUR', date=self.day)
+        self.assertContains(self.client.get(reverse('summaries', args=[self.travel.pk])), '450,00')
+        version = Travel.objects.get(pk=self.travel.pk).version
+        load_rates(self, [(self.day, 'EUR', '100')])
+        self.assertGreater(Travel.objects.get(pk=self.travel.pk).version, version)
+        self.assertContains(self.client.get(reverse('summaries', args=[self.travel.pk])), '500,00')
+
+    def test_unrelated_rates_keep_version(self):
+        version = Travel.objects.get(pk=self.travel.pk).version
+        load_rates(self, [(datetime.date(2019, 1, 1), 'EUR', '70')])
+        self.assertEqual(Travel.objects.get(pk=self.travel.pk).version, version)
+
+
+class SettlementTests(TravelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.travel.travelers.add(self.cid)
+        self.dan = User.objects.create_user('dan', first_name='Dan')
+        self.travel.travelers.add(self.dan)
+        self.add_payment(self.ann, '300', [self.ann, self.bob, self.cid])
+        self.add_payment(self.bob, '90', [self.ann, self.bob, self.cid, self.dan])
+        self.add_payment(self.cid, '50', [self.bob])
+        self.add_payment(self.ann, '40', [self.bob])
+        self.add_payment(self.dan, '99.99', [self.ann, self.cid])
+        self.add_payment(self.bob, '20', [])
+
+    def rows(self):
+        return list(Debt.objects.filter(travel=self.travel).exclude(debitor_id=F('payer_id'))
+                    .values('debitor_id', 'payer_id').annotate(total=Sum('value')).order_by())
+
+    def test_pairwise_matches_old_summary(self):
+        old = sf.get_summary(list(Debt.objects.filter(source__travel=self.travel)
+                                  .exclude(debitor_id=F('source__payer_id'))
+                                  .values('debitor__username', 'source__payer__username')
+                                  .annotate(total=Sum('value')).order_by()))
+        new = sf.settle(self.rows())
+        self.assertEqual(sorted((row['debitor'].pk, row['payer'].pk, row['total']) for row in new),
+                         sorted((row['debitor'].pk, row['payer'].pk, row['total']) for row in old))
+        self.assertEqual(len(new), 6)
+
+    def test_net_balances_match_ledger(self):
+        self.assertEqual({user_id: amount for user_id, amount in sf.net_balances(self.rows()).items() if amount},
+                         {user_id: amount for user_id, amount in ledger.get_balances(self.travel.pk).items() if amount})
+
+    def test_minimal_transfers_invariants(self):
+        balances = sf.net_balances(self.rows())
+        transfers = sf.minimal_transfers(balances)
+        paid = {}
+        for debitor, payer, total in transfers:
+            self.assertNotEqual(debitor, payer)
+            self.assertGreater(total, 0)
+            paid[debitor] = paid.get(debitor, 0) - total
+            paid[payer] = paid.get(payer, 0) + total
+        self.assertEqual({user_id: amount for user_id, amount in paid.items() if amount},
+                         {user_id: amount for user_id, amount in balances.items() if amount})
+        self.assertLessEqual(len(transfers), len([amount for amount in balances.values() if amount]) - 1)
+
+    def test_settled_travelers_need_no_transfers(self):
+        self.assertEqual(sf.minimal_transfers({self.ann.pk: Decimal('0'), self.bob.pk: Decimal('0')}), [])
+        self.assertEqual(sf.settle([{'debitor_id': self.ann.pk, 'payer_id': self.bob.pk, 'total': Decimal('5')},
+                                    {'debitor_id': self.bob.pk, 'payer_id': self.ann.pk, 'total': Decimal('5')}]), [])
+
+    def test_summary_page(self):
+        response = self.client.get(reverse('summaries', args=[self.travel.pk]), {'simplify': '1'})
+        self.assertEqual([(row['debitor'].pk, row['payer'].pk, row['total']) for row in response.context['summary']],
+                         sf.minimal_transfers(ledger.get_balances(self.travel.pk)))
+
+
+class GlobalBalancesTests(TravelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sochi = Travel.objects.create(title='Sochi', start_date=datetime.date(2021, 6, 1),
+                                           end_date=datetime.date(2021, 6, 5))
+        self.sochi.travelers.add(self.ann, self.bob, self.cid)
+
+    def settlement(self, currency='RUR', simplify=False):
+        return [(row['debitor'].username, row['payer'].username, row['total'])
+                for row in sf.global_settlement(self.ann, currency, simplify)]
+
+    def test_pairs_are_netted_across_travels(self):
+        self.add_payment(self.bob, '100', [self.ann])
+        self.add_payment(self.ann, '60', [self.bob], travel=self.sochi)
+        self.assertEqual(self.settlement(), [('ann', 'bob', Decimal('20.00'))])
+
+    def test_foreign_travels_and_pairs_are_excluded(self):
+        other = Travel.objects.create(title='Omsk', start_date=datetime.date(2021, 3, 1),
+                                      end_date=datetime.date(2021, 3, 2))
+        other.travelers.add(self.bob, self.cid)
+        self.add_payment(self.bob, '100', [self.ann])
+        self.add_payment(self.cid, '100', [self.ann], travel=other)
+        self.add_payment(self.cid, '80', [self.bob], travel=self.sochi)
+        self.assertEqual(self.settlement(), [('ann', 'bob', Decimal('50.00'))])
+
+    def test_archived_travels_are_included(self):
+        self.add_payment(self.bob, '100', [self.ann])
+        self.add_payment(self.ann, '60', [self.bob], travel=self.sochi)
+        archive.archive_travel(self.travel.pk)
+        self.assertEqual(self.settlement(), [('ann', 'bob', Decimal('20.00'))])
+        self.assertEqual(self.settlement(simplify=True), [('ann', 'bob', Decimal('20.00'))])
+
+    def test_simplify_shortens_chains(self):
+        self.add_payment(self.bob, '100', [self.ann], travel=self.sochi)
+        self.add_payment(self.cid, '100', [self.bob], travel=self.sochi)
+        self.assertEqual(sorted(self.settlement()), [('ann', 'bob', Decimal('50.00'))])
+        self.assertEqual(self.settlement(simplify=True), [('ann', 'cid', Decimal('50.00'))])
+
+    def test_other_currency(self):
+        day = datetime.date(2021, 1, 2)
+        ExchangeRate.objects.create(currency='EUR', date=day, rate=Decimal('100'))
+        fx.clear_cache()
+        self.add_payment(self.bob, '1000', [self.ann], date=day)
+        self.assertEqual(self.settlement('EUR'), [('ann', 'bob', Decimal('5.00'))])
+
+    def test_missing_rate(self):
+        self.add_payment(self.bob, '1000', [self.ann])
+        response = self.client.get(reverse('global_balances'), {'currency': 'EUR'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Нет курса')
+        response = self.client.get(reverse('global_balances'), {'currency': 'RUR', 'simplify': '1'})
+        self.assertEqual([(row['debitor'], row['payer'], row['total']) for row in response.context['summary']],
+                         [(self.ann, self.bob, Decimal('500.00'))])
+
+
+class ConditionalTests(TravelTestCase):
+
+    def test_unchanged_travel_answers_304(self):
+        url = reverse('travel_detail', args=[self.travel.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+    def test_payment_changes_etag(self):
+        url = reverse('summaries', args=[self.travel.pk])
+        etag = self.client.get(url)['ETag']
+        self.add_payment(self.ann, '100', [self.bob])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, '50,00')
+
+    def test_users_get_different_etags(self):
+        url = reverse('travel_detail', args=[self.travel.pk])
+        etag = self.client.get(url)['ETag']
+        self.client.force_login(self.bob)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_travels_list_answers_304(self):
+        url = reverse('travels_list')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.add_payment(self.ann, '100', [self.bob])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_foreign_travel_is_not_found(self):
+        etag = self.client.get(reverse('travel_detail', args=[self.travel.pk]))['ETag']
+        self.client.force_login(self.cid)
+        for name in ('travel_detail', 'summaries'):
+            url = reverse(name, args=[self.travel.pk])
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 404)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT').status_code,
+                             404)
+
+
+class AnalyticsTests(TravelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        day = datetime.date(2021, 1, 2)
+        ExchangeRate.objects.create(currency='EUR', date=day, rate=Decimal('90'))
+        fx.clear_cache()
+        self.add_payment(self.ann, '100', [self.ann, self.bob], date=day)
+        self.add_payment(self.bob, '1', [self.ann], currency='EUR', date=day)
+        # Без должников платеж целиком - доля плательщика
+        self.add_payment(self.bob, '30', [], date=datetime.date(2021, 1, 3))
+
+    def spending(self):
+        travel = Travel.objects.get(pk=self.travel.pk)
+        return analytics.travel_spending(travel, [self.ann, self.bob])
+
+    def test_totals(self):
+        spending = self.spending()
+        self.assertEqual(spending['currency'], 'RUR')
+        self.assertEqual(spending['total'], Decimal('220.00'))
+        self.assertEqual(spending['days'], [(datetime.date(2021, 1, 2), Decimal('190.00'), 2),
+                                            (datetime.date(2021, 1, 3), Decimal('30.00'), 1)])
+        self.assertEqual(spending['payers'], [(self.bob.pk, 'Bob', Decimal('120.00')),
+                                              (self.ann.pk, 'Ann', Decimal('100.00'))])
+        self.assertEqual(spending['shares'], [(self.bob.pk, 'Bob', Decimal('125.00')),
+                                              (self.ann.pk, 'Ann', Decimal('95.00'))])
+
+    def test_archived_snapshot_gives_same_numbers(self):
+        spending = self.spending()
+        archive.archive_travel(self.travel.pk)
+        self.assertEqual(self.spending(), spending)
+
+    def test_json(self):
+        response = self.client.get(reverse('travel_analytics_json', args=[self.travel.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content),
+                         {'currency': 'RUR', 'total': '220.00',
+                          'days': [['2021-01-02', '190.00', 2], ['2021-01-03', '30.00', 1]],
+                          'payers': [[self.bob.pk, 'Bob', '120.00'], [self.ann.pk, 'Ann', '100.00']],
+                          'shares': [[self.bob.pk, 'Bob', '125.00'], [self.ann.pk, 'Ann', '95.00']]})
+
+    def test_missing_rate(self):
+        ExchangeRate.objects.all().delete()
+        fx.clear_cache()
+        response = self.client.get(reverse('travel_analytics_json', args=[self.travel.pk]))
+        self.assertEqual(response.status_code, 400)
+        self.assertContains(self.client.get(reverse('travel_analytics', args=[self.travel.pk])), 'Нет курса',
+                            status_code=200)
+
+    def test_foreign_travel(self):
+        self.client.force_login(self.cid)
+        for name in ('travel_analytics', 'travel_analytics_json'):
+            self.assertEqual(self.client.get(reverse(name, args=[self.travel.pk])).status_code, 404)
+
+
+class SharedQuerysetsTests(TravelTestCase):
+
+    def test_payment_pages_query_count(self):
+        payment = self.add_payment(self.ann, '100', [self.bob])
+        new_url = reverse('new_payment', args=[self.travel.pk])
+        update_url = reverse('payment_update', args=[self.travel.pk, payment.pk])
+        self.client.get(new_url)
+        # Сессия, пользователь, путешествие; участники - из кэша
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get(new_url).status_code, 200)
+        # Сессия, пользователь, платеж вместе с путешествием, должники
+        with self.assertNumQueries(4):
+            self.assertEqual(self.client.get(update_url).status_code, 200)
+
+    def test_travelers_are_shared_and_invalidated(self):
+        travel = Travel.objects.get(pk=self.travel.pk)
+        self.assertEqual(travel_cache.get_travelers(travel), [self.ann, self.bob])
+        with self.assertNumQueries(0):
+            travel_cache.get_travelers(travel)
+        self.travel.travelers.add(self.cid)
+        travel.refresh_from_db()
+        self.assertEqual(travel_cache.get_travelers(travel), [self.ann, self.bob, self.cid])
+
+    def test_friends_are_invalidated(self):
+        self.assertEqual(travel_cache.get_friends(self.ann), [self.ann])
+        Friendship.objects.create(creator=self.ann, friend=self.bob)
+        self.assertEqual(sorted(travel_cache.get_friends(self.ann), key=lambda user: user.pk), [self.ann, self.bob])
+
+    def test_duplicate_friendship_is_rejected(self):
+        Friendship.objects.create(creator=self.ann, friend=self.bob)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Friendship.objects.create(creator=self.ann, friend=self.bob)
+        Friendship.objects.create(creator=self.bob, friend=self.ann)
+
+    def test_dedup_friendships_keeps_unique_rows(self):
+        Friendship.objects.create(creator=self.ann, friend=self.bob)
+        Friendship.objects.create(creator=self.ann, friend=self.cid)
+        out = StringIO()
+        call_command('dedup_friendships', stdout=out)
+        self.assertIn('Удалено повторов: 0', out.getvalue())
+        self.assertEqual(Friendship.objects.count(), 2)
@@ -5,11 +5,31 @@ from . import views
 urlpatterns = [
     path('', views.TravelsList.as_view(), name='travels_list'),
     path('about', views.about_page, name='about'),
+    path('cache_stats', views.cache_stats, name='cache_stats'),
+    path('metrics', views.metrics, name='metrics'),
+    path('api/travels', views.api_travels, name='api_travels'),
+    path('api/friends', views.api_friends, name='api_friends'),
+    path('api/travels/<int:pk>/payments', views.api_payments, name='api_payments'),
+    path('profiles/', views.profiles_list, name='profiles_list'),
+    path('profiles/<str:name>', views.profile_detail, name='profile_detail'),
     path('new_travel', views.CreateTravel.as_view(), name='new_travel'),
     path('new_person', views.NewPerson.as_view(), name='new_person'),
+    path('new_friends', views.NewFriends.as_view(), name='new_friends'),
     path('travel_detail/<int:pk>/', views.TravelDetail.as_view(), name='travel_detail'),
     path('travel_detail/<int:pk>/delete', views.DeleteTravel.as_view(), name='travel_delete'),
     path('travel_detail/<int:pk>/update', views.UpdateTravel.as_view(), name='travel_update'),
     path('travel_detail/<int:travel_pk>/new_payment', views.AddPayment.as_view(), name='new_payment'),
+    path('travel_detail/<int:travel_pk>/payment/<int:pk>/update', views.UpdatePayment.as_view(),
+         name='payment_update'),
+    path('travel_detail/<int:travel_pk>/payment/<int:pk>/delete', views.DeletePayment.as_view(),
+         name='payment_delete'),
+    path('travel_detail/<int:travel_pk>/import', views.ImportPayments.as_view(), name='import_payments'),
+    path('travel_detail/<int:pk>/export.<str:fmt>', views.ExportLedger.as_view(), name='travel_export'),
+    path('balances', views.GlobalBalances.as_view(), name='global_balances'),
+    path('search', views.Search.as_view(), name='search'),
+    path('export.<str:fmt>', views.ExportLedger.as_view(), name='export'),
     path('travel_detail/<int:pk>/summary', views.SummaryPaymentsAndDebts.as_view(), name='summaries'),
+    path('travel_detail/<int:pk>/analytics', views.TravelAnalytics.as_view(), name='travel_analytics'),
+    path('travel_detail/<int:pk>/analytics.json', views.TravelAnalytics.as_view(fmt='json', etag_kind='analytics-json'),
+         name='travel_analytics_json'),
 ]
@@ -1,99 +1,272 @@
-import uuid
+import io
+import json
+from functools import wraps
 
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.contrib.auth.models import AnonymousUser, User
-from django.db import connection
+from django.contrib.auth.models import AnonymousUser
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Sum, Q, F
-from django.shortcuts import reverse, HttpResponseRedirect, render
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, Http404
+from django.shortcuts import reverse, HttpResponseRedirect, render, get_object_or_404
 from django.urls import reverse_lazy
-from django.views.generic import CreateView, DetailView, ListView, UpdateView, DeleteView, FormView
-
+from django.utils.cache import patch_cache_control
+from django.views import static
+from django.views.generic import (View, CreateView, DetailView, ListView, UpdateView, DeleteView, FormView,
+                                  TemplateView)
+
+import payments_logic.analytics as analytics
+import payments_logic.archive as archive
+import payments_logic.cache as travel_cache
+import payments_logic.conditional as conditional
+import payments_logic.export as export
+import payments_logic.friends as friends
+import payments_logic.fx as fx
+import payments_logic.importer as importer
+import payments_logic.ledger as ledger
+import payments_logic.profiling as profiling
+import payments_logic.routers as routers
+import payments_logic.search as search
 import payments_logic.service_functions as sf
-from payments_logic.models import Travel, Debt, Payment, Friendship
-from .forms import TravelForm, PersonForm, PaymentForm
+import payments_logic.sync as sync
+from payments_logic.metrics import registry
+from payments_logic.models import Travel, Debt, Payment
+from payments_logic.storage import is_hashed
+from .forms import TravelForm, PersonForm, PaymentForm, ImportPaymentsForm, FriendsForm
 
 
 def about_page(request):
     return render(request, '../templates/about.html')
 
 
-class TravelsList(ListView):
+def static_file(request, path):
+    # Имена с хэшем содержимого неизменны: браузер держит их год и не перепроверяет
+    response = static.serve(request, path, document_root=settings.STATIC_ROOT)
+    if is_hashed(path):
+        patch_cache_control(response, public=True, max_age=365 * 24 * 3600, immutable=True)
+    return response
+
+
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse(travel_cache.get_stats())
+
+
+@staff_member_required
+def metrics(request):
+    cache_lines = ['# HELP travel_cache_requests_total Travel cache lookups by kind and result',
+                   '# TYPE travel_cache_requests_total counter']
+    for kind, kind_stats in sorted(travel_cache.get_stats().items()):
+        for result, value in sorted(kind_stats.items()):
+            cache_lines.append(f'travel_cache_requests_total{{kind="{kind}",result="{result}"}} {value}')
+    return HttpResponse(registry.render(cache_lines), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def profiles_list(request):
+    return render(request, 'profiles/profiles_list.html', {'profiles': profiling.list_profiles()})
+
+
+@staff_member_required
+def profile_detail(request, name):
+    try:
+        profile = profiling.load_profile(name)
+    except FileNotFoundError:
+        raise Http404
+    return render(request, 'profiles/profile_detail.html', {'name': name, 'profile': profile})
+
+
+def api_response(data, status=200):
+    # Компактный JSON без пробелов: мобильные клиенты синхронизируются по медленной сети
+    return JsonResponse(data, status=status, encoder=DjangoJSONEncoder,
+                        json_dumps_params={'separators': (',', ':'), 'ensure_ascii': False})
+
+
+def api_login_required(view):
+    # API отвечает 401 вместо редиректа на страницу входа
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return api_response({'error': 'Требуется вход'}, status=401)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+@api_login_required
+def api_travels(request):
+    return api_response({'travels': sync.travels_state(request.user)})
+
+
+@api_login_required
+def api_friends(request):
+    """
+    {"friends": [{"name": ..., "email": ...}, ...], "travel": id} - добавить друзей разом,
+    travel необязателен.
+    """
+    if request.method != 'POST':
+        return api_response({'error': 'Метод не поддерживается'}, status=405)
+    try:
+        body = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return api_response({'error': 'Некорректный JSON'}, status=400)
+    if not isinstance(body, dict) or not isinstance(body.get('friends'), list):
+        return api_response({'error': 'Ожидается объект с полем friends'}, status=400)
+
+    people, errors = [], []
+    for index, item in enumerate(body['friends']):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('Ожидается объект с полями name, email')
+            people.append(friends.parse_person(item.get('name'), item.get('email')))
+        except ValueError as error:
+            errors.append({'index': index, 'error': str(error)})
+    if errors:
+        return api_response({'errors': errors}, status=400)
+
+    travel = body.get('travel')
+    if travel is not None:
+        if isinstance(travel, bool) or not isinstance(travel, int) or not 0 < travel <= sf.MAX_CURSOR:
+            return api_response({'error': 'travel должен быть id путешествия'}, status=400)
+        travel = Travel.objects.filter(pk=travel, travelers=request.user).first()
+        if travel is None:
+            return api_response({'error': 'Путешествие не найдено'}, status=404)
+        if travel.archived:
+            return api_response({'error': 'Путешествие в архиве'}, status=400)
+    try:
+        return api_response(friends.add_friends(request.user, people, travel))
+    except friends.FriendsError as error:
+        return api_response({'error': str(error)}, status=400)
+
+
+@api_login_required
+def api_payments(request, pk):
+    travel = get_object_or_404(Travel, pk=pk, travelers=request.user)
+    try:
+        if request.method == 'GET':
+            return api_response(sync.pull(travel, request.GET.get('cursor')))
+        if request.method == 'POST':
+            try:
+                body = json.loads(request.body)
+            except (ValueError, UnicodeDecodeError):
+                return api_response({'error': 'Некорректный JSON'}, status=400)
+            if not isinstance(body, dict):
+                return api_response({'error': 'Ожидается объект с полем payments'}, status=400)
+            return api_response(sync.push(travel, body.get('payments')))
+    except sync.SyncError as error:
+        return api_response({'error': str(error)}, status=400)
+    return api_response({'error': 'Метод не поддерживается'}, status=405)
+
+
+class TravelsList(routers.ReplicaReadMixin, conditional.ConditionalTravelsMixin, ListView):
     model = Travel
-    paginate_by = 10
     template_name = 'travels_list.html'
     context_object_name = 'travels'
+    prev_cursor = next_cursor = None
 
     def get_queryset(self):
         if isinstance(self.request.user, AnonymousUser):
             return []
-        travels = Travel.objects.filter(travelers__username=self.request.user.username).order_by('-start_date',
-                                                                                                 '-end_date')
-
+        travels, self.prev_cursor, self.next_cursor = sf.travels_page(self.request.user,
+                                                                      after=self.request.GET.get('after'),
+                                                                      before=self.request.GET.get('before'))
         return travels
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['prev_cursor'] = self.prev_cursor
+        context['next_cursor'] = self.next_cursor
+        return context
+
 
 class BaseOperations(LoginRequiredMixin):
     login_url = reverse_lazy('login')
 
 
-class TravelDetail(BaseOperations, DetailView):
+class ActiveTravelMixin:
+    # Платежи добавляют только участники, и не в архивное путешествие: его снимок заморожен
+    def dispatch(self, request, *args, **kwargs):
+        self.travel = get_object_or_404(Travel, pk=kwargs['travel_pk'], travelers=request.user)
+        if self.travel.archived:
+            raise Http404('Путешествие в архиве')
+        return super().dispatch(request, *args, **kwargs)
+
+
+class TravelDetail(routers.ReplicaReadMixin, BaseOperations, conditional.ConditionalTravelMixin, DetailView):
     model = Travel
     template_name = 'travels/travel_details.html'
     context_object_name = 'travel'
 
+    def get_queryset(self):
+        return Travel.objects.filter(travelers=self.request.user)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         travel_object = kwargs.get('object')
-        query = '''
-            select pa.id, concat(pr.first_name, ' ', pr.last_name) as name, pa.title as title, pa.value as value, group_concat(concat(pr2.first_name, ' ',  pr2.last_name) separator ', ') as debitors 
-            from payments_logic_payment pa
-            inner join auth_user pr on pr.id = pa.payer_id
-            left join payments_logic_debt d on d.source_id = pa.id
-            left join auth_user pr2 on pr2.id = d.debitor_id
-            where pa.travel_id = %s
-            group by pa.id, pr.first_name, pr.last_name''' % travel_object.id
-
-        with connection.cursor() as cur:
-            cur.execute(query)
-            context['payments_list'] = sf.dictfetchall(cur)
+        after, before = self.get_cursor('after'), self.get_cursor('before')
+
+        def compute():
+            travelers = {person.id: person for person in travel_cache.get_travelers(travel_object)}
+            payments, prev_cursor, next_cursor = sf.travel_payments(travel_object.id, travelers,
+                                                                    after=after, before=before,
+                                                                    archived=travel_object.archived)
+            return {'travelers': list(travelers.values()),
+                    'payments_list': payments,
+                    'prev_cursor': prev_cursor,
+                    'next_cursor': next_cursor}
+
+        context.update(travel_cache.get_or_compute(travel_object, 'detail', (after, before), compute))
+        context['live_updates'] = settings.LIVE_UPDATES
 
         return context
 
+    def get_cursor(self, name):
+        value = self.request.GET.get(name, '')
+        if not value.isascii() or not value.isdigit() or int(value) > sf.MAX_CURSOR:
+            return None
+        return int(value)
 
-class AddPayment(BaseOperations, CreateView):
+
+class AddPayment(BaseOperations, ActiveTravelMixin, CreateView):
     template_name = 'payments/new_payment.html'
     form_class = PaymentForm
     success_url = reverse_lazy('travel_detail')
 
     def get_form_kwargs(self, *args, **kwargs):
         form_kwargs = super(AddPayment, self).get_form_kwargs()
-        form_kwargs.update({'travel_id': self.kwargs['travel_pk']})
+        form_kwargs.update({'travel': self.travel})
 
         return form_kwargs
 
     def form_valid(self, form):
-        travel = Travel.objects.get(pk=self.kwargs['travel_pk'])
+        travel = self.travel
 
         payment_data = form.save(commit=False)
-        payment_data.travel_id = travel.id
+        payment_data.travel = travel
         payment_data.payer = form.cleaned_data['payer']
 
-        payment_data.save()
+        ledger.record_payment(payment_data, form.cleaned_data['debitors'])
 
-        debitors = form.cleaned_data['debitors'].filter(~Q(id=payment_data.payer.id))
+        return HttpResponseRedirect(reverse('travel_detail', args=[travel.id]))
 
-        if debitors:
-            value = payment_data.value / (len(debitors) + 1)
 
-            Debt.objects.bulk_create(
-                objs=[Debt(source=payment_data,
-                           value=0 - value,
-                           debitor=payment_data.payer)] + [
-                         Debt(source=payment_data,
-                              value=value,
-                              debitor=debitor) for debitor in debitors])
+class ImportPayments(BaseOperations, ActiveTravelMixin, FormView):
+    template_name = 'payments/import_payments.html'
+    form_class = ImportPaymentsForm
 
-        return HttpResponseRedirect(reverse('travel_detail', args=[travel.id]))
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['travel'] = self.travel
+        return context
+
+    def form_valid(self, form):
+        travel = self.travel
+        upload = form.cleaned_data['file']
+        stream = importer.open_text(upload.file) if upload else io.StringIO(form.cleaned_data['text'])
+
+        result = importer.import_payments(travel, stream, form.cleaned_data['format'])
+
+        return self.render_to_response(self.get_context_data(form=form, result=result))
 
 
 class UpdatePayment(BaseOperations, UpdateView):
@@ -101,51 +274,189 @@ class UpdatePayment(BaseOperations, UpdateView):
     model = Payment
     form_class = PaymentForm
 
+    def get_queryset(self):
+        return (Payment.objects
+                .filter(travel_id=self.kwargs['travel_pk'], travel__travelers=self.request.user,
+                        travel__archived=False)
+                .select_related('travel'))
+
     def get_form_kwargs(self, *args, **kwargs):
         form_kwargs = super(UpdatePayment, self).get_form_kwargs()
-        form_kwargs.update({'travel_id': self.kwargs['travel_pk']})
-        form_kwargs.update({'source_id': self.kwargs['source_id']})
+        form_kwargs.update({'travel': self.object.travel})
 
         return form_kwargs
 
-    form_valid = AddPayment.form_valid
+    def form_valid(self, form):
+        payment_data = form.save(commit=False)
+        payment_data.payer = form.cleaned_data['payer']
+
+        ledger.update_payment(payment_data, form.cleaned_data['debitors'])
+
+        return HttpResponseRedirect(self.get_success_url())
 
     def get_success_url(self):
-        return reverse('travel_detail', kwargs={'pk': self.kwargs['pk']})
+        return reverse('travel_detail', kwargs={'pk': self.kwargs['travel_pk']})
 
 
 class DeletePayment(BaseOperations, DeleteView):
     model = Payment
     template_name = 'payments/payment_confirm_delete.html'
 
+    def get_queryset(self):
+        return Payment.objects.filter(travel_id=self.kwargs['travel_pk'], travel__travelers=self.request.user,
+                                      travel__archived=False)
+
+    def delete(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        success_url = self.get_success_url()
+        ledger.delete_payment(self.object)
+        return HttpResponseRedirect(success_url)
+
     def get_success_url(self):
-        return reverse('travel_detail', kwargs={'pk': self.kwargs['pk']})
+        return reverse('travel_detail', kwargs={'pk': self.kwargs['travel_pk']})
 
 
 class SummaryPaymentsAndDebts(TravelDetail):
-    # TODO Продумать возможность сокращения цепочки долгов (например Ксюша - я - Вова = Ксюша - Вова)
     template_name = 'summary.html'
     context_object_name = 'summary'
+    etag_kind = 'summary'
+
+    def get_context_data(self, **kwargs):
+        # Список платежей на странице итогов не нужен, пропускаем запрос TravelDetail
+        context = super(TravelDetail, self).get_context_data(**kwargs)
+        simplify = self.request.GET.get('simplify') == '1'
+        travel = kwargs.get('object')
+        try:
+            context['summary'] = travel_cache.get_or_compute(travel, 'summary', (simplify,),
+                                                             lambda: self.get_summary(travel, simplify))
+        except fx.MissingRateError as error:
+            context['error'] = str(error)
+        context['simplify'] = simplify
+        return context
+
+    @staticmethod
+    def get_summary(travel, simplify):
+        if simplify:
+            # Чистые балансы уже лежат в TravelBalance в валюте путешествия, агрегировать Debt не нужно
+            return sf.settle_balances(ledger.get_balances(travel.id))
+        if travel.archived:
+            return sf.settle(fx.convert_totals(archive.summary_rows([travel.id]), travel.currency))
+        # Фильтр и группировка по id из индекса Debt, из платежа по первичному ключу берутся только валюта и дата
+        return sf.settle(fx.convert_totals(Debt.objects
+                                           .filter(travel_id=travel.id)
+                                           .filter(~Q(debitor_id=F('payer_id')))
+                                           .values('debitor_id', 'payer_id',
+                                                   currency=F('source__currency'),
+                                                   date=F('source__date'))
+                                           .annotate(total=Sum('value'))
+                                           .order_by(),
+                                           travel.currency))
+
+
+class TravelAnalytics(routers.ReplicaReadMixin, BaseOperations, conditional.ConditionalTravelMixin, DetailView):
+    template_name = 'analytics.html'
+    context_object_name = 'travel'
+    etag_kind = 'analytics'
+    fmt = 'html'
+
+    def get_queryset(self):
+        return Travel.objects.filter(travelers=self.request.user)
+
+    def get_spending(self):
+        travel = self.object
+        return travel_cache.get_or_compute(travel, 'analytics', (),
+                                           lambda: analytics.travel_spending(travel,
+                                                                             travel_cache.get_travelers(travel)))
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        summary = sf.get_summary(Debt.objects
-                                 .filter(source__travel_id=kwargs.get('object').id)
-                                 .values('debitor__username', 'source__payer__username')
-                                 .filter(~Q(debitor__username=F('source__payer__username')))
-                                 .annotate(total=Sum('value')))
+        try:
+            context['spending'] = self.get_spending()
+        except fx.MissingRateError as error:
+            context['error'] = str(error)
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        if self.fmt != 'json':
+            return super().render_to_response(context, **response_kwargs)
+        if 'error' in context:
+            return api_response({'error': context['error']}, status=400)
+        # Для графиков: кортежи уходят массивами, суммы - строками
+        return api_response(context['spending'])
+
+
+class GlobalBalances(BaseOperations, TemplateView):
+    template_name = 'global_balances.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        currencies = dict(Travel.CURRENCIES)
+        currency = self.request.GET.get('currency')
+        if currency not in currencies:
+            currency = fx.reference_currency()
+        simplify = self.request.GET.get('simplify') == '1'
+        try:
+            context['summary'] = sf.global_settlement(self.request.user, currency, simplify)
+        except fx.MissingRateError as error:
+            context['error'] = str(error)
+        context.update({'currency': currency,
+                        'currencies': Travel.CURRENCIES,
+                        'simplify': simplify})
+        return context
+
+
+class Search(routers.ReplicaReadMixin, BaseOperations, TemplateView):
+    template_name = 'search.html'
 
-        context['summary'] = summary
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        page = self.request.GET.get('page', '')
+        # Номер страницы уходит в OFFSET, поэтому ограничен так же, как курсоры
+        page = int(page) if page.isascii() and page.isdigit() and 0 < int(page) <= sf.MAX_CURSOR // 100 else 1
+        hits, has_next = search.search(self.request.user, query, page)
+        # Названия путешествий для найденных платежей - одним запросом
+        travel_titles = dict(Travel.objects
+                             .filter(pk__in={hit.travel_id for hit in hits})
+                             .values_list('id', 'title'))
+        context.update({'query': query,
+                        'page': page,
+                        'has_next': has_next,
+                        'results': [(hit, travel_titles.get(hit.travel_id)) for hit in hits]})
         return context
 
 
+class ExportLedger(BaseOperations, View):
+    # Без pk выгружаются все путешествия текущего пользователя
+    def get(self, request, fmt, pk=None):
+        if fmt not in export.CONTENT_TYPES:
+            raise Http404
+        travels = Travel.objects.filter(travelers=request.user)
+        if pk is not None:
+            travels = travels.filter(pk=pk)
+            if not travels.exists():
+                raise Http404
+        compress = request.GET.get('gzip') == '1'
+
+        filename = f'travel_{pk}.{fmt}' if pk is not None else f'travels_{request.user.username}.{fmt}'
+        if compress:
+            response = StreamingHttpResponse(export.export_stream(travels, fmt, compress=True),
+                                             content_type='application/gzip')
+            filename += '.gz'
+        else:
+            response = StreamingHttpResponse(export.export_stream(travels, fmt),
+                                             content_type=export.CONTENT_TYPES[fmt])
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+
 class CreateTravel(BaseOperations, CreateView):
     template_name = 'travels/new_travel.html'
     form_class = TravelForm
 
     def get_form_kwargs(self, *args, **kwargs):
         form_kwargs = super(CreateTravel, self).get_form_kwargs()
-        form_kwargs.update({'current_user': self.request.user.username})
+        form_kwargs.update({'current_user': self.request.user})
         return form_kwargs
 
     def form_valid(self, form):
@@ -163,9 +474,16 @@ class UpdateTravel(BaseOperations, UpdateView):
 
     def get_form_kwargs(self, *args, **kwargs):
         form_kwargs = super(UpdateTravel, self).get_form_kwargs()
-        form_kwargs.update({'current_user': self.request.user.username})
+        form_kwargs.update({'current_user': self.request.user})
         return form_kwargs
 
+    def form_valid(self, form):
+        response = super(UpdateTravel, self).form_valid(form)
+        if 'currency' in form.changed_data:
+            # Балансы хранятся в валюте путешествия и пересчитываются целиком
+            ledger.rebuild_balances([self.object.id])
+        return response
+
     def get_success_url(self):
         return reverse('travel_detail', kwargs={'pk': self.kwargs['pk']})
 
@@ -182,24 +500,29 @@ class NewPerson(BaseOperations, FormView):
     success_url = reverse_lazy('new_travel')
 
     def form_valid(self, form):
-        form_data = form.cleaned_data
-        email = form_data.get('email', None)
-        name = form_data.get('name')
-        if email:
-            username = email[:email.index('@')]
-        else:
-            username = name + str(uuid.uuid4())[:8]
+        friends.add_friends(self.request.user, [(form.cleaned_data['name'], form.cleaned_data['email'])])
 
-        creator = User.objects.get(username=self.request.user.username)
+        return HttpResponseRedirect(reverse('new_travel'))
 
-        existing_user = User.objects.filter(email=email)
-        if not existing_user:
-            existing_user = User.objects.create_user(username=username, first_name=name, email=email)
-            existing_user.save()
-        else:
-            existing_user = existing_user[0]
 
-        new_friendship = Friendship(creator=creator, friend=existing_user)
-        new_friendship.save()
+class NewFriends(BaseOperations, FormView):
+    template_name = 'new_friends.html'
+    form_class = FriendsForm
 
-        return HttpResponseRedirect(reverse('new_travel'))
+    def get_form_kwargs(self, *args, **kwargs):
+        form_kwargs = super(NewFriends, self).get_form_kwargs()
+        form_kwargs.update({'current_user': self.request.user})
+        return form_kwargs
+
+    def get_initial(self):
+        # Со страницы путешествия форма открывается с ним же
+        return {'travel': self.request.GET.get('travel')}
+
+    def form_valid(self, form):
+        travel = form.cleaned_data['travel']
+        result = friends.add_friends(self.request.user, form.cleaned_data['people'], travel)
+        if travel is not None:
+            return HttpResponseRedirect(reverse('travel_detail', args=[travel.id]))
+
+        return self.render_to_response(self.get_context_data(form=self.get_form_class()(self.request.user),
+                                                             result=result))
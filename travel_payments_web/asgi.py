@@ -13,4 +13,8 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'travel_payments_web.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from payments_logic.live import with_events  # noqa: E402 - модели доступны только после setup()
+
+application = with_events(django_application)
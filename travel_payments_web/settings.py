@@ -50,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'payments_logic.middleware.InstrumentationMiddleware',
+    'payments_logic.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +59,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'payments_logic.middleware.ReplicaPinMiddleware',
+    'payments_logic.middleware.ProfilingMiddleware',
 ]
 
 AUTHENTICATION_BACKENDS = (
@@ -98,6 +102,8 @@ if DEBUG:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            # Одновременные записи ждут освобождения базы дольше стандартных 5 секунд
+            'OPTIONS': {'timeout': 20},
         }
     }
 else:
@@ -111,6 +117,83 @@ else:
             'OPTIONS': {'init_command': "SET sql_mode='STRICT_TRANS_TABLES'"}},
     }
 
+# Persistent connections: a connection is reused for DB_CONN_MAX_AGE seconds (0 - new one per request,
+# as before). With DB_HEALTH_CHECKS=1 a reused connection is pinged at the start of each request and
+# reopened if the server dropped it while idle.
+
+DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('DB_CONN_MAX_AGE', 0 if DEBUG else 60))
+DB_HEALTH_CHECKS = os.getenv('DB_HEALTH_CHECKS', '1') == '1'
+
+# Read replica: read-only pages (travel list, travel, summary, news) read from it, writes and everything
+# else stay on 'default'. After their own write a user reads from 'default' for REPLICA_PIN_SECONDS,
+# longer than the expected replication lag. Locally two SQLite files work as primary and replica:
+# DB_REPLICA_NAME=replica.sqlite3 and a copy of db.sqlite3 made after migrate.
+
+if DEBUG and os.getenv('DB_REPLICA_NAME'):
+    DATABASES['replica'] = dict(DATABASES['default'], NAME=BASE_DIR / os.getenv('DB_REPLICA_NAME'))
+elif not DEBUG and os.getenv('DB_REPLICA_HOST'):
+    DATABASES['replica'] = dict(DATABASES['default'], HOST=os.getenv('DB_REPLICA_HOST'),
+                                USER=os.getenv('DB_REPLICA_USERNAME', DATABASES['default']['USER']),
+                                PASSWORD=os.getenv('DB_REPLICA_PASSWORD', DATABASES['default']['PASSWORD']))
+if 'replica' in DATABASES:
+    # Tests run against a single database
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+DATABASE_ROUTERS = ['payments_logic.routers.ReplicaRouter']
+REPLICA_PIN_COOKIE = 'primary_reads'
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'travels'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', str(BASE_DIR / '.cache' / 'travels')),
+    'db': ('django.core.cache.backends.db.DatabaseCache', 'travel_cache'),  # manage.py createcachetable
+}
+TRAVEL_CACHE_BACKEND, TRAVEL_CACHE_LOCATION = CACHE_BACKENDS[os.getenv('TRAVEL_CACHE_BACKEND', 'locmem')]
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'travels': {
+        'BACKEND': TRAVEL_CACHE_BACKEND,
+        'LOCATION': TRAVEL_CACHE_LOCATION,
+        'TIMEOUT': int(os.getenv('TRAVEL_CACHE_TIMEOUT', 600)),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('TRAVEL_CACHE_MAX_ENTRIES', 1000))},
+    },
+}
+TRAVEL_CACHE_ALIAS = 'travels'
+
+# Per-view latency and query metrics, exposed at /metrics for staff
+
+METRICS_QUERY_BUDGET = int(os.getenv('METRICS_QUERY_BUDGET', 30))
+
+# On-demand profiling: staff send X-Profile: 1 or ?profile=1, or every Nth request is sampled (0 - off)
+
+PROFILING_SAMPLE_RATE = int(os.getenv('PROFILING_SAMPLE_RATE', 0))
+PROFILING_DIR = BASE_DIR / 'profiles'
+PROFILING_MAX_FILES = 50
+
+# Live ledger updates (server-sent events, served only under ASGI): 'local' for a single worker,
+# 'database' polls travel versions so that writes in other workers are seen as well
+
+LIVE_UPDATES = os.getenv('LIVE_UPDATES', '0') == '1'
+EVENTS_BROKERS = {
+    'local': 'payments_logic.events.LocalBroker',
+    'database': 'payments_logic.events.DatabaseBroker',
+}
+EVENTS_BROKER = EVENTS_BROKERS[os.getenv('EVENTS_BROKER', 'local')]
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', 1))
+
+# Exchange rates are loaded from a local CSV with `manage.py load_fx_rates`
+
+FX_REFERENCE_CURRENCY = 'RUR'
+FX_LOOKBACK_DAYS = 14
+FX_CACHE_SIZE = 10000
+# Per-process rate cache lifetime; load_fx_rates also resets it everywhere via the travels cache
+FX_CACHE_SECONDS = 300
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -148,6 +231,17 @@ USE_TZ = True
 STATIC_ROOT = BASE_DIR / 'static'
 STATIC_URL = '/static/'
 
+# Hashed names (css/skeleton.<hash>.css) are written next to the originals by `manage.py hashstatic`
+# on deploy, so they can be cached for a year. SERVE_STATIC=1 lets Django serve them when no
+# front server does.
+
+STATICFILES_STORAGE = 'payments_logic.storage.HashedStaticStorage'
+SERVE_STATIC = os.getenv('SERVE_STATIC', '0') == '1'
+
+# Responses smaller than this are sent uncompressed: the gzip header would eat the gain
+
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 512))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -13,8 +13,11 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+
+from payments_logic.views import static_file
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -22,4 +25,7 @@ urlpatterns = [
     path('', include('news_blog.urls')),
     path('', include('social_django.urls', namespace='social'))
 
-]
\ No newline at end of file
+]
+
+if settings.SERVE_STATIC:
+    urlpatterns.insert(0, re_path(r'^static/(?P<path>.*)$', static_file))